@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+This program runs any number of audits over an OSM file in a single streaming
+pass, instead of parsing the whole XML file once per audit.
+
+Each audit is a visitor object with:
+    - element_types: tuple with the element types it is interested in
+    - visit(element_type, tags): called once per element with the list of
+      (key, value) pairs of its secondary tags
+    - result(): returns the outcome of the audit
+
+The following audits are provided:
+    - TagValuesAudit: same results as audit_tag_types.get_tags
+    - StreetTypesAudit: same results as audit_street_types.get_street_types
+    - CityNamesAudit: number of occurrences of each city name
+    - PostcodeAudit: valid and invalid postal codes with their occurrences
+The street names used to group their variants are collected with the
+StreetNamesAudit of audit_street_clusters.
+
+Python version: 3.6.0
+"""
+
+import sys
+import re
+from collections import Counter
+
+from osm_reader import iter_records
+from audit_tag_types import count_elems, new_value_sets
+from audit_street_types import add_street_type
+
+
+# ================================================== #
+#               Audit Visitors                       #
+# ================================================== #
+class TagValuesAudit(object):
+    """Stores all the different values of each tag key for a given element
+       type (node, way)"""
+    
+    def __init__(self, element_type, max_values=None, max_total_values=None):
+        self.element_types = (element_type,)
+        self.tag_types = new_value_sets(max_values, max_total_values=max_total_values)
+    
+    def visit(self, element_type, tags):
+        for key, value in tags:
+            self.tag_types[key].add(value)
+    
+    def result(self):
+        return self.tag_types, count_elems(self.tag_types)
+
+
+class StreetTypesAudit(object):
+    """Stores the street names found in "addr:street" tags grouped by street
+       type, given by the regular expression provided"""
+    
+    def __init__(self, street_type_re, element_types=('node', 'way'), 
+                 max_values=None, max_total_values=None):
+        self.element_types = element_types
+        self.street_type_re = street_type_re
+        self.street_types = new_value_sets(max_values, max_total_values=max_total_values)
+    
+    def visit(self, element_type, tags):
+        for key, value in tags:
+            if key == 'addr:street':
+                add_street_type(self.street_types, value, self.street_type_re)
+    
+    def result(self):
+        return self.street_types, count_elems(self.street_types)
+
+
+class CityNamesAudit(object):
+    """Counts the occurrences of each city name found in "addr:city" tags"""
+    
+    def __init__(self, element_types=('node', 'way')):
+        self.element_types = element_types
+        self.cities = Counter()
+    
+    def visit(self, element_type, tags):
+        for key, value in tags:
+            if key == 'addr:city':
+                self.cities[value] += 1
+    
+    def result(self):
+        return self.cities
+
+
+class PostcodeAudit(object):
+    """Counts the occurrences of the postal codes found in "addr:postcode"
+       tags, split into valid and invalid ones"""
+    
+    def __init__(self, postcode_re=re.compile(r'^\d{5}$'),
+                 element_types=('node', 'way')):
+        self.element_types = element_types
+        self.postcode_re = postcode_re
+        self.valid = Counter()
+        self.invalid = Counter()
+    
+    def visit(self, element_type, tags):
+        for key, value in tags:
+            if key == 'addr:postcode':
+                if self.postcode_re.match(value):
+                    self.valid[value] += 1
+                else:
+                    self.invalid[value] += 1
+    
+    def result(self):
+        return self.valid, self.invalid
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def run_audits(osm_file, audits, backend=None):
+    """Feeds every element record of the OSM file to the audits interested in
+       its type, parsing the file only once, and returns the list of results in
+       the same order as the audits"""
+    
+    element_types = set()
+    for audit in audits:
+        element_types.update(audit.element_types)
+    
+    for elem in iter_records(osm_file, tuple(element_types), backend):
+        for audit in audits:
+            if elem.tag in audit.element_types:
+                audit.visit(elem.tag, elem.tags)
+    
+    return [audit.result() for audit in audits]
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    OSM_FILE = sys.argv[1]
+    st_type_re = re.compile(r'\S+\b', re.IGNORECASE)
+    
+    ((node_tag_types, node_tag_numbers), (way_tag_types, way_tag_numbers),
+     (st_types, st_types_count), cities, (valid_postcodes, invalid_postcodes)) = \
+        run_audits(OSM_FILE, [TagValuesAudit('node'), TagValuesAudit('way'),
+                              StreetTypesAudit(st_type_re), CityNamesAudit(),
+                              PostcodeAudit()])
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+This program groups the street names which are variants of the same street,
+to find the corrections of the street mapping (see correction_rules) without
+reading the output of audit_street_types by eye.
+
+The distinct values of the "addr:street" tags and the "name" tags of the
+highways are collected in a single pass (StreetNamesAudit, an audit of
+audit_engine) and each one is normalised into a blocking key:
+    - lower case, without accents (Fernandez/Fernández) or punctuation
+    - the street type (first word) replaced by its Galician name, including
+      the Spanish names (Calle, Plaza, Carretera...) and the abbreviations
+      (Av., Avda, C/...), or removed if the name has no street type
+    - without the articles and prepositions (de, do, da, del, la...), which
+      differ between the Spanish and Galician spellings
+The names with the same key are grouped (exact clustering), and the names
+without street type are added to the group of the same key with a street
+type, if there is only one. The keys whose character trigrams have a Jaccard
+similarity of at least threshold are then merged (approximate clustering,
+e.g. typos), as long as their street types and their numbers are the same.
+The similar keys are found with an inverted index of the rarest trigrams of
+each key (prefix filtering), so only the keys sharing one of them are
+compared and the run time grows almost linearly with the number of names.
+
+The name chosen for each group is the one with an expected street type, not
+written in upper case, with accents and the most frequent. The proposed
+mapping of the other names of the group to this name is saved along with the
+current rules in a JSON data file which can be loaded with
+correction_rules.load_rules (the groups are saved in the same file, under
+street_clusters, for their review).
+
+Python version: 3.6.0
+"""
+
+import re
+import sys
+import math
+import argparse
+import unicodedata
+from collections import Counter, defaultdict
+
+import audit_engine
+import correction_rules
+
+SIMILARITY_THRESHOLD = 0.7
+
+# Street types in Spanish and abbreviated (normalised, see normalise) and
+# their Galician name
+STREET_TYPE_ALIASES = {'calle': 'Rúa', 'c': 'Rúa', 'cl': 'Rúa', 'r': 'Rúa',
+                       'plaza': 'Praza', 'pza': 'Praza', 'pl': 'Praza',
+                       'plza': 'Praza', 'avda': 'Avenida', 'avd': 'Avenida',
+                       'av': 'Avenida', 'carretera': 'Estrada', 'ctra': 'Estrada',
+                       'camino': 'Camiño', 'ronda': 'Rolda', 'trav': 'Travesía',
+                       'pso': 'Paseo', 'plazuela': 'Praciña',
+                       'plazoleta': 'Praciña', 'callejon': 'Calexón',
+                       'rampa': 'Rampla', 'muelle': 'Peirao',
+                       'autopista': 'Autoestrada'}
+# Articles and prepositions left out of the blocking keys
+STOP_WORDS = frozenset(['de', 'do', 'da', 'dos', 'das', 'del', 'la', 'las',
+                        'el', 'los', 'o', 'a', 'os', 'as', 'y', 'e'])
+WORD_RE = re.compile(r'\w+')
+
+
+# ================================================== #
+#               Street Names Audit                   #
+# ================================================== #
+class StreetNamesAudit(object):
+    """Counts the occurrences of the street names found in "addr:street"
+       tags and in the "name" tags of the highways"""
+    
+    def __init__(self, element_types=('node', 'way'), highway_names=True):
+        self.element_types = element_types
+        self.highway_names = highway_names
+        self.names = Counter()
+    
+    def visit(self, element_type, tags):
+        name = None
+        highway = False
+        for key, value in tags:
+            if key == 'addr:street':
+                self.names[value] += 1
+            elif key == 'name':
+                name = value
+            elif key == 'highway':
+                highway = True
+        
+        if highway and name is not None and self.highway_names:
+            self.names[name] += 1
+    
+    def result(self):
+        return self.names
+
+
+# ================================================== #
+#               Blocking Keys                        #
+# ================================================== #
+def normalise(text):
+    """Lower case text without accents"""
+    
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def street_type_names(rules):
+    """Dictionary of the normalised street types (expected street types,
+       Spanish names and abbreviations) and their Galician name"""
+    
+    type_names = {}
+    for alias, street_type in STREET_TYPE_ALIASES.items():
+        type_names[alias] = street_type
+    for abbreviation, street_type in rules.abbreviations.items():
+        type_names[' '.join(WORD_RE.findall(normalise(abbreviation)))] = street_type
+    for street_type in rules.expected_street_types:
+        type_names[normalise(street_type)] = street_type
+    
+    return type_names
+
+
+def blocking_key(name, type_names):
+    """Returns the Galician street type of a street name (None if it has
+       none) and its key: normalised words without the street type and the
+       stop words"""
+    
+    words = WORD_RE.findall(normalise(name))
+    street_type = None
+    if len(words) > 1 and words[0] in type_names:
+        street_type = type_names[words[0]]
+        words = words[1:]
+    
+    key_words = [word for word in words if word not in STOP_WORDS]
+    
+    return street_type, ' '.join(key_words or words)
+
+
+def trigrams(key):
+    """Set of the character trigrams of a key, without the spaces"""
+    
+    text = ' {0} '.format(key.replace(' ', ''))
+    return frozenset(sys.intern(text[i:i + 3]) for i in range(len(text) - 2))
+
+
+def numbers(key):
+    return tuple(word for word in key.split() if any(c.isdigit() for c in word))
+
+
+# ================================================== #
+#               Similarity Search                    #
+# ================================================== #
+def similar_keys(keys, threshold=SIMILARITY_THRESHOLD):
+    """Returns the (similarity, i, j) pairs of keys whose trigram sets have a
+       Jaccard similarity of at least threshold (prefix filtering join). The
+       trigrams of each set are sorted from the rarest to the most frequent,
+       and two sets with the required similarity share one of their first
+       trigrams, so only these are looked up in the inverted index: the 
+       probing prefix of the set compared with the indexing prefix of the 
+       smaller sets (see Xiao et al., Efficient similarity joins for near 
+       duplicate detection, 2008)"""
+    
+    sets = [trigrams(key) for key in keys]
+    frequency = Counter(gram for grams in sets for gram in grams)
+    index_threshold = 2 * threshold / (1 + threshold)
+    
+    # Keys of each trigram, by size, and first one large enough to be similar
+    index = defaultdict(list)
+    index_start = Counter()
+    pairs = []
+    for i in sorted(range(len(keys)), key=lambda i: (len(sets[i]), keys[i])):
+        grams = sets[i]
+        size = len(grams)
+        if not size:
+            continue
+        
+        grams_order = sorted(grams, key=lambda gram: (frequency[gram], gram))
+        probe_size = size - int(math.ceil(threshold * size - 1e-9)) + 1
+        index_size = size - int(math.ceil(index_threshold * size - 1e-9)) + 1
+        min_size = threshold * size - 1e-9
+        
+        candidates = set()
+        for gram in grams_order[:probe_size]:
+            postings = index.get(gram)
+            if postings is None:
+                continue
+            # The keys too small for this one are too small for the next ones
+            start = index_start[gram]
+            while start < len(postings) and len(sets[postings[start]]) < min_size:
+                start += 1
+            index_start[gram] = start
+            candidates.update(postings[start:])
+        for gram in grams_order[:index_size]:
+            index[gram].append(i)
+        
+        for j in candidates:
+            common = len(grams & sets[j])
+            similarity = common / float(size + len(sets[j]) - common)
+            if similarity >= threshold:
+                pairs.append((similarity, j, i))
+    
+    return pairs
+
+
+# ================================================== #
+#               Clustering                           #
+# ================================================== #
+def block_pairs(blocks, threshold):
+    """Returns the (similarity, block, block) pairs of blocks to be merged:
+       blocks with the same key, one without street type, and blocks with
+       similar keys, the same street type (or none) and the same numbers"""
+    
+    key_types = defaultdict(list)
+    for street_type, key in blocks:
+        key_types[key].append(street_type)
+    
+    pairs = []
+    for key, street_types in key_types.items():
+        if None in street_types:
+            pairs.extend((1.0, (None, key), (street_type, key))
+                         for street_type in street_types if street_type is not None)
+    
+    if threshold is not None and threshold < 1:
+        keys = sorted(key_types)
+        for similarity, i, j in similar_keys(keys, threshold):
+            if numbers(keys[i]) != numbers(keys[j]):
+                continue
+            for type_i in key_types[keys[i]]:
+                for type_j in key_types[keys[j]]:
+                    if type_i == type_j or type_i is None or type_j is None:
+                        pairs.append((similarity, (type_i, keys[i]), (type_j, keys[j])))
+    
+    # A block without street type is only merged if its most similar blocks
+    # have a single street type
+    best = {}
+    for similarity, block_a, block_b in pairs:
+        for block, other in ((block_a, block_b), (block_b, block_a)):
+            if block[0] is None and other[0] is not None:
+                best_similarity, best_types = best.get(block, (0, set()))
+                if similarity > best_similarity:
+                    best[block] = (similarity, {other[0]})
+                elif similarity == best_similarity:
+                    best_types.add(other[0])
+    ambiguous = set(block for block, (_, street_types) in best.items()
+                    if len(street_types) > 1)
+    
+    pairs = [pair for pair in pairs
+             if pair[1] not in ambiguous and pair[2] not in ambiguous]
+    pairs.sort(key=lambda pair: (-pair[0], pair[1][1], pair[2][1],
+                                 pair[1][0] or '', pair[2][0] or ''))
+    
+    return pairs
+
+
+def merge_blocks(blocks, pairs):
+    """Merges the blocks of the pairs, in order, into groups of blocks with
+       a single street type (union-find). Returns the groups as lists"""
+    
+    parent = {block: block for block in blocks}
+    group_type = {block: block[0] for block in blocks}
+    
+    def find(block):
+        while parent[block] != block:
+            parent[block] = parent[parent[block]]
+            block = parent[block]
+        return block
+    
+    for _, block_a, block_b in pairs:
+        root_a, root_b = find(block_a), find(block_b)
+        if root_a == root_b:
+            continue
+        type_a, type_b = group_type[root_a], group_type[root_b]
+        if type_a is not None and type_b is not None and type_a != type_b:
+            continue
+        parent[root_b] = root_a
+        group_type[root_a] = type_a or type_b
+    
+    groups = defaultdict(list)
+    for block in blocks:
+        groups[find(block)].append(block)
+    
+    return [(group_type[root], group) for root, group in groups.items()]
+
+
+def canonical_name(names, street_type, rules, type_names):
+    """Chooses the name of a group: the corrected name (see
+       correction_rules) with an expected street type, not in upper case,
+       with more accents and more frequent. The Galician street type is added
+       or replaced if the chosen name has none or a Spanish one"""
+    
+    corrected = Counter()
+    for name, count in names.items():
+        corrected[rules.street_name(name)] += count
+    
+    def score(name):
+        words = name.split()
+        return (bool(words) and rules.is_street_type(words[0]), not name.isupper(),
+                sum(1 for c in unicodedata.normalize('NFD', name) if unicodedata.combining(c)),
+                corrected[name], name)
+    
+    name = max(corrected, key=score)
+    if street_type is not None:
+        words = name.split(' ', 1)
+        first_word = ' '.join(WORD_RE.findall(normalise(words[0])))
+        if len(words) > 1 and first_word in type_names:
+            if not rules.is_street_type(words[0]):
+                name = street_type + ' ' + words[1]
+        else:
+            name = street_type + ' ' + name
+    
+    return name
+
+
+def cluster_street_names(names, rules, threshold=SIMILARITY_THRESHOLD):
+    """Groups the street names (dictionary of names and occurrences) which
+       are variants of the same street. threshold is the similarity of the
+       approximate clustering (None for the exact clustering only). Returns
+       the list of groups of two or more names, as dictionaries with the
+       chosen name, the street type, the names and their total occurrences,
+       sorted by occurrences"""
+    
+    type_names = street_type_names(rules)
+    
+    blocks = defaultdict(dict)
+    for name, count in names.items():
+        blocks[blocking_key(name, type_names)][name] = count
+    
+    pairs = block_pairs(blocks, threshold)
+    
+    clusters = []
+    for street_type, group in merge_blocks(blocks, pairs):
+        group_names = {}
+        for block in group:
+            group_names.update(blocks[block])
+        if len(group_names) < 2:
+            continue
+        clusters.append({'name': canonical_name(group_names, street_type, rules, type_names),
+                         'street_type': street_type,
+                         'names': sorted(group_names.items(), key=lambda item: (-item[1], item[0])),
+                         'count': sum(group_names.values())})
+    
+    clusters.sort(key=lambda cluster: (-cluster['count'], cluster['name']))
+    
+    return clusters
+
+
+def proposed_mapping(clusters, rules):
+    """Mapping of the names of each group to its chosen name, leaving out the
+       names already corrected to it by the rules"""
+    
+    mapping = {}
+    for cluster in clusters:
+        for name, _ in cluster['names']:
+            if name != cluster['name'] and rules.street_name(name) != cluster['name']:
+                mapping[name] = cluster['name']
+    
+    return mapping
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def audit_street_clusters(osm_file, rules, threshold=SIMILARITY_THRESHOLD,
+                          backend=None):
+    """Collects the street names of the OSM file and groups their variants.
+       Returns the groups and the proposed street mapping"""
+    
+    names = audit_engine.run_audits(osm_file, [StreetNamesAudit()], backend)[0]
+    clusters = cluster_street_names(names, rules, threshold)
+    
+    return clusters, proposed_mapping(clusters, rules)
+
+
+def save_proposed_rules(rules, mapping, clusters, rules_file):
+    """Saves the rules with the proposed mapping added to the street mapping
+       (the current entries are kept) and the groups, for their review"""
+    
+    street_mapping = dict(mapping)
+    street_mapping.update(rules.street_mapping)
+    proposed_rules = correction_rules.CorrectionRules(
+        street_mapping, rules.expected_street_types, rules.abbreviations,
+        rules.city_rules)
+    
+    correction_rules.save_rules(proposed_rules, rules_file, street_clusters=clusters)
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    parser = argparse.ArgumentParser(description='Group the variants of the street names')
+    parser.add_argument('osm_file')
+    parser.add_argument('-r', '--rules', default=correction_rules.RULES_FILE,
+                        help='current rules file')
+    parser.add_argument('-o', '--output', default='proposed_rules.json',
+                        help='rules file with the proposed street mapping')
+    parser.add_argument('-t', '--threshold', type=float, default=SIMILARITY_THRESHOLD,
+                        help='similarity of the approximate clustering (1 for exact only)')
+    args = parser.parse_args()
+    
+    RULES = correction_rules.load_rules(args.rules)
+    CLUSTERS, MAPPING = audit_street_clusters(args.osm_file, RULES, args.threshold)
+    save_proposed_rules(RULES, MAPPING, CLUSTERS, args.output)
+    
+    for CLUSTER in CLUSTERS:
+        print(CLUSTER['name'])
+        for NAME, COUNT in CLUSTER['names']:
+            print('    {0}: {1}'.format(NAME, COUNT))
+    print('{0} groups, {1} names mapped, saved to {2}'.format(
+        len(CLUSTERS), len(MAPPING), args.output))
@@ -5,14 +5,18 @@ found in the input OSM file and the street names associated to each street type.
 Additionally, a dictionary with the number of occurrences for each street type
 is provided.
 
+Only the "addr:street" tags of the node and way records of osm_reader are
+read. The number of street names stored per street type can be capped with
+max_values (see audit_tag_types.new_value_sets).
+
 Python version: 3.6.0
 """
 
 import sys
 import re
-import codecs
-import xml.etree.cElementTree as ET
-from collections import defaultdict
+from osm_reader import iter_records
+from audit_tag_types import (count_elems, new_value_sets, SKETCH_WIDTH, 
+                             SKETCH_DEPTH)
 
 
 def add_street_type(street_types, street_name, street_type_re):
@@ -24,33 +28,23 @@ def add_street_type(street_types, street_name, street_type_re):
         street_types[street_type].add(street_name)
 
 
-def count_elems(dict_in):
-    """Produces a dictionary with the number of occurrences on each dictionary key"""
-    
-    counter = defaultdict(int)
-    for key, values in dict_in.items():
-        counter[key] = len(values)
-    
-    return counter
-
-
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def get_street_types(osm_file, street_type_re):
+def get_street_types(osm_file, street_type_re, max_values=None, 
+                     sketch_width=SKETCH_WIDTH, sketch_depth=SKETCH_DEPTH, 
+                     backend=None, max_total_values=None):
     """Creates a dictionary of sets with the street types as keys and the 
        street names as values, and another dictionary with the total number
        of streets for each street type"""
     
-    with codecs.open(osm_file, "r", encoding="utf-8") as osm:
-
-        street_types = defaultdict(set)
-        for event, elem in ET.iterparse(osm, events=("start",)):
-
-            if (elem.tag == "node") or (elem.tag == "way"):
-                for tag in elem.iter("tag"):
-                    if tag.attrib["k"] == 'addr:street':
-                        add_street_type(street_types, tag.attrib["v"], street_type_re)
+    street_types = new_value_sets(max_values, sketch_width, sketch_depth, 
+                                  max_total_values)
+    
+    for elem in iter_records(osm_file, ("node", "way"), backend):
+        for key, value in elem.tags:
+            if key == 'addr:street':
+                add_street_type(street_types, value, street_type_re)
     
     street_types_count = count_elems(street_types)
     
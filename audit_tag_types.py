@@ -3,40 +3,282 @@
 This program is meant to read all the different tag types linked to a given
 element type (e.g. nodes) contained in the OSM file.
 
+The tags of each element are read from its record (osm_reader.iter_records).
+For keys with a very high number of different values (e.g. "name") the values
+stored per key can be capped with max_values: only the most frequent values
+are then kept, ranked with a count-min sketch of a fixed size (sketch_width x
+sketch_depth counters) shared among all the keys.
+The values kept among all the keys are capped too (max_total_values), the
+least frequent ones being evicted, so the memory does not grow with the number
+of keys. The number of different values of the capped keys is then estimated
+with a small HyperLogLog counter per key.
+
 Python version: 3.6.0
 """
 
 import sys
-import codecs
-import xml.etree.cElementTree as ET
+import math
+import heapq
+import random
+from array import array
 from collections import defaultdict
 
+from osm_reader import iter_records
+
+SKETCH_WIDTH = 2 ** 16
+SKETCH_DEPTH = 4
+# Values kept among all the keys when the values are capped
+MAX_TOTAL_VALUES = 2 ** 20
+# Registers (2 ** precision bytes) of the distinct value estimates
+DISTINCT_PRECISION = 8
+HASH_BITS = 64
+
 
 def count_elems(dict_in):
-    """Produces a dictionary with the number of occurrences on each dictionary key"""
+    """Produces a dictionary with the number of occurrences on each dictionary key
+       (estimated for the keys whose values were capped, see TopValues)"""
     
     counter = defaultdict(int)
     for key, values in dict_in.items():
-        counter[key] = len(values)
+        if isinstance(values, TopValues):
+            counter[key] = values.distinct_count()
+        else:
+            counter[key] = len(values)
     
     return counter
 
 
+# ================================================== #
+#               Capped Value Sets                    #
+# ================================================== #
+class CountMinSketch(object):
+    """Approximate counter of item frequencies using a fixed amount of memory.
+       The estimates never fall below the real counts"""
+    
+    PRIME = 2 ** 61 - 1
+    
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, seed=0):
+        self.width = width
+        self.rows = [array('L', [0]) * width for _ in range(depth)]
+        rng = random.Random(seed)
+        self.hashes = [(rng.randrange(1, self.PRIME), rng.randrange(self.PRIME)) 
+                       for _ in range(depth)]
+    
+    def cells(self, item):
+        h = hash(item)
+        return [((a * h + b) % self.PRIME) % self.width for a, b in self.hashes]
+    
+    def add(self, item):
+        """Counts one occurrence of the item and returns its estimated count"""
+        
+        estimate = None
+        for row, cell in zip(self.rows, self.cells(item)):
+            row[cell] += 1
+            if estimate is None or row[cell] < estimate:
+                estimate = row[cell]
+        
+        return estimate
+    
+    def estimate(self, item):
+        return min(row[cell] for row, cell in zip(self.rows, self.cells(item)))
+
+
+class DistinctCounter(object):
+    """Estimate of the number of distinct items added (HyperLogLog), using a
+       fixed amount of memory (2 ** precision one-byte registers)"""
+    
+    def __init__(self, precision=DISTINCT_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+    
+    def add(self, item):
+        h = hash(item) & (2 ** HASH_BITS - 1)
+        index = h & (len(self.registers) - 1)
+        rank = HASH_BITS - self.precision - (h >> self.precision).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def estimate(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # Small numbers of items are estimated from the empty registers
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        
+        return int(round(estimate))
+
+
+class TopValues(object):
+    """Set-like container that keeps only the max_values most frequent values
+       of a tag key, ranked by their count-min sketch estimates. Once a value
+       has been evicted, the number of distinct values is estimated with a
+       DistinctCounter"""
+    
+    def __init__(self, key, max_values, sketch, value_sets=None):
+        self.key = key
+        self.max_values = max_values
+        self.sketch = sketch
+        self.value_sets = value_sets
+        self.counts = {}
+        self.heap = []
+        self.distinct = None
+    
+    def add(self, value):
+        count = self.sketch.add((self.key, value))
+        if self.distinct is not None:
+            self.distinct.add(value)
+        
+        new_value = value not in self.counts
+        if not new_value or len(self.counts) < self.max_values:
+            self.counts[value] = count
+            heapq.heappush(self.heap, (count, value))
+            if new_value and self.value_sets is not None:
+                self.value_sets.added(self.key, value, count)
+        else:
+            if self.distinct is None:
+                self.count_distinct()
+                self.distinct.add(value)
+            # Discard outdated heap entries until the top is the least frequent value
+            while self.counts.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if count > self.heap[0][0]:
+                _, evicted = heapq.heapreplace(self.heap, (count, value))
+                del self.counts[evicted]
+                self.counts[value] = count
+                if self.value_sets is not None:
+                    self.value_sets.added(self.key, value, count, replaced=True)
+        
+        if len(self.heap) > 4 * self.max_values:
+            self.heap = [(c, v) for v, c in self.counts.items()]
+            heapq.heapify(self.heap)
+    
+    def count_distinct(self):
+        """Starts estimating the number of distinct values, before the first
+           value is evicted or discarded"""
+        
+        if self.distinct is None:
+            self.distinct = DistinctCounter()
+            for value in self.counts:
+                self.distinct.add(value)
+    
+    def discard(self, value):
+        """Removes a stored value, evicted by the value sets (its heap entries
+           become outdated)"""
+        
+        self.count_distinct()
+        del self.counts[value]
+    
+    def distinct_count(self):
+        """Number of distinct values added: exact until a value is evicted, 
+           estimated afterwards"""
+        
+        if self.distinct is None:
+            return len(self.counts)
+        
+        return max(self.distinct.estimate(), len(self.counts))
+    
+    def most_common(self):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+    
+    def __contains__(self, value):
+        return value in self.counts
+    
+    def __iter__(self):
+        return iter(self.counts)
+    
+    def __len__(self):
+        return len(self.counts)
+
+
+class CappedValueSets(dict):
+    """Dictionary creating a TopValues container for each new key, all of 
+       them sharing the same count-min sketch. At most max_total_values values
+       are kept among all the keys: beyond that the least frequent value of 
+       all the keys is evicted, and the keys left without values are removed,
+       so the memory does not depend on the number of keys either"""
+    
+    def __init__(self, max_values, sketch, max_total_values=MAX_TOTAL_VALUES):
+        dict.__init__(self)
+        self.max_values = max_values
+        self.sketch = sketch
+        self.max_total_values = max_total_values
+        self.total_values = 0
+        self.heap = []
+    
+    def __missing__(self, key):
+        values = self[key] = TopValues(key, self.max_values, self.sketch, self)
+        return values
+    
+    def added(self, key, value, count, replaced=False):
+        """Records a new value stored for a key (replacing an evicted value
+           of the key if replaced is True), evicting the least frequent value
+           of all the keys if there are too many values"""
+        
+        heapq.heappush(self.heap, (count, key, value))
+        if len(self.heap) > 4 * self.max_total_values:
+            self.heap = [(c, k, v) for k, values in self.items() 
+                         for v, c in values.counts.items()]
+            heapq.heapify(self.heap)
+        
+        if not replaced:
+            self.total_values += 1
+        if self.total_values <= self.max_total_values:
+            return
+        
+        # The heap entries keep the count of the values when they were stored:
+        # the entries of removed values are discarded, and the outdated counts
+        # are updated, until the top is the least frequent value
+        while True:
+            c, k, v = self.heap[0]
+            values = self.get(k)
+            count = values.counts.get(v) if values is not None else None
+            if count is None:
+                heapq.heappop(self.heap)
+            elif count != c:
+                heapq.heapreplace(self.heap, (count, k, v))
+            else:
+                heapq.heappop(self.heap)
+                break
+        values.discard(v)
+        self.total_values -= 1
+        if not values:
+            del self[k]
+
+
+def new_value_sets(max_values=None, sketch_width=SKETCH_WIDTH, 
+                   sketch_depth=SKETCH_DEPTH, max_total_values=None):
+    """Returns the dictionary used to store the values of each key: a 
+       defaultdict(set), or capped value sets if max_values (values per key)
+       or max_total_values (values among all the keys, MAX_TOTAL_VALUES by
+       default) is given"""
+    
+    if max_values is None and max_total_values is None:
+        return defaultdict(set)
+    
+    max_total_values = max_total_values or MAX_TOTAL_VALUES
+    return CappedValueSets(max_values or max_total_values, 
+                           CountMinSketch(sketch_width, sketch_depth),
+                           max_total_values)
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def get_tags(osm_file, element_type):
+def get_tags(osm_file, element_type, max_values=None, 
+             sketch_width=SKETCH_WIDTH, sketch_depth=SKETCH_DEPTH, backend=None,
+             max_total_values=None):
     """Saves all the different tags associated to a given element type (node, way) 
-    and stores them in a dictionary"""
+    and stores them in a dictionary. If max_values or max_total_values is given, 
+    only the most frequent values of each tag are stored, and the number of 
+    different values is estimated"""
     
-    tag_types = defaultdict(set)
+    tag_types = new_value_sets(max_values, sketch_width, sketch_depth, 
+                               max_total_values)
     
-    with codecs.open(osm_file, "r", encoding="utf-8") as osm:
-        
-        for event, elem in ET.iterparse(osm, events=("start",)):
-            if (elem.tag == element_type):
-                for tag in elem.iter('tag'):
-                    tag_types[tag.attrib["k"]].add(tag.attrib["v"])
+    for elem in iter_records(osm_file, (element_type,), backend):
+        for key, value in elem.tags:
+            tag_types[key].add(value)
     
     tag_numbers = count_elems(tag_types)
     
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+This program provides the rule engine used to correct street and city names.
+
+The rules are loaded from a JSON data file (correction_rules.json by default):
+    - street_mapping: full street names and their corrected value
+    - expected_street_types: street types accepted in the street names
+    - abbreviations: abbreviated street types (e.g. Av., Avda, Avd.) and their
+      expansion, applied at the beginning of the names not in street_mapping
+    - city_rules: ordered list of rules with a "pattern" searched in the city
+      name, an optional "unless" pattern and the "replacement" city name
+
+The rules are compiled once into hashed lookups (dictionary and set) and one
+combined alternation regular expression for the abbreviations and another one
+for the city patterns, so most values are discarded with a single search.
+The results are memoised per distinct input string with a bounded LRU cache,
+since the same street and city names are repeated thousands of times in the
+real extracts.
+
+Python version: 3.6.0
+"""
+
+import os
+import re
+import json
+import codecs
+from functools import lru_cache
+
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'correction_rules.json')
+CACHE_SIZE = 65536
+
+# City rules applied by osm2csv.correct_city_name
+CITY_RULES = [{'pattern': 'O Temple', 'replacement': 'O Temple, Cambre'},
+              {'pattern': 'Coruña', 'unless': 'A Coruña', 'replacement': 'A Coruña'}]
+
+
+def alternation(patterns):
+    """Compiles a list of literal strings into one alternation regular
+       expression, trying the longest strings first"""
+    
+    escaped = [re.escape(p) for p in sorted(patterns, key=len, reverse=True)]
+    return re.compile('|'.join(escaped))
+
+
+class CorrectionRules(object):
+    """Compiled street and city correction rules with memoised results"""
+    
+    def __init__(self, street_mapping, expected_street_types, abbreviations=None,
+                 city_rules=CITY_RULES, cache_size=CACHE_SIZE):
+        self.street_mapping = dict(street_mapping)
+        self.expected_street_types = list(expected_street_types)
+        self.abbreviations = dict(abbreviations or {})
+        self.city_rules = list(city_rules or [])
+        self.cache_size = cache_size
+        self.compile()
+    
+    def compile(self):
+        self.street_types = frozenset(self.expected_street_types)
+        
+        self.abbreviation_re = None
+        if self.abbreviations:
+            # Abbreviation followed by a space, or ending with a dot, and the name
+            self.abbreviation_re = re.compile(r'^({0})(?:\s+|(?<=\.)\s*)(?=\S)'.format(
+                alternation(self.abbreviations).pattern))
+        
+        self.city_re = None
+        self.compiled_city_rules = []
+        if self.city_rules:
+            self.city_re = alternation([rule['pattern'] for rule in self.city_rules])
+            for rule in self.city_rules:
+                unless = rule.get('unless')
+                self.compiled_city_rules.append(
+                    (re.compile(re.escape(rule['pattern'])),
+                     re.compile(re.escape(unless)) if unless else None,
+                     rule['replacement']))
+        
+        self.street_name = lru_cache(maxsize=self.cache_size)(self._street_name)
+        self.city_name = lru_cache(maxsize=self.cache_size)(self._city_name)
+    
+    def _street_name(self, st_name):
+        """Corrected street name: mapped value, or name with the abbreviated
+           street type expanded"""
+        
+        try:
+            return self.street_mapping[st_name]
+        except KeyError:
+            pass
+        
+        if self.abbreviation_re is not None:
+            m = self.abbreviation_re.match(st_name)
+            if m:
+                return self.abbreviations[m.group(1)] + ' ' + st_name[m.end():]
+        
+        return st_name
+    
+    def _city_name(self, city_name):
+        """Corrected city name given by the first city rule that applies"""
+        
+        if self.city_re is None or not self.city_re.search(city_name):
+            return city_name
+        
+        for pattern_re, unless_re, replacement in self.compiled_city_rules:
+            if pattern_re.search(city_name) and not (unless_re and unless_re.search(city_name)):
+                return replacement
+        
+        return city_name
+    
+    def is_street_type(self, word):
+        return word in self.street_types
+    
+    def __getstate__(self):
+        # The memoised functions cannot be pickled, they are rebuilt instead
+        return {'street_mapping': self.street_mapping,
+                'expected_street_types': self.expected_street_types,
+                'abbreviations': self.abbreviations,
+                'city_rules': self.city_rules,
+                'cache_size': self.cache_size}
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+
+def load_rules(rules_file=RULES_FILE, cache_size=CACHE_SIZE):
+    """Loads the correction rules from a JSON data file and compiles them"""
+    
+    with codecs.open(rules_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    
+    return CorrectionRules(data.get('street_mapping', {}),
+                           data.get('expected_street_types', []),
+                           data.get('abbreviations'),
+                           data.get('city_rules', CITY_RULES),
+                           cache_size)
+
+
+def save_rules(rules, rules_file, **extra):
+    """Saves the correction rules to a JSON data file readable by load_rules,
+       with any extra data given (ignored by load_rules)"""
+    
+    data = {'expected_street_types': rules.expected_street_types,
+            'street_mapping': rules.street_mapping,
+            'abbreviations': rules.abbreviations,
+            'city_rules': rules.city_rules}
+    data.update(extra)
+    
+    with codecs.open(rules_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
@@ -4,6 +4,45 @@ The objective of this program is to create a SQL database with a series of
 tables defined by the schemas given by the function create_schemas and populate
 the different tables with the CSV files obtained from the program osm2csv.
 
+The CSV files are read in chunks of a fixed number of rows with explicit data
+types and appended to the tables created from the schemas, so the PRIMARY KEY,
+NOT NULL and FOREIGN KEY definitions are kept and the memory usage does not
+depend on the size of the files. The Parquet files written by osm2parquet can
+be imported too (the .parquet files are read in batches with pyarrow).
+
+Once the data is loaded, the secondary indexes used by the analysis queries
+are built (optionally followed by ANALYZE). The query plans of the analysis 
+queries can be printed with explain_queries (or the --explain command line 
+option) to confirm that the indexes are used.
+
+An R*Tree spatial index over the node coordinates and the way bounding boxes
+can be built as well (spatial_index argument of create_database). It is used
+by query_bbox and query_nearest to find the elements inside an area or the
+nearest ones to a point, with their tags, without scanning the nodes table.
+
+The analysis queries read the tags of the nodes and the ways together, which
+needs a UNION ALL of the tag tables (sometimes twice in the same query). The
+summary tables are built once after the import (create_summary_tables): 
+    - tags: the tags of all the elements in a single table, with their 
+      element type
+    - tag_counts and key_counts: number of tags of each key and value, and
+      number of tags and distinct values of each key, per element type
+    - user_edits: number of nodes, ways and relations of each user
+The queries of the notebook rewritten on these tables are given in 
+SUMMARY_QUERIES. When only a few elements change (osc2sqldb), the summary 
+tables are updated with the differences of their tags and users 
+(SummaryChanges) instead of being rebuilt. The results of repeated queries 
+are cached by QueryCache (or cached_query), keyed by the modification time of
+the database file and the query text, so they are only run again once the
+database is modified.
+
+An interrupted import can be resumed table by table (resume argument of
+create_database, or --resume command line option). The rows are committed in
+chunks and the import_progress table records the source file of each table
+and whether its import is complete. On resume the completed tables are kept,
+the import of a partially loaded table goes on after the rows it already has,
+and the other tables are imported again.
+
 The code is based on the one from this source:
     https://www.sqlitetutorial.net/sqlite-python/create-tables/
 
@@ -14,15 +53,174 @@ project details:
 Python version: 3.6.0
 """
 
+import os
 import re
+import sys
+import math
+import time
 import sqlite3
 import pandas as pd
+from collections import OrderedDict, Counter, defaultdict
+
+import pipeline_stats
+from geometry import GEOMETRY_FIELDS, EARTH_RADIUS, haversine
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+CHUNK_SIZE = 100000
+# Number of query results kept by QueryCache
+QUERY_CACHE_SIZE = 128
+
+# Data types used to read the CSV file of each table
+# (nullable Int64 for the metadata missing in anonymous elements or in PBF
+# extracts without metadata)
+CSV_DTYPES = {
+    'nodes': {'id': 'int64', 'lat': 'float64', 'lon': 'float64', 'user': str,
+              'uid': 'Int64', 'version': 'Int64', 'changeset': 'Int64',
+              'timestamp': str},
+    'nodes_tags': {'id': 'int64', 'key': str, 'value': str, 'type': str},
+    'ways': {'id': 'int64', 'user': str, 'uid': 'Int64', 'version': str,
+             'changeset': 'Int64', 'timestamp': str, 'min_lat': 'float64',
+             'min_lon': 'float64', 'max_lat': 'float64', 'max_lon': 'float64',
+             'centroid_lat': 'float64', 'centroid_lon': 'float64', 
+             'length': 'float64'},
+    'ways_tags': {'id': 'int64', 'key': str, 'value': str, 'type': str},
+    'ways_nodes': {'id': 'int64', 'node_id': 'int64', 'position': 'int64'},
+    'relations': {'id': 'int64', 'user': str, 'uid': 'Int64', 'version': str,
+                  'changeset': 'Int64', 'timestamp': str},
+    'relations_tags': {'id': 'int64', 'key': str, 'value': str, 'type': str},
+    'relations_members': {'id': 'int64', 'member_id': 'int64', 
+                          'member_type': str, 'role': str, 'position': 'int64'}
+}
+
+# Values read as NULL in the CSV files (missing metadata, and geometry of the
+# ways whose nodes are not in the file)
+METADATA_NA_VALUES = {'uid': [''], 'version': [''], 'changeset': ['']}
+CSV_NA_VALUES = {
+    'nodes': METADATA_NA_VALUES,
+    'ways': dict(METADATA_NA_VALUES, **{field: [''] for field in GEOMETRY_FIELDS}),
+    'relations': METADATA_NA_VALUES
+}
+
+# Secondary indexes built after the bulk load, given as (table, columns)
+INDEXES = [('nodes_tags', ('id',)),
+           ('nodes_tags', ('key', 'value')),
+           ('nodes_tags', ('type', 'key')),
+           ('ways_tags', ('id',)),
+           ('ways_tags', ('key', 'value')),
+           ('ways_tags', ('type', 'key')),
+           ('ways_nodes', ('id',)),
+           ('ways_nodes', ('node_id',)),
+           ('relations_tags', ('id',)),
+           ('relations_tags', ('key', 'value')),
+           ('relations_tags', ('type', 'key')),
+           ('relations_members', ('id',)),
+           ('relations_members', ('member_type', 'member_id'))]
+
+# Main table, R*Tree table and tags table of each element type
+SPATIAL_TABLES = {'node': ('nodes', 'nodes_rtree', 'nodes_tags'),
+                  'way': ('ways', 'ways_rtree', 'ways_tags')}
+# Rows of the R*Tree table of each element type
+SPATIAL_ROWS = {'node': """SELECT id, lat, lat, lon, lon FROM nodes
+                           WHERE lat IS NOT NULL AND lon IS NOT NULL""",
+                'way': """SELECT id, min_lat, max_lat, min_lon, max_lon FROM ways
+                          WHERE min_lat IS NOT NULL"""}
+# Maximum number of ids given in the IN list of a query
+MAX_QUERY_IDS = 500
+
+# Analysis queries of the notebook, used to check the query plans
+ANALYSIS_QUERIES = {
+    'unique_users': """SELECT COUNT(DISTINCT(tables.uid)) AS "Number of unique users"
+                       FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) tables;""",
+    'top_shops': """SELECT tags.value, COUNT(*) AS Count 
+                    FROM (SELECT * FROM nodes_tags UNION ALL SELECT * FROM ways_tags) tags
+                    WHERE tags.key == 'shop' GROUP BY tags.value ORDER BY count DESC LIMIT 5;""",
+    'clothes_names': """SELECT nodes_tags.value, COUNT(*) as Count
+                        FROM nodes_tags JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='clothes') i ON nodes_tags.id=i.id
+                        WHERE nodes_tags.key='name' GROUP BY nodes_tags.value ORDER BY Count DESC LIMIT 5;""",
+    'street_amenities': """SELECT tags.value, COUNT(*) AS Count
+                           FROM (SELECT * FROM nodes_tags UNION ALL SELECT * FROM ways_tags) tags 
+                            JOIN (SELECT DISTINCT(id) FROM (SELECT * FROM nodes_tags UNION ALL SELECT * FROM ways_tags) WHERE key='street' AND type='name') i
+                            ON tags.id=i.id WHERE tags.key='amenity' GROUP BY tags.value ORDER BY Count DESC;"""
+}
+
+
+# Schemas of the summary tables, built in this order from the imported tables
+SUMMARY_SCHEMAS = [
+    """CREATE TABLE tags (
+       element_type TEXT NOT NULL,
+       id INTEGER NOT NULL,
+       key TEXT,
+       value TEXT,
+       type TEXT
+       );""",
+    """CREATE TABLE tag_counts (
+       element_type TEXT NOT NULL,
+       key TEXT,
+       type TEXT,
+       value TEXT,
+       count INTEGER NOT NULL
+       );""",
+    """CREATE TABLE key_counts (
+       element_type TEXT NOT NULL,
+       key TEXT,
+       type TEXT,
+       count INTEGER NOT NULL,
+       distinct_values INTEGER NOT NULL
+       );""",
+    """CREATE TABLE user_edits (
+       uid INTEGER PRIMARY KEY,
+       user TEXT,
+       nodes INTEGER NOT NULL,
+       ways INTEGER NOT NULL,
+       relations INTEGER NOT NULL,
+       edits INTEGER NOT NULL
+       );"""]
+
+# Element type, main table and tags table of each element
+ELEMENT_TABLES = [('node', 'nodes', 'nodes_tags'),
+                  ('way', 'ways', 'ways_tags'),
+                  ('relation', 'relations', 'relations_tags')]
+ELEMENT_TABLE_NAMES = {element_type: (table_name, tags_table) 
+                       for element_type, table_name, tags_table in ELEMENT_TABLES}
+
+# Indexes of the summary tables
+SUMMARY_INDEXES = [('tags', ('key', 'value')),
+                   ('tags', ('element_type', 'id')),
+                   ('tags', ('value',)),
+                   ('tags', ('type', 'key')),
+                   ('tag_counts', ('key', 'value'))]
+
+# Analysis queries of the notebook rewritten on the summary tables, giving
+# the same results
+SUMMARY_QUERIES = {
+    'unique_users': """SELECT COUNT(*) AS "Number of unique users"
+                       FROM user_edits WHERE nodes + ways > 0;""",
+    'top_shops': """SELECT value, SUM(count) AS Count FROM tag_counts
+                    WHERE key = 'shop' AND element_type IN ('node', 'way')
+                    GROUP BY value ORDER BY Count DESC LIMIT 5;""",
+    'clothes_names': """SELECT tags.value, COUNT(*) AS Count
+                        FROM tags JOIN (SELECT DISTINCT(id) FROM tags WHERE value='clothes' AND element_type='node') i
+                         ON tags.id=i.id
+                        WHERE tags.element_type='node' AND tags.key='name' 
+                        GROUP BY tags.value ORDER BY Count DESC LIMIT 5;""",
+    'street_amenities': """SELECT tags.value, COUNT(*) AS Count
+                           FROM tags JOIN (SELECT DISTINCT(id) FROM tags WHERE key='street' AND type='name' AND element_type IN ('node', 'way')) i
+                            ON tags.id=i.id
+                           WHERE tags.key='amenity' AND tags.element_type IN ('node', 'way')
+                           GROUP BY tags.value ORDER BY Count DESC;"""
+}
 
 
 def create_schemas(nodes_path, node_tags_path, ways_path, way_nodes_path, 
-                   way_tags_path):
+                   way_tags_path, relations_path=None, 
+                   relation_members_path=None, relation_tags_path=None):
     """Define the required schemas for the creation of the different tables
-       in the SQL database and store them in a dictionary"""
+       in the SQL database and store them in a dictionary. The schemas of the
+       relation tables are included if relations_path is given"""
     
     schemas = {}
     schemas[nodes_path] = """CREATE TABLE nodes (
@@ -48,7 +246,14 @@ def create_schemas(nodes_path, node_tags_path, ways_path, way_nodes_path,
                             uid INTEGER,
                             version TEXT,
                             changeset INTEGER,
-                            timestamp TEXT
+                            timestamp TEXT,
+                            min_lat REAL,
+                            min_lon REAL,
+                            max_lat REAL,
+                            max_lon REAL,
+                            centroid_lat REAL,
+                            centroid_lon REAL,
+                            length REAL
                             );"""
     schemas[way_tags_path] = """CREATE TABLE ways_tags (
                                  id INTEGER NOT NULL,
@@ -64,6 +269,30 @@ def create_schemas(nodes_path, node_tags_path, ways_path, way_nodes_path,
                                 FOREIGN KEY (id) REFERENCES ways(id),
                                 FOREIGN KEY (node_id) REFERENCES nodes(id)
                                 );"""
+    if relations_path:
+        schemas[relations_path] = """CREATE TABLE relations (
+                                     id INTEGER PRIMARY KEY NOT NULL,
+                                     user TEXT,
+                                     uid INTEGER,
+                                     version TEXT,
+                                     changeset INTEGER,
+                                     timestamp TEXT
+                                     );"""
+        schemas[relation_tags_path] = """CREATE TABLE relations_tags (
+                                         id INTEGER NOT NULL,
+                                         key TEXT NOT NULL,
+                                         value TEXT NOT NULL,
+                                         type TEXT,
+                                         FOREIGN KEY (id) REFERENCES relations(id)
+                                         );"""
+        schemas[relation_members_path] = """CREATE TABLE relations_members (
+                                            id INTEGER NOT NULL,
+                                            member_id INTEGER NOT NULL,
+                                            member_type TEXT NOT NULL,
+                                            role TEXT,
+                                            position INTEGER NOT NULL,
+                                            FOREIGN KEY (id) REFERENCES relations(id)
+                                            );"""
     
     return schemas
 
@@ -84,12 +313,21 @@ def create_connection(db_file):
     return conn
 
 
+def has_table(conn, table_name):
+    """Returns True if the database has the given table"""
+    
+    return conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                        "AND name = ?", (table_name,)).fetchone() is not None
+
+
 def create_table(conn, sql_schema):
-    """Creates a new table in the SQL file with a given schema"""
+    """Creates a new table in the SQL file with a given schema, replacing the
+       table if it already exists"""
     
     table_name = re.search("CREATE TABLE (\w+)", sql_schema).group(1)    
     try:
         c = conn.cursor()
+        c.execute("DROP TABLE IF EXISTS {0}".format(table_name))
         c.execute(sql_schema)
         conn.commit()
     except sqlite3.Error as e:
@@ -98,36 +336,627 @@ def create_table(conn, sql_schema):
     return table_name
 
 
-def import_csv(conn, csv_file, table_name):
-    """Imports a CSV file into the corresponding SQL table"""
+def import_csv(conn, csv_file, table_name, chunk_size=CHUNK_SIZE, skip_rows=0):
+    """Imports a CSV file into the corresponding SQL table, appending the rows
+       in chunks so that the table schema is preserved, and reports the 
+       import speed. The first skip_rows rows (already imported) are skipped.
+       Returns the number of rows imported"""
+    
+    start = time.time()
+    rows = 0
+    
+    chunks = pd.read_csv(csv_file, dtype=CSV_DTYPES.get(table_name), 
+                         keep_default_na=False, 
+                         na_values=CSV_NA_VALUES.get(table_name), 
+                         chunksize=chunk_size)
+    for df in chunks:
+        if skip_rows:
+            if skip_rows >= len(df):
+                skip_rows -= len(df)
+                continue
+            df = df.iloc[skip_rows:]
+            skip_rows = 0
+        # Each chunk is committed by to_sql
+        df.to_sql(table_name, conn, if_exists='append', index=False)
+        rows += len(df)
+    
+    conn.commit()
+    
+    report_speed(table_name, rows, time.time() - start)
+    
+    return rows
+
+
+def import_parquet(conn, parquet_file, table_name, chunk_size=CHUNK_SIZE, 
+                   skip_rows=0):
+    """Imports a Parquet file into the corresponding SQL table, appending the
+       rows in batches, and reports the import speed. The first skip_rows rows
+       (already imported) are skipped. Returns the number of rows imported"""
+    
+    if pq is None:
+        raise ImportError('pyarrow is required to import Parquet files')
+    
+    start = time.time()
+    rows = 0
+    
+    for batch in pq.ParquetFile(parquet_file).iter_batches(batch_size=chunk_size):
+        if skip_rows:
+            if skip_rows >= batch.num_rows:
+                skip_rows -= batch.num_rows
+                continue
+            batch = batch.slice(skip_rows)
+            skip_rows = 0
+        df = batch.to_pandas()
+        df.to_sql(table_name, conn, if_exists='append', index=False)
+        rows += len(df)
+    
+    conn.commit()
+    
+    report_speed(table_name, rows, time.time() - start)
+    
+    return rows
+
+
+def read_import_progress(conn):
+    """Returns the (source file, complete) import progress of each table,
+       recorded in the import_progress table"""
+    
+    if not conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                        "AND name = 'import_progress'").fetchone():
+        return {}
+    
+    return {table_name: (source, bool(complete)) for table_name, source, complete 
+            in conn.execute("SELECT table_name, source, complete FROM import_progress")}
+
+
+def set_import_progress(conn, table_name, source, complete):
+    """Records the source file of a table and whether its import is complete"""
+    
+    conn.execute("INSERT OR REPLACE INTO import_progress VALUES (?, ?, ?)", 
+                 (table_name, os.path.abspath(source), int(complete)))
+    conn.commit()
+
+
+def import_table(conn, source, sql_schema, progress):
+    """Imports a CSV or Parquet file into its table, given by the schema. The
+       table is skipped if its import from the same file is complete, and the
+       import goes on after the rows already loaded if it was interrupted (as
+       given by the progress of read_import_progress, empty to import all the
+       tables again). Returns the table name and the number of rows imported"""
+    
+    table_name = re.search("CREATE TABLE (\w+)", sql_schema).group(1)
+    source_progress = progress.get(table_name)
+    
+    skip_rows = 0
+    if source_progress is not None and source_progress[0] == os.path.abspath(source):
+        if source_progress[1]:
+            print("{0}: already imported".format(table_name))
+            return table_name, 0
+        skip_rows = conn.execute("SELECT COUNT(*) FROM {0}".format(table_name)).fetchone()[0]
+    else:
+        create_table(conn, sql_schema)
+    set_import_progress(conn, table_name, source, False)
+    
+    if source.endswith('.parquet'):
+        rows = import_parquet(conn, source, table_name, skip_rows=skip_rows)
+    else:
+        rows = import_csv(conn, source, table_name, skip_rows=skip_rows)
+    set_import_progress(conn, table_name, source, True)
+    
+    return table_name, rows
+
+
+def report_speed(table_name, rows, elapsed):
+    """Prints the number of rows imported into a table and the import speed"""
+    
+    print("{0}: {1} rows in {2:.2f} s ({3:.0f} rows/s)".format(
+        table_name, rows, elapsed, rows / elapsed if elapsed > 0 else 0))
+
+
+def create_indexes(conn, indexes=INDEXES, analyze=True):
+    """Creates the secondary indexes given as (table, columns) and gathers
+       the statistics used by the query planner if required. The indexes of
+       the tables which do not exist (e.g. relations) are skipped"""
+    
+    tables = set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    for table_name, columns in indexes:
+        if table_name not in tables:
+            continue
+        index_name = 'idx_{0}_{1}'.format(table_name, '_'.join(columns))
+        start = time.time()
+        conn.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(
+            index_name, table_name, ', '.join(columns)))
+        print("{0}: built in {1:.2f} s".format(index_name, time.time() - start))
+    
+    if analyze:
+        conn.execute("ANALYZE")
+    
+    conn.commit()
+
+
+def explain_queries(conn, queries=ANALYSIS_QUERIES):
+    """Prints the query plan given by EXPLAIN QUERY PLAN for each query"""
+    
+    for name, query in queries.items():
+        print(name)
+        for row in conn.execute("EXPLAIN QUERY PLAN " + query):
+            print('   ', row[-1])
+
+
+# ================================================== #
+#               Spatial Index                        #
+# ================================================== #
+def create_spatial_index(conn):
+    """Creates the R*Tree virtual tables indexing the coordinates of the 
+       nodes and the bounding boxes of the ways (only if the ways have their
+       geometry, see osm2csv.process_map)"""
+    
+    rtree_schema = "CREATE VIRTUAL TABLE {0} USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+    
+    start = time.time()
+    conn.execute("DROP TABLE IF EXISTS nodes_rtree")
+    conn.execute(rtree_schema.format('nodes_rtree'))
+    conn.execute("INSERT INTO nodes_rtree " + SPATIAL_ROWS['node'])
+    print("nodes_rtree: built in {0:.2f} s".format(time.time() - start))
+    
+    conn.execute("DROP TABLE IF EXISTS ways_rtree")
+    if 'min_lat' in [row[1] for row in conn.execute("PRAGMA table_info(ways)")]:
+        start = time.time()
+        conn.execute(rtree_schema.format('ways_rtree'))
+        conn.execute("INSERT INTO ways_rtree " + SPATIAL_ROWS['way'])
+        print("ways_rtree: built in {0:.2f} s".format(time.time() - start))
+    
+    conn.commit()
+
+
+def fetch_tags(conn, tags_table, elements):
+    """Adds the list of (key, value, type) tags of each element, read from
+       the given tags table"""
+    
+    by_id = {}
+    for element in elements:
+        element['tags'] = []
+        by_id[element['id']] = element
     
-    df = pd.read_csv(csv_file)
-    df.to_sql(table_name, conn, if_exists='replace', index=False)
+    ids = list(by_id)
+    for i in range(0, len(ids), MAX_QUERY_IDS):
+        chunk = ids[i:i + MAX_QUERY_IDS]
+        query = "SELECT id, key, value, type FROM {0} WHERE id IN ({1})".format(
+            tags_table, ', '.join('?' * len(chunk)))
+        for element_id, key, value, tag_type in conn.execute(query, chunk):
+            by_id[element_id]['tags'].append((key, value, tag_type))
     
+    return elements
+
+
+def query_bbox(conn, min_lat, min_lon, max_lat, max_lon, element_type='node',
+               key=None, value=None, tags=True):
+    """Returns the nodes inside the bounding box, or the ways whose bounding
+       box intersects it, using the R*Tree spatial index. Only the elements 
+       with the given tag key (and value) are returned if key is given. Each
+       element is given as a dictionary with its id, its coordinates (nodes)
+       or its geometry (ways) and the list of its tags"""
+    
+    table_name, rtree_name, tags_table = SPATIAL_TABLES[element_type]
+    if element_type == 'node':
+        columns = 't.id, t.lat, t.lon'
+        # The R*Tree stores 32-bit floats, the exact coordinates are checked
+        exact = 't.lat BETWEEN :min_lat AND :max_lat AND t.lon BETWEEN :min_lon AND :max_lon'
+    else:
+        columns = 't.id, ' + ', '.join('t.' + field for field in GEOMETRY_FIELDS)
+        exact = ('t.max_lat >= :min_lat AND t.min_lat <= :max_lat AND '
+                 't.max_lon >= :min_lon AND t.min_lon <= :max_lon')
+    
+    query = """SELECT {0} FROM {1} r JOIN {2} t ON t.id = r.id
+               WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat
+               AND r.max_lon >= :min_lon AND r.min_lon <= :max_lon
+               AND {3}""".format(columns, rtree_name, table_name, exact)
+    if key is not None:
+        query += """ AND EXISTS (SELECT 1 FROM {0} g WHERE g.id = r.id AND g.key = :key
+                                 AND (:value IS NULL OR g.value = :value))""".format(tags_table)
+    
+    params = {'min_lat': min_lat, 'min_lon': min_lon, 'max_lat': max_lat, 
+              'max_lon': max_lon, 'key': key, 'value': value}
+    cursor = conn.execute(query, params)
+    fields = [d[0] for d in cursor.description]
+    elements = [dict(zip(fields, row)) for row in cursor]
+    
+    if tags:
+        fetch_tags(conn, tags_table, elements)
+    
+    return elements
+
+
+def query_nearest(conn, lat, lon, n=10, element_type='node', key=None, 
+                  value=None, radius=500.0):
+    """Returns the n nodes (or ways, by their centroid) nearest to a point,
+       sorted by their distance in meters (given in the 'distance' field).
+       The elements are searched with bounding box queries around the point,
+       starting with the given radius in meters and doubling it until the n
+       nearest elements are known"""
+    
+    lat_field, lon_field = ('lat', 'lon') if element_type == 'node' else \
+                           ('centroid_lat', 'centroid_lon')
+    to_radians = math.pi / 180
+    
+    while True:
+        lat_delta = radius / EARTH_RADIUS / to_radians
+        lon_delta = lat_delta / max(math.cos(min(abs(lat) + lat_delta, 89.9) * to_radians), 1e-6)
+        elements = query_bbox(conn, lat - lat_delta, lon - lon_delta, 
+                              lat + lat_delta, lon + lon_delta, element_type,
+                              key, value, tags=False)
+        
+        for element in elements:
+            element['distance'] = haversine(lat * to_radians, lon * to_radians,
+                                            element[lat_field] * to_radians,
+                                            element[lon_field] * to_radians)
+        
+        # Only the elements within the radius are sure to be the nearest ones
+        nearest = sorted((e for e in elements if e['distance'] <= radius),
+                         key=lambda e: e['distance'])
+        if len(nearest) >= n or lat_delta >= 180:
+            break
+        radius *= 2
+    
+    _, _, tags_table = SPATIAL_TABLES[element_type]
+    
+    return fetch_tags(conn, tags_table, nearest[:n])
+
+
+# ================================================== #
+#               Summary Tables                       #
+# ================================================== #
+def create_summary_tables(conn, indexes=SUMMARY_INDEXES):
+    """Creates the tags, tag_counts, key_counts and user_edits tables from
+       the imported tables (replacing them if they already exist), and their
+       indexes. The relations are included if their tables exist"""
+    
+    tables = set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    
+    start = time.time()
+    for sql_schema in SUMMARY_SCHEMAS:
+        create_table(conn, sql_schema)
+    
+    element_edits = []
+    for element_type, table_name, tags_table in ELEMENT_TABLES:
+        if table_name not in tables:
+            element_edits.append('0')
+            continue
+        conn.execute("""INSERT INTO tags (element_type, id, key, value, type)
+                        SELECT ?, id, key, value, type FROM {0}""".format(tags_table), 
+                     (element_type,))
+        element_edits.append("element_type = '{0}'".format(element_type))
+    
+    conn.execute("""INSERT INTO tag_counts 
+                    SELECT element_type, key, type, value, COUNT(*) FROM tags
+                    GROUP BY element_type, key, type, value""")
+    conn.execute("""INSERT INTO key_counts
+                    SELECT element_type, key, type, SUM(count), COUNT(*) FROM tag_counts
+                    GROUP BY element_type, key, type""")
+    
+    edits = ' UNION ALL '.join(
+        "SELECT '{0}' AS element_type, uid, user FROM {1}".format(element_type, table_name)
+        for element_type, table_name, _ in ELEMENT_TABLES if table_name in tables)
+    conn.execute("""INSERT INTO user_edits
+                    SELECT uid, MAX(user), SUM({0}), SUM({1}), SUM({2}), COUNT(*)
+                    FROM ({3}) WHERE uid IS NOT NULL GROUP BY uid""".format(*(element_edits + [edits])))
     conn.commit()
+    print("summary tables: built in {0:.2f} s".format(time.time() - start))
+    
+    if indexes:
+        create_indexes(conn, indexes, analyze=False)
+
+
+def has_summary_tables(conn):
+    """Returns True if the database has the summary tables"""
+    
+    return conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                        "AND name = 'tag_counts'").fetchone() is not None
+
+
+class SummaryChanges(object):
+    """Changes of the summary tables due to the elements removed from the
+       database (deleted or replaced) and the elements added to it. The 
+       removed elements are read before they are deleted, and apply updates
+       the rows of the summary tables affected by the changes, in the current
+       transaction, giving the same tables as create_summary_tables"""
+    
+    def __init__(self):
+        self.removed = defaultdict(set)
+        self.added = OrderedDict()
+        # Changes of the number of tags of each (element type, key, type, 
+        # value), and of the number of elements of each (uid, element type)
+        self.tag_deltas = Counter()
+        self.edit_deltas = Counter()
+        # User names of the removed and added elements of each uid
+        self.removed_users = defaultdict(set)
+        self.added_users = defaultdict(set)
+    
+    def remove_element(self, conn, element_type, element_id):
+        """Records the removal of an element still in the database"""
+        
+        table_name, tags_table = ELEMENT_TABLE_NAMES[element_type]
+        for key, value, tag_type in conn.execute(
+                'SELECT key, value, type FROM {0} WHERE id = ?'.format(tags_table), 
+                (element_id,)):
+            self.tag_deltas[(element_type, key, tag_type, value)] -= 1
+        
+        row = conn.execute('SELECT uid, user FROM {0} WHERE id = ?'.format(table_name),
+                           (element_id,)).fetchone()
+        if row is not None and row[0] not in (None, ''):
+            self.edit_deltas[(row[0], element_type)] -= 1
+            self.removed_users[row[0]].add(row[1])
+        
+        self.removed[element_type].add(element_id)
+        # An element added earlier in the same changes is replaced
+        self.added.pop((element_type, element_id), None)
+    
+    def add_element(self, element_type, element_id, uid, user, tags):
+        """Records the addition of an element, given its uid and user and
+           its (key, value, type) tags"""
+        
+        tags = [(key, value, tag_type) for key, value, tag_type in tags]
+        for key, value, tag_type in tags:
+            self.tag_deltas[(element_type, key, tag_type, value)] += 1
+        
+        if uid not in (None, ''):
+            uid = int(uid)
+            self.edit_deltas[(uid, element_type)] += 1
+            self.added_users[uid].add(user)
+        
+        self.added[(element_type, element_id)] = tags
+    
+    def apply(self, conn):
+        """Updates the summary tables, without committing"""
+        
+        for element_type, element_ids in self.removed.items():
+            element_ids = sorted(element_ids)
+            for i in range(0, len(element_ids), MAX_QUERY_IDS):
+                chunk = element_ids[i:i + MAX_QUERY_IDS]
+                conn.execute('DELETE FROM tags WHERE element_type = ? AND id IN ({0})'.format(
+                    ', '.join('?' * len(chunk))), [element_type] + chunk)
+        conn.executemany('INSERT INTO tags (element_type, id, key, value, type) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         [(element_type, element_id, key, value, tag_type)
+                          for (element_type, element_id), tags in self.added.items()
+                          for key, value, tag_type in tags])
+        
+        key_deltas = Counter()
+        value_deltas = Counter()
+        for (element_type, key, tag_type, value), delta in self.tag_deltas.items():
+            if not delta:
+                continue
+            key_deltas[(element_type, key, tag_type)] += delta
+            where = 'element_type = ? AND key IS ? AND type IS ? AND value IS ?'
+            params = (element_type, key, tag_type, value)
+            row = conn.execute('SELECT count FROM tag_counts WHERE ' + where, 
+                               params).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO tag_counts VALUES (?, ?, ?, ?, ?)', 
+                             params + (delta,))
+                value_deltas[(element_type, key, tag_type)] += 1
+            elif row[0] + delta > 0:
+                conn.execute('UPDATE tag_counts SET count = ? WHERE ' + where, 
+                             (row[0] + delta,) + params)
+            else:
+                conn.execute('DELETE FROM tag_counts WHERE ' + where, params)
+                value_deltas[(element_type, key, tag_type)] -= 1
+        
+        for params in set(key_deltas) | set(value_deltas):
+            where = 'element_type = ? AND key IS ? AND type IS ?'
+            row = conn.execute('SELECT count, distinct_values FROM key_counts WHERE ' + 
+                               where, params).fetchone()
+            count, distinct_values = row if row is not None else (0, 0)
+            count += key_deltas[params]
+            distinct_values += value_deltas[params]
+            if row is not None:
+                conn.execute('DELETE FROM key_counts WHERE ' + where, params)
+            if count > 0:
+                conn.execute('INSERT INTO key_counts VALUES (?, ?, ?, ?, ?)', 
+                             params + (count, distinct_values))
+        
+        for uid in set(uid for uid, _ in self.edit_deltas):
+            row = conn.execute('SELECT user, nodes, ways, relations FROM user_edits '
+                               'WHERE uid = ?', (uid,)).fetchone()
+            user, *edits = row if row is not None else (None, 0, 0, 0)
+            edits = [edits[i] + self.edit_deltas[(uid, element_type)]
+                     for i, (element_type, _, _) in enumerate(ELEMENT_TABLES)]
+            conn.execute('DELETE FROM user_edits WHERE uid = ?', (uid,))
+            if sum(edits) > 0:
+                conn.execute('INSERT INTO user_edits VALUES (?, ?, ?, ?, ?, ?)',
+                             [uid, self.user_name(conn, uid, user)] + edits + [sum(edits)])
+    
+    def user_name(self, conn, uid, user):
+        """Name of a user once the changes are applied: the greatest name of
+           its elements, as in create_summary_tables"""
+        
+        names = set(name for name in self.added_users[uid] if name is not None)
+        if user is not None and user not in names and user in self.removed_users[uid]:
+            tables = [table_name for _, table_name, _ in ELEMENT_TABLES 
+                      if has_table(conn, table_name)]
+            user_rows = ' UNION ALL '.join(
+                'SELECT user FROM {0} WHERE uid = ?'.format(table_name) 
+                for table_name in tables)
+            # The name may no longer be used by the elements of the user
+            if conn.execute('SELECT 1 FROM ({0}) WHERE user = ? LIMIT 1'.format(user_rows),
+                            [uid] * len(tables) + [user]).fetchone() is None:
+                return conn.execute('SELECT MAX(user) FROM ({0})'.format(user_rows),
+                                    [uid] * len(tables)).fetchone()[0]
+        if user is not None:
+            names.add(user)
+        
+        return max(names) if names else None
+
+
+# ================================================== #
+#               Cached Queries                       #
+# ================================================== #
+class QueryCache(object):
+    """Results of the queries run on a SQL database file, given as pandas 
+       DataFrames (as pd.read_sql_query) and kept while the file is not 
+       modified. Up to max_entries results are kept, the least recently used
+       ones are dropped first"""
+    
+    def __init__(self, db_path, max_entries=QUERY_CACHE_SIZE):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.file_version = None
+        self.conn = None
+        self.hits = 0
+        self.misses = 0
+    
+    def get_file_version(self):
+        """Modification time and size of the database file (and of its 
+           write-ahead log, if any)"""
+        
+        version = []
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                version.append(None)
+            else:
+                version.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(version)
+    
+    def query(self, query, params=None):
+        """Returns the result of the query, run only if it is not cached for
+           the current version of the database file"""
+        
+        file_version = self.get_file_version()
+        if file_version != self.file_version:
+            # The results of the previous versions of the file are never used again
+            self.results.clear()
+            self.file_version = file_version
+        
+        if isinstance(params, dict):
+            key = (file_version, query, tuple(sorted(params.items())))
+        else:
+            key = (file_version, query, tuple(params) if params is not None else None)
+        
+        try:
+            result = self.results[key]
+        except KeyError:
+            self.misses += 1
+            if self.conn is None:
+                self.conn = create_connection(self.db_path)
+            result = pd.read_sql_query(query, self.conn, params=params)
+            self.results[key] = result
+            if len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        
+        # A copy is returned so that the cached result cannot be modified
+        return result.copy()
+    
+    def clear(self):
+        self.results.clear()
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# Query caches of each database file, used by cached_query
+QUERY_CACHES = {}
+
+
+def cached_query(db_path, query, params=None):
+    """Returns the result of a query on a SQL database file as a pandas
+       DataFrame, cached until the database file is modified"""
+    
+    db_path = os.path.abspath(db_path)
+    try:
+        cache = QUERY_CACHES[db_path]
+    except KeyError:
+        cache = QUERY_CACHES[db_path] = QueryCache(db_path)
+    
+    return cache.query(query, params)
+
+
+def clear_cached_queries(db_path):
+    """Drops the cached results of the queries on a SQL database file, once
+       it is modified"""
+    
+    cache = QUERY_CACHES.get(os.path.abspath(db_path))
+    if cache is not None:
+        cache.clear()
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
 def create_database(db_path, nodes_path, node_tags_path, ways_path, 
-                    way_nodes_path, way_tags_path):
-    """Creates a SQL database with the defined schemas and imports the data
-       from CSV files"""
+                    way_nodes_path, way_tags_path, indexes=INDEXES, 
+                    analyze=True, relations_path=None, 
+                    relation_members_path=None, relation_tags_path=None,
+                    spatial_index=False, stats=False, summary_tables=True,
+                    resume=False):
+    """Creates a SQL database with the defined schemas, imports the data
+       from CSV files and builds the summary tables (unless summary_tables 
+       is False) and the secondary indexes, and the R*Tree spatial index if
+       required. The relation tables are created if relations_path is given.
+       
+       stats can be True (print the time of each stage at the end) or a 
+       pipeline_stats.PipelineStats, filled with the time of the import, 
+       summary tables, index and spatial index stages and the rows imported
+       in each table.
+       
+       If resume is True, the import of an interrupted run goes on: the 
+       tables completely imported from the same files are kept and a 
+       partially imported table is completed (see import_table). The summary
+       tables and the indexes are built again"""
+    
+    run_stats = pipeline_stats.get_stats(stats)
     
     sql_table_schemas = create_schemas(nodes_path, node_tags_path, ways_path, 
-                                       way_nodes_path, way_tags_path)
+                                       way_nodes_path, way_tags_path, 
+                                       relations_path, relation_members_path,
+                                       relation_tags_path)
     
     # Create a database connection
     conn = create_connection(db_path)
 
+    # Import progress of the tables, recorded to resume an interrupted run
+    progress = read_import_progress(conn) if resume else {}
+    if not resume:
+        conn.execute("DROP TABLE IF EXISTS import_progress")
+    conn.execute("""CREATE TABLE IF NOT EXISTS import_progress (
+                    table_name TEXT PRIMARY KEY, 
+                    source TEXT, 
+                    complete INTEGER NOT NULL)""")
+    
     # Create tables in SQL DB and import .csv files
-    table_names = {}
     for csv_file, sql_schema in sql_table_schemas.items():
-        table_names[csv_file] = create_table(conn, sql_schema)
-        import_csv(conn, csv_file, table_names[csv_file])
+        with pipeline_stats.stage_timer(run_stats, 'import'):
+            table_name, rows = import_table(conn, csv_file, sql_schema, progress)
+        if run_stats is not None:
+            run_stats.counters['rows:' + table_name] += rows
+            run_stats.sample_memory()
+    
+    # Build the summary tables and the indexes once the data is loaded
+    if summary_tables:
+        with pipeline_stats.stage_timer(run_stats, 'summary_tables'):
+            create_summary_tables(conn)
+    if indexes:
+        with pipeline_stats.stage_timer(run_stats, 'indexes'):
+            create_indexes(conn, indexes, analyze)
+    if spatial_index:
+        with pipeline_stats.stage_timer(run_stats, 'spatial_index'):
+            create_spatial_index(conn)
     
     conn.close()
+    
+    if run_stats is not None:
+        run_stats.finish()
+        if stats is True:
+            print(run_stats.summary())
 
 
 if __name__ == '__main__':
@@ -140,6 +969,20 @@ if __name__ == '__main__':
     WAYS_PATH = 'ways.csv'
     WAY_NODES_PATH = 'ways_nodes.csv'
     WAY_TAGS_PATH = 'ways_tags.csv'
+    RELATIONS_PATH = 'relations.csv'
+    RELATION_MEMBERS_PATH = 'relations_members.csv'
+    RELATION_TAGS_PATH = 'relations_tags.csv'
     
-    create_database(SQL_DB_PATH, NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, 
-                    WAY_NODES_PATH, WAY_TAGS_PATH)
+    if '--explain' in sys.argv:
+        conn = create_connection(SQL_DB_PATH)
+        explain_queries(conn)
+        if has_summary_tables(conn):
+            explain_queries(conn, SUMMARY_QUERIES)
+        conn.close()
+    else:
+        create_database(SQL_DB_PATH, NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, 
+                        WAY_NODES_PATH, WAY_TAGS_PATH, 
+                        relations_path=RELATIONS_PATH,
+                        relation_members_path=RELATION_MEMBERS_PATH,
+                        relation_tags_path=RELATION_TAGS_PATH, 
+                        spatial_index=True, resume='--resume' in sys.argv)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+This program provides the node coordinate indexes and the way geometry used
+by the conversion programs to add the bounding box, the centroid and the
+length of each way to the ways table, resolving the node references of the
+ways in the same pass that reads the nodes.
+
+The coordinates are stored as fixed point 32-bit integers (1e-7 degrees, the
+precision of the OSM coordinates), never as Python objects:
+    - NodeIndex: two arrays in memory with the sorted node ids and their
+      coordinates (16 bytes per node), looked up by binary search. The node
+      ids of the OSM files are sorted, so the nodes are simply appended.
+    - DiskNodeIndex: memory-mapped file holding the coordinates at the offset
+      given by the node id (8 bytes per id). The file is sparse, so only the
+      pages of the ids in use take disk space, and the pages are cached by
+      the operating system instead of the Python process. It can be shared
+      among several processes, e.g. the workers of osm2csv.process_map.
+
+The way centroid is the mean of its vertices (the closing node of a closed
+way is counted once) and the length is the sum of the great circle distances
+between consecutive nodes, in meters. The nodes which are not found in the
+index (e.g. outside of the extract) are ignored.
+
+Python version: 3.6.0
+"""
+
+import os
+import mmap
+import math
+import struct
+from array import array
+from bisect import bisect_left
+
+COORD_SCALE = 10 ** 7
+EARTH_RADIUS = 6371008.8
+GROW_SIZE = 1 << 26
+
+# Columns added to the ways table
+GEOMETRY_FIELDS = ['min_lat', 'min_lon', 'max_lat', 'max_lon',
+                   'centroid_lat', 'centroid_lon', 'length']
+
+
+def to_fixed(coord):
+    """Converts a coordinate in degrees (number or string) to fixed point"""
+    
+    return int(round(float(coord) * COORD_SCALE))
+
+
+# ================================================== #
+#               Node Coordinate Indexes              #
+# ================================================== #
+class NodeIndex(object):
+    """In-memory node id -> (lat, lon) index backed by arrays of fixed width
+       integers, 16 bytes per node"""
+    
+    writable = True
+    
+    def __init__(self):
+        self.ids = array('q')
+        self.coords = array('i')
+        self.sorted = True
+    
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if self.ids and node_id <= self.ids[-1]:
+            self.sorted = False
+        self.ids.append(node_id)
+        self.coords.append(to_fixed(lat))
+        self.coords.append(to_fixed(lon))
+    
+    def sort(self):
+        """Sorts the index by node id, only needed if the nodes were not
+           added in increasing id order"""
+        
+        order = sorted(range(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('q', (self.ids[i] for i in order))
+        coords = self.coords
+        self.coords = array('i')
+        for i in order:
+            self.coords.append(coords[2 * i])
+            self.coords.append(coords[2 * i + 1])
+        self.sorted = True
+    
+    def get_fixed(self, node_id):
+        """Returns the fixed point (lat, lon) of a node, or None"""
+        
+        if not self.sorted:
+            self.sort()
+        
+        i = bisect_left(self.ids, node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return self.coords[2 * i], self.coords[2 * i + 1]
+        
+        return None
+    
+    def get(self, node_id):
+        """Returns the (lat, lon) of a node in degrees, or None"""
+        
+        coords = self.get_fixed(int(node_id))
+        if coords is None:
+            return None
+        
+        return coords[0] / COORD_SCALE, coords[1] / COORD_SCALE
+    
+    def close(self):
+        pass
+
+
+class DiskNodeIndex(object):
+    """Memory-mapped node id -> (lat, lon) index stored in a sparse file of
+       fixed width records, 8 bytes per node id. The coordinates are shifted
+       to positive values so that the zeros of the unused records mean that
+       the node is missing. A writable index starts empty (an existing file
+       is truncated), a read-only one opens the file written by another"""
+    
+    RECORD = struct.Struct('<II')
+    LAT_SHIFT = 90 * COORD_SCALE + 1
+    LON_SHIFT = 180 * COORD_SCALE + 1
+    
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.writable = not readonly
+        self.file = open(path, 'rb' if readonly else 'w+b')
+        self.map = None
+        self.size = 0
+        self.remap()
+    
+    def remap(self, size=None):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        
+        if size is not None and size > os.path.getsize(self.path):
+            self.file.truncate(size)
+        
+        self.size = os.path.getsize(self.path)
+        if self.size:
+            access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=access)
+    
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if node_id < 0:
+            raise ValueError('negative node id {0} cannot be stored in '
+                             'a DiskNodeIndex'.format(node_id))
+        
+        offset = node_id * self.RECORD.size
+        if offset + self.RECORD.size > self.size:
+            self.remap(GROW_SIZE * (offset // GROW_SIZE + 1))
+        self.RECORD.pack_into(self.map, offset, to_fixed(lat) + self.LAT_SHIFT,
+                              to_fixed(lon) + self.LON_SHIFT)
+    
+    def get_fixed(self, node_id):
+        """Returns the fixed point (lat, lon) of a node, or None"""
+        
+        offset = node_id * self.RECORD.size
+        if node_id < 0 or offset + self.RECORD.size > self.size:
+            return None
+        
+        lat, lon = self.RECORD.unpack_from(self.map, offset)
+        if not lat:
+            return None
+        
+        return lat - self.LAT_SHIFT, lon - self.LON_SHIFT
+    
+    def get(self, node_id):
+        """Returns the (lat, lon) of a node in degrees, or None"""
+        
+        coords = self.get_fixed(int(node_id))
+        if coords is None:
+            return None
+        
+        return coords[0] / COORD_SCALE, coords[1] / COORD_SCALE
+    
+    def flush(self):
+        """Writes the added nodes to the file, to be read by other processes"""
+        
+        if self.map is not None and self.writable:
+            self.map.flush()
+    
+    def close(self):
+        if self.map is not None:
+            self.flush()
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+def get_node_index(geometry):
+    """Returns the node index to use for the geometry argument of the
+       conversion programs: None if False, a new in-memory index if True, or
+       the given index"""
+    
+    if geometry is True:
+        return NodeIndex()
+    if not geometry:
+        return None
+    
+    return geometry
+
+
+# ================================================== #
+#               Way Geometry                         #
+# ================================================== #
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters between two points given in radians"""
+    
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def way_geometry(node_refs, node_index):
+    """Computes the bounding box, the centroid and the length of a way from
+       the references of its nodes. The fields are None if none of the nodes
+       is found in the index"""
+    
+    points = []
+    get_fixed = node_index.get_fixed
+    for ref in node_refs:
+        coords = get_fixed(int(ref))
+        if coords is not None:
+            points.append(coords)
+    
+    if not points:
+        return dict.fromkeys(GEOMETRY_FIELDS)
+    
+    lats = [lat for lat, _ in points]
+    lons = [lon for _, lon in points]
+    
+    # Closed ways repeat their first node at the end
+    vertices = len(points)
+    if vertices > 1 and points[0] == points[-1]:
+        vertices -= 1
+    
+    length = 0.0
+    scale = math.pi / (180.0 * COORD_SCALE)
+    for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+        length += haversine(lat1 * scale, lon1 * scale, lat2 * scale, lon2 * scale)
+    
+    return {'min_lat': min(lats) / COORD_SCALE,
+            'min_lon': min(lons) / COORD_SCALE,
+            'max_lat': max(lats) / COORD_SCALE,
+            'max_lon': max(lons) / COORD_SCALE,
+            'centroid_lat': round(sum(lats[:vertices]) / vertices / COORD_SCALE, 7),
+            'centroid_lon': round(sum(lons[:vertices]) / vertices / COORD_SCALE, 7),
+            'length': round(length, 2)}
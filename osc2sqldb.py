@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+The objective of this program is to update an existing SQL database, created
+with csv2sqldb or osm2sqldb, with the changes given in an osmChange (.osc)
+file, instead of rebuilding the whole database from a new OSM file.
+
+The created and modified nodes, ways and relations are shaped with the same
+corrections as osm2csv and replace the previous rows of the element in its
+main table and in the tables depending on it (tags, way nodes and relation
+members). The deleted elements are removed from all the tables. The version
+of each change is compared with the version stored in the database, and the
+changes which are not newer are skipped (the changes without version, or of
+elements stored without version, are always applied). The missing metadata
+are stored as NULL values, as in osm2sqldb. All the changes are applied 
+inside a single transaction, so the database is either fully updated or left
+untouched.
+
+The deletions look up the tag and way node tables by id, so the indexes built
+by csv2sqldb.create_indexes should exist to apply large diffs quickly.
+
+If the ways of the database have their geometry (bounding box, centroid and
+length), the geometry of the changed ways and of the ways whose nodes were
+changed is computed again from the nodes table once all the changes are
+applied (so the order of the changes in the file does not matter), in the
+same transaction. The rows of the changed elements in the R*Tree spatial 
+index of csv2sqldb (nodes_rtree and ways_rtree) are replaced as well, if the
+database has it.
+
+The summary tables of csv2sqldb (tags, tag_counts, key_counts and user_edits)
+are updated in the same transaction, if the database has them: the tags and
+users of the replaced and deleted elements are read before they are removed,
+and only the rows of the summary tables affected by the changes are updated
+(csv2sqldb.SummaryChanges). The cached query results of the database 
+(csv2sqldb.cached_query) are dropped once the changes are committed.
+
+Python version: 3.6.0
+"""
+
+import sys
+from itertools import groupby
+from collections import Counter
+
+import osm2csv
+import osm2sqldb
+import csv2sqldb
+import osm_reader
+import validation
+import correction_rules
+from geometry import GEOMETRY_FIELDS, to_fixed, way_geometry
+
+# Main table and tables depending on it for each element type
+ELEMENT_TABLES = {'node': ('nodes', ['nodes_tags']),
+                  'way': ('ways', ['ways_tags', 'ways_nodes']),
+                  'relation': ('relations', ['relations_tags', 'relations_members'])}
+
+
+# ================================================== #
+#               Helper Functions                     #
+# ================================================== #
+def get_version(conn, table_name, element_id):
+    """Returns the version of an element stored in the database (0 if it 
+       has no version), or None if the element is not in the database"""
+    
+    row = conn.execute('SELECT IFNULL(CAST(version AS INTEGER), 0) FROM {0} '
+                       'WHERE id = ?'.format(table_name), (element_id,)).fetchone()
+    
+    return row[0] if row else None
+
+
+def delete_element(conn, element_type, element_id):
+    """Deletes the rows of an element from all its tables"""
+    
+    table_name, child_tables = ELEMENT_TABLES[element_type]
+    for child_table in child_tables:
+        conn.execute('DELETE FROM {0} WHERE id = ?'.format(child_table), (element_id,))
+    conn.execute('DELETE FROM {0} WHERE id = ?'.format(table_name), (element_id,))
+
+
+def insert_element(conn, el):
+    """Inserts the rows of a shaped element in its tables"""
+    
+    for field, records in el.items():
+        table_name = osm2sqldb.FIELD_TABLES[field]
+        if isinstance(records, tuple):
+            records = [osm2sqldb.null_values(records, osm2sqldb.null_positions(table_name))]
+        conn.executemany(osm2sqldb.insert_statement(table_name), records)
+
+
+# ================================================== #
+#               Way Geometry                         #
+# ================================================== #
+class DatabaseNodeIndex(object):
+    """Read-only node index looking up the coordinates of the nodes in the
+       nodes table, used to compute the geometry of the changed ways"""
+    
+    writable = False
+    
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def get_fixed(self, node_id):
+        """Returns the fixed point (lat, lon) of a node, or None"""
+        
+        row = self.conn.execute('SELECT lat, lon FROM nodes WHERE id = ?', 
+                                (node_id,)).fetchone()
+        if row is None or row[0] is None or row[1] is None:
+            return None
+        
+        return to_fixed(row[0]), to_fixed(row[1])
+
+
+def has_way_geometry(conn):
+    """Returns True if the ways of the database have their geometry (the
+       geometry columns are empty if the database was built without it)"""
+    
+    if 'min_lat' not in [row[1] for row in conn.execute("PRAGMA table_info(ways)")]:
+        return False
+    
+    return conn.execute('SELECT 1 FROM ways WHERE min_lat IS NOT NULL '
+                        'LIMIT 1').fetchone() is not None
+
+
+def iter_id_chunks(ids):
+    """Yields the sorted ids in chunks of csv2sqldb.MAX_QUERY_IDS, with the
+       placeholders of their IN list"""
+    
+    ids = sorted(ids)
+    for i in range(0, len(ids), csv2sqldb.MAX_QUERY_IDS):
+        chunk = ids[i:i + csv2sqldb.MAX_QUERY_IDS]
+        yield chunk, ', '.join('?' * len(chunk))
+
+
+def ways_of_nodes(conn, node_ids):
+    """Returns the ids of the ways referencing any of the given nodes"""
+    
+    way_ids = set()
+    for chunk, placeholders in iter_id_chunks(node_ids):
+        way_ids.update(row[0] for row in conn.execute(
+            'SELECT DISTINCT id FROM ways_nodes WHERE node_id IN ({0})'.format(
+                placeholders), chunk))
+    
+    return way_ids
+
+
+def update_way_geometry(conn, way_ids):
+    """Computes the geometry of the given ways from their nodes in the
+       nodes table and updates it in the ways table"""
+    
+    node_index = DatabaseNodeIndex(conn)
+    statement = 'UPDATE ways SET {0} WHERE id = ?'.format(
+        ', '.join('{0} = ?'.format(field) for field in GEOMETRY_FIELDS))
+    
+    for chunk, placeholders in iter_id_chunks(way_ids):
+        rows = conn.execute('SELECT id, node_id FROM ways_nodes WHERE id IN ({0}) '
+                            'ORDER BY id, position'.format(placeholders), 
+                            chunk).fetchall()
+        for way_id, way_rows in groupby(rows, key=lambda row: row[0]):
+            geometry = way_geometry([node_id for _, node_id in way_rows], node_index)
+            conn.execute(statement, 
+                         [geometry[field] for field in GEOMETRY_FIELDS] + [way_id])
+
+
+# ================================================== #
+#               Spatial Index                        #
+# ================================================== #
+def update_spatial_index(conn, element_type, element_ids):
+    """Replaces the rows of the given elements (deleted, created or changed)
+       in the R*Tree table of their element type, if it exists"""
+    
+    _, rtree_name, _ = csv2sqldb.SPATIAL_TABLES[element_type]
+    if not csv2sqldb.has_table(conn, rtree_name):
+        return
+    
+    for chunk, placeholders in iter_id_chunks(element_ids):
+        conn.execute('DELETE FROM {0} WHERE id IN ({1})'.format(rtree_name, placeholders), 
+                     chunk)
+        conn.execute('INSERT INTO {0} {1} AND id IN ({2})'.format(
+            rtree_name, csv2sqldb.SPATIAL_ROWS[element_type], placeholders), chunk)
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def apply_changes(osc_file, db_path, mapping, expected_street_types,
+                  validate=False, rules=None):
+    """Applies the node, way and relation changes of an osmChange file to the
+       SQL database in a single transaction (the relation changes only if the
+       database has the relation tables). Returns the number of changes 
+       applied for each action and the number of stale changes skipped"""
+    
+    if rules is None:
+        rules = correction_rules.CorrectionRules(mapping, expected_street_types)
+    validator = validation.get_validator(validate)
+    
+    stats = Counter()
+    conn = csv2sqldb.create_connection(db_path)
+    try:
+        element_types = ('node', 'way')
+        if csv2sqldb.has_table(conn, 'relations'):
+            element_types += ('relation',)
+        
+        geometry = has_way_geometry(conn)
+        summary = csv2sqldb.SummaryChanges() if csv2sqldb.has_summary_tables(conn) else None
+        # Elements changed, by element type
+        changed = {element_type: set() for element_type in element_types}
+        
+        conn.execute('BEGIN')
+        for action, element in osm_reader.iter_changes(osc_file, element_types):
+            table_name, _ = ELEMENT_TABLES[element.tag]
+            element_id = int(element.attrib['id'])
+            version = element.attrib.get('version')
+            
+            current_version = get_version(conn, table_name, element_id)
+            if current_version is not None:
+                if version is not None and current_version >= int(version):
+                    stats['stale'] += 1
+                    continue
+                if summary is not None:
+                    summary.remove_element(conn, element.tag, element_id)
+                delete_element(conn, element.tag, element_id)
+            
+            if action != 'delete':
+                el = osm2csv.shape_element(element, rules.street_mapping,
+                                           rules.expected_street_types, rules=rules)
+                if validator is not None:
+                    validator.validate(el)
+                insert_element(conn, el)
+                if summary is not None:
+                    record = el[element.tag]
+                    summary.add_element(element.tag, element_id, record.uid, 
+                                        record.user, 
+                                        [tag[1:] for tag in el[element.tag + '_tags']])
+            
+            changed[element.tag].add(element_id)
+            stats[action] += 1
+        
+        changed_ways = changed['way']
+        if geometry:
+            changed_ways = changed_ways | ways_of_nodes(conn, changed['node'])
+            update_way_geometry(conn, changed_ways)
+        update_spatial_index(conn, 'node', changed['node'])
+        update_spatial_index(conn, 'way', changed_ways)
+        if summary is not None:
+            summary.apply(conn)
+        
+        conn.commit()
+        csv2sqldb.clear_cached_queries(db_path)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    return stats
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    OSC_FILE = sys.argv[1]
+    SQL_DB_PATH = sys.argv[2] if len(sys.argv) > 2 else 'LCG_map.db'
+    
+    RULES = correction_rules.load_rules()
+    
+    print(apply_changes(OSC_FILE, SQL_DB_PATH, RULES.street_mapping,
+                        RULES.expected_street_types, rules=RULES))
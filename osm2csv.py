@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 The objective of this program is to read an OSM datafile given in XML format,
-obtain the information stored in nodes and ways, store the defined fields,
+obtain the information stored in nodes, ways and relations, store the defined fields,
 apply the corrections given in the shape_element function and store the data
 in the corresponding CSV files.
 
@@ -15,21 +15,94 @@ the addition of the following corrections:
     - Add the street type to street names which do not contain it.
     - Discard the postal code if it does not contain a 5-digit code.
 
+The street mapping, the expected street types, the abbreviated street types 
+and the city corrections are compiled into the rule engine of correction_rules.
+In stand-alone mode they are loaded from correction_rules.json.
+
+For large files the conversion can be split among several worker processes
+(processes argument of process_map, or second command line argument). The file
+is split in byte ranges starting on node/way/relation elements and the partial
+CSV files are merged in order, so the output is identical to the serial one.
+Compressed files (.osm.bz2, .osm.gz) cannot be split in byte ranges: they are
+converted in a single process, while they are decompressed in the background
+(in parallel for multi-stream bz2 files, see osm_input). PBF files (.osm.pbf)
+are converted in a single process too, while their blobs are decoded in a pool
+of processes (see pbf_reader).
+
+Long conversions can be resumed after a failure (checkpoint and resume 
+arguments of process_map, or --checkpoint and --resume command line options).
+The XML file is converted in segments of about checkpoint_size bytes starting
+on top level elements. After each segment the outputs are flushed and a JSON
+checkpoint file records the offset of the next segment and the size and 
+number of rows of each output, along with the size and modification time of
+the input file. On resume the outputs are truncated to the sizes of the last
+checkpoint and the conversion goes on from its offset, so the outputs are the
+same as the ones of an uninterrupted run; a checkpoint saved for another 
+input file, or for a modified one, is rejected. The conversion with 
+checkpoints is serial and requires an uncompressed XML file.
+
+The XML file is read as lightweight element records produced by one of the
+parsing backends of osm_reader (expat, lxml or etree), selected with the 
+backend argument or the OSM_XML_BACKEND environment variable.
+
+The relations are converted when the paths of their CSV files are given
+(relations, relation members and relation tags). Their tags are corrected in
+the same way as the node and way tags, and the members, which can be tens of
+thousands for a single relation, are produced one by one from the element
+record (see RelationMembers) and written in streaming.
+
+With the geometry argument of process_map, the bounding box, the centroid and
+the length of each way are added to the ways CSV file (see geometry). The
+coordinates of the nodes are stored in a compact node index while the nodes
+are read, and the node references of the ways, which come after the nodes in
+the OSM files, are resolved in the same pass.
+
+The shaped elements are dictionaries of compact records (named tuples in the
+order of the CSV fields, see NodeRecord, TagRecord, etc.) instead of one
+dictionary per row, and the rows of the way nodes and the relation members
+are produced one by one from the element record (see WayNodes and
+RelationMembers). The records are written with csv.writer and inserted into
+SQLite without any conversion. The tag keys and types and the user names,
+repeated in most of the elements, are interned (sys.intern), so a single copy
+of each string is kept.
+
 Python version: 3.6.0
 """
 
 import sys
+import os
 import csv
+import json
 import codecs
 import pprint
 import re
-import xml.etree.cElementTree as ET
-import cerberus
+import shutil
+import tempfile
+import multiprocessing
+from sys import intern
+from collections import namedtuple
 
 import schema
+import osm_reader
+import osm_input
+import pbf_reader
+import validation
+import correction_rules
+import pipeline_stats
+from geometry import GEOMETRY_FIELDS, DiskNodeIndex, get_node_index, way_geometry
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+# Cache of the (type, key, corrector) triplet of each tag key, see classify_key
+KEY_CLASSES = {}
+KEY_CORRECTORS = {'addr:street': 'street', 
+                  'addr:city': 'city', 
+                  'addr:postcode': 'postcode'}
+
+ELEMENT_START = osm_reader.ELEMENT_START
+SCAN_BLOCK_SIZE = 1 << 16
+# Bytes of the input converted between two checkpoints
+CHECKPOINT_SIZE = 64 << 20
 
 SCHEMA = schema.schema
 
@@ -39,121 +112,382 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'member_type', 'role', 'position']
+CSV_FIELDS = [NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, 
+              WAY_TAGS_FIELDS, RELATION_FIELDS, RELATION_MEMBERS_FIELDS, 
+              RELATION_TAGS_FIELDS]
+# Fields of the ways including their geometry, see csv_fields
+WAY_GEOMETRY_FIELDS = WAY_FIELDS + GEOMETRY_FIELDS
+# Fields of the shaped elements, in the same order as CSV_FIELDS
+SHAPED_FIELDS = ['node', 'node_tags', 'way', 'way_nodes', 'way_tags', 
+                 'relation', 'relation_members', 'relation_tags']
+# Attributes stored once per distinct value (sys.intern)
+INTERNED_ATTRIBUTES = frozenset(['user'])
+
+
+# ================================================== #
+#               Shaped Records                       #
+# ================================================== #
+NodeRecord = namedtuple('NodeRecord', NODE_FIELDS)
+TagRecord = namedtuple('TagRecord', NODE_TAGS_FIELDS)
+WayRecord = namedtuple('WayRecord', WAY_FIELDS)
+WayGeometryRecord = namedtuple('WayGeometryRecord', WAY_GEOMETRY_FIELDS)
+WayNodeRecord = namedtuple('WayNodeRecord', WAY_NODES_FIELDS)
+RelationRecord = namedtuple('RelationRecord', RELATION_FIELDS)
+RelationMemberRecord = namedtuple('RelationMemberRecord', RELATION_MEMBERS_FIELDS)
+# Record type of each list of attributes, see record_type
+RECORD_TYPES = {tuple(NODE_FIELDS): NodeRecord,
+                tuple(WAY_FIELDS): WayRecord,
+                tuple(RELATION_FIELDS): RelationRecord}
+
+
+def record_type(fields):
+    """Return the record type of a list of attributes, created once for the
+       attribute lists given to shape_element"""
+    
+    fields = tuple(fields)
+    try:
+        return RECORD_TYPES[fields]
+    except KeyError:
+        new_type = RECORD_TYPES[fields] = namedtuple('Record', fields)
+        return new_type
+
+
+def attributes_record(element, attr_fields, rec_type):
+    """Return the record of the given attributes of an element, with empty
+       strings for the missing attributes"""
+    
+    get = element.attrib.get
+    
+    return rec_type._make([intern(get(field, '')) if field in INTERNED_ATTRIBUTES 
+                           else get(field, '') for field in attr_fields])
+
+
+class WayNodes(object):
+    """Iterable producing the node rows of a way one by one from the node
+       references of the element record, so that no row is stored. It can be
+       iterated several times (e.g. by the validator and by the writer)"""
+    
+    __slots__ = ('way_id', 'nds')
+    
+    def __init__(self, way_id, nds):
+        self.way_id = way_id
+        self.nds = nds
+    
+    def __iter__(self):
+        way_id = self.way_id
+        make = WayNodeRecord._make
+        for position, node_ref in enumerate(self.nds):
+            yield make((way_id, node_ref, position))
+    
+    def __len__(self):
+        return len(self.nds)
+
+
+class RelationMembers(object):
+    """Iterable producing the member rows of a relation one by one from the
+       (type, ref, role) triplets of the element record, so that the rows of
+       large relations are never stored in a list. It can be iterated several
+       times (e.g. by the validator and by the writer)"""
+    
+    __slots__ = ('relation_id', 'members')
+    
+    def __init__(self, relation_id, members):
+        self.relation_id = relation_id
+        self.members = members
+    
+    def __iter__(self):
+        relation_id = self.relation_id
+        make = RelationMemberRecord._make
+        for position, (member_type, member_id, role) in enumerate(self.members):
+            yield make((relation_id, member_id, intern(member_type),
+                        intern(role) if role is not None else '', position))
+    
+    def __len__(self):
+        return len(self.members)
 
 
 def shape_element(element, mapping, expected_street_types, 
-                  node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS):
-    """Clean and shape node or way XML element to Python dict"""
+                  node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS, 
+                  rules=None, relation_attr_fields=RELATION_FIELDS):
+    """Clean and shape node, way or relation element record to a dict of
+       compact records (see NodeRecord, TagRecord, etc.)"""
     
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
     tags = []
 
     if element.tag == 'node':
-        for attrib in node_attr_fields:
-            try:
-                node_attribs[attrib] = element.attrib[attrib]
-            except KeyError:
-                node_attribs[attrib] = ''
+        node_attribs = attributes_record(
+            element, node_attr_fields, 
+            NodeRecord if node_attr_fields is NODE_FIELDS else record_type(node_attr_fields))
         
-        tags = get_tags(element, tags, mapping, expected_street_types)
+        tags = get_tags(element, tags, mapping, expected_street_types, rules)
         
         return {'node': node_attribs, 'node_tags': tags}
     elif element.tag == 'way':
-        for attrib in way_attr_fields:
-            try:
-                way_attribs[attrib] = element.attrib[attrib]
-            except KeyError:
-                way_attribs[attrib] = ''
+        way_attribs = attributes_record(
+            element, way_attr_fields, 
+            WayRecord if way_attr_fields is WAY_FIELDS else record_type(way_attr_fields))
         
-        way_id = element.attrib['id']
-        for idx, child in enumerate(element.findall('nd')):
-            way_nodes.append({'id': way_id,
-                              'node_id': child.attrib['ref'],
-                              'position': idx})
+        way_nodes = WayNodes(element.attrib['id'], element.nds)
         
-        tags = get_tags(element, tags, mapping, expected_street_types)
+        tags = get_tags(element, tags, mapping, expected_street_types, rules)
         
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    elif element.tag == 'relation':
+        relation_attribs = attributes_record(
+            element, relation_attr_fields, 
+            RelationRecord if relation_attr_fields is RELATION_FIELDS 
+            else record_type(relation_attr_fields))
+        
+        relation_members = RelationMembers(element.attrib['id'], element.members)
+        
+        tags = get_tags(element, tags, mapping, expected_street_types, rules)
+        
+        return {'relation': relation_attribs, 'relation_members': relation_members,
+                'relation_tags': tags}
 
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=None):
+    """Yield element record if it is the right type of tag, using the XML 
+       backend selected in osm_reader"""
+
+    return osm_reader.iter_records(osm_file, tags, backend)
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+
+def csv_fields(geometry=False):
+    """Return the list of fields of each output, with the geometry fields
+       added to the ways if required"""
+    
+    if not geometry:
+        return CSV_FIELDS
+    return [WAY_GEOMETRY_FIELDS if fields is WAY_FIELDS else fields 
+            for fields in CSV_FIELDS]
+
+
+def build_node_index(osm_file, node_index, backend=None):
+    """Add the coordinates of all the nodes of the OSM file to the node index"""
+    
+    for element in get_element(osm_file, ('node',), backend):
+        node_index.add(element.attrib['id'], element.attrib['lat'], 
+                       element.attrib['lon'])
+    
+    return node_index
+
+
+def add_geometry(element, el, node_index):
+    """Add the coordinates of a node to the node index (unless it is 
+       read-only), or the geometry of a way to its shaped element"""
+    
+    if element.tag == 'node':
+        if node_index.writable:
+            node_index.add(element.attrib['id'], element.attrib['lat'], 
+                           element.attrib['lon'])
+    elif element.tag == 'way':
+        geometry = way_geometry(element.nds, node_index)
+        el['way'] = WayGeometryRecord._make(
+            el['way'] + tuple(geometry[field] for field in GEOMETRY_FIELDS))
+
+
+def element_types(n_outputs):
+    """Return the element types converted for a given number of outputs:
+       nodes and ways (5 outputs), and relations if their outputs are given"""
+    
+    if n_outputs > SHAPED_FIELDS.index('relation'):
+        return ('node', 'way', 'relation')
+    return ('node', 'way')
+
+
+class ShardReader(object):
+    """File-like object exposing the byte range [start, end) of an OSM file 
+       wrapped between the original prolog and a closing </osm> tag, so that 
+       the range can be parsed as a standalone document"""
+    
+    def __init__(self, osm_file, prolog_end, start, end):
+        self.osm = open(osm_file, 'rb')
+        self.head = self.osm.read(prolog_end)
+        self.tail = b'</osm>'
+        self.osm.seek(start)
+        self.remaining = end - start
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.head) + self.remaining + len(self.tail)
+        
+        data = self.head[:size]
+        self.head = self.head[size:]
+        if len(data) < size and self.remaining > 0:
+            chunk = self.osm.read(min(size - len(data), self.remaining))
+            self.remaining = self.remaining - len(chunk) if chunk else 0
+            data += chunk
+        if len(data) < size and self.remaining == 0:
+            missing = size - len(data)
+            data += self.tail[:missing]
+            self.tail = self.tail[missing:]
+        
+        return data
+    
+    def close(self):
+        self.osm.close()
+
+
+def next_element_offset(osm, offset):
+    """Return the byte offset of the first top level element found at or after
+       the given offset of a binary file handle, or None if there is none"""
+    
+    osm.seek(offset)
+    carry = b''
+    while True:
+        block = osm.read(SCAN_BLOCK_SIZE)
+        if not block:
+            return None
+        buf = carry + block
+        m = ELEMENT_START.search(buf)
+        if m:
+            return offset - len(carry) + m.start()
+        offset += len(block)
+        carry = buf[-16:]
+
+
+def closing_tag_offset(osm, first, size):
+    """Return the byte offset of the closing </osm> tag of a binary file 
+       handle, or its size if there is none"""
+    
+    osm.seek(max(first, size - SCAN_BLOCK_SIZE))
+    tail_offset = osm.tell()
+    close = osm.read().rfind(b'</osm>')
+    
+    return size if close == -1 else tail_offset + close
+
+
+def find_shard_offsets(osm_file, n_shards):
+    """Split the OSM file in up to n_shards byte ranges of similar size, each
+       one starting on a top level element. Returns the end of the prolog and
+       the list of (start, end) ranges"""
+    
+    size = os.path.getsize(osm_file)
+    with open(osm_file, 'rb') as osm:
+        first = next_element_offset(osm, 0)
+        if first is None:
+            return 0, []
+        
+        close = closing_tag_offset(osm, first, size)
+        
+        offsets = [first]
+        for i in range(1, n_shards):
+            offset = next_element_offset(osm, first + i * (close - first) // n_shards)
+            if offset is None or offset >= close:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+        offsets.append(close)
+    
+    return first, list(zip(offsets[:-1], offsets[1:]))
+
+
+def iter_segments(osm_file, start, segment_size):
+    """Yield the byte ranges [start, end) of about segment_size bytes in which
+       the OSM file is split from the given offset, each one starting on a 
+       top level element"""
+    
+    size = os.path.getsize(osm_file)
+    with open(osm_file, 'rb') as osm:
+        close = closing_tag_offset(osm, start, size)
+        while start < close:
+            end = next_element_offset(osm, start + segment_size)
+            if end is None or end > close:
+                end = close
+            yield start, end
+            start = end
 
 
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
+        field, errors = next(iter(validator.errors.items()))
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
         
         raise Exception(message_string.format(field, error_string))
 
 
-def get_tags(element, tags, mapping, expected_street_types):
-    """Get information from secondary tags and correct data if needed"""
+def classify_key(tag_key):
+    """Return the (type, key, corrector) triplet of a tag key and store it in
+       the KEY_CLASSES cache shared by all the elements. The corrector is the
+       name of the correction applied to the value, 'skip' if the tag has to
+       be discarded or None"""
+    
+    if PROBLEMCHARS.search(tag_key):
+        key_class = (None, None, 'skip')
+    elif tag_key == 'name':
+        key_class = ('name', 'name', 'name')
+    elif LOWER_COLON.search(tag_key):
+        tag_type, key = tag_key.split(':', 1)
+        key_class = (intern(tag_type), intern(key), KEY_CORRECTORS.get(tag_key))
+    elif 'name' in tag_key:
+        key_class = ('name', intern(tag_key), None)
+    else:
+        key_class = ('regular', intern(tag_key), None)
+    
+    KEY_CLASSES[tag_key] = key_class
+    
+    return key_class
+
+
+def get_tags(element, tags, mapping, expected_street_types, rules=None):
+    """Get information from secondary tags and correct data if needed. If the
+       compiled correction rules are given they are used instead of the 
+       mapping and the expected street types"""
     
     node_id = element.attrib['id']
+    make_tag = TagRecord._make
     
     # Set a boolean to True if there is no "addr:street" and if the node is not a bus stop
     change_name_tag = True
-    if (len(element.findall(".//tag[@k='addr:street']")) != 0 or 
-        len(element.findall(".//tag[@v='bus_stop']")) != 0):
-        change_name_tag = False
-    
-    for child in element.findall('tag'):
-        tag_key = child.attrib['k']
-        if PROBLEMCHARS.search(tag_key):
-            continue
+    name_tags = []
+    
+    for tag_key, tag_value in element.tags:
+        if tag_key == 'addr:street' or tag_value == 'bus_stop':
+            change_name_tag = False
+        
+        try:
+            tag_type, key, corrector = KEY_CLASSES[tag_key]
+        except KeyError:
+            tag_type, key, corrector = classify_key(tag_key)
         
-        if tag_key == 'name':
-            tag_value = child.attrib['v']
-            first_word = tag_value.split()[0]
-            # Change tag to "name:street" if the first word matches the expected street types and if the boolean is True
-            if (first_word in expected_street_types) and (change_name_tag):
-                tag_type = tag_key
-                key = 'street'
-            else: # Keep name value as "name"
-                tag_type = tag_key
-                key = 'name'
-        elif LOWER_COLON.search(tag_key):
-            tag_type = tag_key.split(':', 1)[0]
-            key = tag_key.split(':', 1)[-1]
-            if tag_key == 'addr:street':
-                tag_value = update_street_name(child.attrib['v'], mapping)
-            elif tag_key == 'addr:city':
-                tag_value = correct_city_name(child.attrib['v'])
-            elif tag_key == 'addr:postcode':
-                tag_value = child.attrib['v']
+        if corrector is not None:
+            if corrector == 'skip':
+                continue
+            elif corrector == 'street':
+                if rules is not None:
+                    tag_value = rules.street_name(tag_value)
+                else:
+                    tag_value = update_street_name(tag_value, mapping)
+            elif corrector == 'city':
+                if rules is not None:
+                    tag_value = rules.city_name(tag_value)
+                else:
+                    tag_value = correct_city_name(tag_value)
+            elif corrector == 'postcode':
                 if len(tag_value) != 5:
                     continue
-            else:
-                tag_value = child.attrib['v']
-        else:
-            tag_value = child.attrib['v']
-            key = tag_key
-            if 'name' in tag_key:
-                tag_type = 'name'
-            else:
-                tag_type = 'regular'
         
-        tags.append({'id': node_id, 
-                     'key': key, 
-                     'value': tag_value, 
-                     'type': tag_type})
+        if corrector == 'name':
+            name_tags.append(len(tags))
+        tags.append(make_tag((node_id, key, tag_value, tag_type)))
+    
+    # Change "name" tags to "name:street" if the first word matches the expected
+    # street types and if the boolean is True (known once all tags are read)
+    if change_name_tag:
+        street_types = rules.street_types if rules is not None else expected_street_types
+        for i in name_tags:
+            if tags[i].value.split()[0] in street_types:
+                tags[i] = tags[i]._replace(key='street')
     
     return tags
 
@@ -164,97 +498,508 @@ def get_tags(element, tags, mapping, expected_street_types):
 def update_street_name(st_name, mapping):
     """Update street name if present in the mapping dictionary provided """
     
-    if st_name in mapping.keys():
-        st_name = mapping[st_name]
-
-    return st_name
+    return mapping.get(st_name, st_name)
 
 
 def correct_city_name(city_name):
     """Correct city name if it contains either Coruña or O Temple"""
     
-    if re.search("O Temple", city_name):
+    if "O Temple" in city_name:
         city_name = 'O Temple, Cambre'
-    elif (re.search("Coruña", city_name)) and not (re.search("A Coruña", city_name)):
+    elif ("Coruña" in city_name) and not ("A Coruña" in city_name):
         city_name = 'A Coruña'
     
     return city_name
 
 
+# ================================================== #
+#               Writing Functions                    #
+# ================================================== #
+def write_elements(elements, writers, rules, validate, node_index=None, 
+                   stats=None):
+    """Shape each element record with the compiled correction rules, validate
+       it if required and write it to the csv writers (nodes, node tags, ways,
+       way nodes, way tags, and optionally relations, relation members and
+       relation tags). If a node index is given, the coordinates of the nodes
+       are added to it (unless it is read-only) and the geometry of the ways 
+       is computed from it. If stats are given (a pipeline_stats.PipelineStats),
+       each stage is timed and the elements are counted. Returns the 
+       validator used, if any"""
+    
+    writers = dict(zip(SHAPED_FIELDS, writers))
+    
+    validator = validation.get_validator(validate)
+    
+    if stats is None:
+        # Same loop without the stage timers
+        for element in elements:
+            el = shape_element(element, rules.street_mapping, 
+                               rules.expected_street_types, rules=rules)
+            if el:
+                if node_index is not None:
+                    add_geometry(element, el, node_index)
+                
+                if validator is not None:
+                    validator.validate(el)
+                
+                for field, records in el.items():
+                    if isinstance(records, tuple):
+                        writers[field].writerow(records)
+                    else:
+                        writers[field].writerows(records)
+        
+        return validator
+    
+    parse_timer = stats.timer('parse')
+    shape_timer = stats.timer('shape')
+    geometry_timer = stats.timer('geometry')
+    validate_timer = stats.timer('validate')
+    write_timer = stats.timer('write')
+    count_element = stats.count_element
+    
+    elements = iter(elements)
+    while True:
+        with parse_timer:
+            element = next(elements, None)
+        if element is None:
+            break
+        
+        with shape_timer:
+            el = shape_element(element, rules.street_mapping, 
+                               rules.expected_street_types, rules=rules)
+        if el:
+            if node_index is not None:
+                with geometry_timer:
+                    add_geometry(element, el, node_index)
+            
+            if validator is not None:
+                with validate_timer:
+                    validator.validate(el)
+            
+            with write_timer:
+                for field, records in el.items():
+                    if isinstance(records, tuple):
+                        writers[field].writerow(records)
+                    else:
+                        writers[field].writerows(records)
+            
+            count_element(element, el)
+    
+    return validator
+
+
+class RowCounter(object):
+    """csv writer counting the rows written, used for the checkpoints"""
+    
+    __slots__ = ('writer', 'rows')
+    
+    def __init__(self, writer, rows=0):
+        self.writer = writer
+        self.rows = rows
+    
+    def writerow(self, record):
+        self.rows += 1
+        self.writer.writerow(record)
+    
+    def writerows(self, records):
+        # Lists of tags, WayNodes and RelationMembers, all with a length
+        self.rows += len(records)
+        self.writer.writerows(records)
+
+
+def checkpoint_path(file_in, out_dir='.'):
+    """Return the path of the checkpoint file of the conversion of an input
+       file, in the directory of the outputs"""
+    
+    return os.path.join(out_dir, '{0}.osm2csv_checkpoint.json'.format(
+        os.path.basename(file_in)))
+
+
+def input_state(file_in):
+    """Return the path, size and modification time of the input file, 
+       recorded in the checkpoints"""
+    
+    stat = os.stat(file_in)
+    return {'input': os.path.abspath(file_in), 
+            'input_size': stat.st_size, 
+            'input_mtime': stat.st_mtime_ns}
+
+
+def read_checkpoint(checkpoint, file_in, out_paths, geometry):
+    """Return the state saved in a checkpoint file, or None if it does not
+       exist. Raises ValueError if it was saved for another input file (or 
+       the input file was modified since) or other outputs"""
+    
+    try:
+        with open(checkpoint) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    
+    if (any(state.get(field) != value for field, value in input_state(file_in).items()) or
+            state['geometry'] != geometry or
+            [output['path'] for output in state['outputs']] != 
+            [os.path.abspath(path) for path in out_paths]):
+        raise ValueError("Checkpoint {0} does not match the input and outputs "
+                         "of the conversion".format(checkpoint))
+    
+    return state
+
+
+def write_checkpoint(checkpoint, state, files, writers):
+    """Flush the outputs to disk and save their sizes and number of rows in
+       the checkpoint file, replaced atomically"""
+    
+    for f, writer, output in zip(files, writers, state['outputs']):
+        f.flush()
+        os.fsync(f.fileno())
+        output['size'] = os.path.getsize(output['path'])
+        output['rows'] = writer.rows
+    
+    tmp_path = checkpoint + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, checkpoint)
+
+
+def write_checkpointed(file_in, out_paths, rules, validate, node_index, stats,
+                       backend, checkpoint, resume, checkpoint_size):
+    """Convert an uncompressed XML file in segments of about checkpoint_size
+       bytes, saving a checkpoint after each segment. If resume is True and 
+       the checkpoint file exists, the outputs are truncated to the sizes of
+       the checkpoint (the node index is rebuilt with the nodes before it) 
+       and the conversion goes on from its offset. The checkpoint file is 
+       removed once the conversion is completed. Returns the validator used,
+       if any"""
+    
+    if osm_input.is_compressed(file_in) or pbf_reader.is_pbf(file_in):
+        raise ValueError("Checkpoints require an uncompressed XML file: {0}".format(file_in))
+    
+    geometry = node_index is not None
+    with open(file_in, 'rb') as osm:
+        prolog_end = next_element_offset(osm, 0)
+    
+    state = read_checkpoint(checkpoint, file_in, out_paths, geometry) if resume else None
+    if state is not None:
+        for output in state['outputs']:
+            os.truncate(output['path'], output['size'])
+        files = [codecs.open(path, "a", encoding="utf-8") for path in out_paths]
+        writers = [RowCounter(csv.writer(f), output['rows']) 
+                   for f, output in zip(files, state['outputs'])]
+        if node_index is not None and state['offset'] > prolog_end:
+            reader = ShardReader(file_in, prolog_end, prolog_end, state['offset'])
+            try:
+                build_node_index(reader, node_index, backend)
+            finally:
+                reader.close()
+    else:
+        state = input_state(file_in)
+        state.update(geometry=geometry, offset=prolog_end,
+                     outputs=[{'path': os.path.abspath(path)} for path in out_paths])
+        files = [codecs.open(path, "w", encoding="utf-8") for path in out_paths]
+        writers = [RowCounter(csv.writer(f)) for f in files]
+        for f, fields in zip(files, csv_fields(geometry)):
+            csv.writer(f).writerow(fields)
+    
+    if stats is not None:
+        stats.set_input(state['input_size'], lambda: state['offset'])
+    
+    validator = validation.get_validator(validate)
+    try:
+        write_checkpoint(checkpoint, state, files, writers)
+        if prolog_end is not None:
+            for start, end in iter_segments(file_in, state['offset'], checkpoint_size):
+                reader = ShardReader(file_in, prolog_end, start, end)
+                try:
+                    elements = get_element(reader, element_types(len(writers)), backend)
+                    write_elements(elements, writers, rules, validator, node_index, 
+                                   stats)
+                finally:
+                    reader.close()
+                
+                state['offset'] = end
+                write_checkpoint(checkpoint, state, files, writers)
+    finally:
+        for f in files:
+            f.close()
+    
+    os.remove(checkpoint)
+    
+    return validator
+
+
+def process_shard(task):
+    """Process one byte range of the OSM file and write it to headerless csv 
+       part files. Runs in a worker process of process_map_parallel and 
+       returns the shard number, the part files, the validation report and
+       the stats of the shard. The way geometry is computed with the shared
+       node index file, if given"""
+    
+    (shard, file_in, prolog_end, start, end, rules, part_paths, validate, 
+     backend, node_index_path, stats) = task
+    
+    node_index = None
+    if node_index_path:
+        node_index = DiskNodeIndex(node_index_path, readonly=True)
+    
+    reader = ShardReader(file_in, prolog_end, start, end)
+    files = [codecs.open(path, "w", encoding="utf-8") for path in part_paths]
+    try:
+        writers = [csv.writer(f) for f in files]
+        elements = get_element(reader, element_types(len(writers)), backend)
+        validator = write_elements(elements, writers, rules, validate, node_index, 
+                                   stats)
+    finally:
+        for f in files:
+            f.close()
+        reader.close()
+        if node_index is not None:
+            node_index.close()
+    
+    if stats is not None:
+        # Peak memory of the worker process, merged into the stats of the run
+        stats.sample_memory()
+    
+    return shard, part_paths, validator.report if validator is not None else None, stats
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
 def process_map(file_in, mapping, expected_street_types, nodes_path, 
                 node_tags_path, ways_path, way_nodes_path, way_tags_path, 
-                validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(nodes_path, "w", encoding="utf-8") as nodes_file, \
-         codecs.open(node_tags_path, "w", encoding="utf-8") as nodes_tags_file, \
-         codecs.open(ways_path, "w", encoding="utf-8") as ways_file, \
-         codecs.open(way_nodes_path, "w", encoding="utf-8") as way_nodes_file, \
-         codecs.open(way_tags_path, "w", encoding="utf-8") as way_tags_file:
-
-        nodes_writer = csv.DictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = csv.DictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = csv.DictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = csv.DictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = csv.DictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element, mapping, expected_street_types)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-                
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+                validate, processes=1, backend=None, rules=None, 
+                relations_path=None, relation_members_path=None, 
+                relation_tags_path=None, geometry=False, stats=False,
+                checkpoint=None, resume=False, checkpoint_size=CHECKPOINT_SIZE):
+    """Iteratively process each XML element and write to csv(s). The street
+       mapping and the expected street types are compiled into correction 
+       rules, unless the rules are given (see correction_rules.load_rules).
+       The relations are converted too if relations_path is given.
+       
+       geometry can be True (add the geometry of the ways, storing the node
+       coordinates in an in-memory geometry.NodeIndex) or a node index to use,
+       e.g. a geometry.DiskNodeIndex for very large files (the only one the
+       worker processes can share when processes is not 1).
+       
+       validate can be True (validate every element and raise an exception on
+       the first error) or a validation.ElementValidator, to sample elements 
+       and collect the errors. The validation report is returned.
+       
+       stats can be True (report the progress and print the time of each
+       stage at the end) or a pipeline_stats.PipelineStats, filled with the
+       timers and counters of the run.
+       
+       If a checkpoint file path is given, the file is converted serially in
+       segments of checkpoint_size bytes with a checkpoint saved after each 
+       one (see write_checkpointed). With resume, an interrupted conversion 
+       goes on from its last checkpoint. The validation report and the stats 
+       then cover only the resumed part"""
+    
+    if rules is None:
+        rules = correction_rules.CorrectionRules(mapping, expected_street_types)
+    
+    run_stats = pipeline_stats.get_stats(stats)
+    
+    if (processes != 1 and checkpoint is None and 
+            not osm_input.is_compressed(file_in) and not pbf_reader.is_pbf(file_in)):
+        return process_map_parallel(file_in, mapping, expected_street_types, 
+                                    nodes_path, node_tags_path, ways_path, 
+                                    way_nodes_path, way_tags_path, validate, 
+                                    processes, backend=backend, rules=rules,
+                                    relations_path=relations_path,
+                                    relation_members_path=relation_members_path,
+                                    relation_tags_path=relation_tags_path,
+                                    geometry=geometry, stats=stats)
+    
+    out_paths = [nodes_path, node_tags_path, ways_path, way_nodes_path, 
+                 way_tags_path]
+    if relations_path:
+        out_paths += [relations_path, relation_members_path, relation_tags_path]
+    
+    node_index = get_node_index(geometry)
+    
+    if checkpoint is not None:
+        validator = write_checkpointed(file_in, out_paths, rules, validate, 
+                                       node_index, run_stats, backend, 
+                                       checkpoint, resume, checkpoint_size)
+        if run_stats is not None:
+            run_stats.finish()
+            if stats is True:
+                print(run_stats.summary())
+        return validator.report if validator is not None else None
+    
+    osm = file_in
+    if (run_stats is not None and isinstance(file_in, str) and
+            not osm_input.is_compressed(file_in) and not pbf_reader.is_pbf(file_in)):
+        # The position in the XML file gives the progress of the run
+        osm = open(file_in, 'rb')
+        run_stats.set_input(os.path.getsize(file_in), osm.tell)
+    
+    files = [codecs.open(path, "w", encoding="utf-8") for path in out_paths]
+    try:
+        fields_list = csv_fields(node_index is not None)
+        writers = [csv.writer(f) for f in files]
+        for writer, fields in zip(writers, fields_list):
+            writer.writerow(fields)
+        
+        elements = get_element(osm, element_types(len(writers)), backend)
+        validator = write_elements(elements, writers, rules, validate, node_index,
+                                   run_stats)
+    finally:
+        for f in files:
+            f.close()
+        if osm is not file_in:
+            osm.close()
+    
+    if run_stats is not None:
+        run_stats.finish()
+        if stats is True:
+            print(run_stats.summary())
+    
+    return validator.report if validator is not None else None
+
+
+def process_map_parallel(file_in, mapping, expected_street_types, nodes_path, 
+                         node_tags_path, ways_path, way_nodes_path, 
+                         way_tags_path, validate, processes=None, 
+                         shards_per_process=4, backend=None, rules=None,
+                         relations_path=None, relation_members_path=None, 
+                         relation_tags_path=None, geometry=False, stats=False):
+    """Split the OSM file in byte ranges aligned on node/way/relation 
+       boundaries, process each range in a worker process and concatenate the
+       partial csv(s) in file order, so that the output is byte-identical to
+       the one of the serial process_map. If geometry is True, the node 
+       coordinates are first stored in a geometry.DiskNodeIndex file shared
+       by the workers. geometry can also be a DiskNodeIndex, read by the 
+       workers from its file (the nodes of the file are first added to it
+       unless it is read-only), but not an in-memory index. The stats of each shard are merged into the given
+       stats once it is done (the stage times are summed over the workers and
+       the peak memory is the one of the largest process), and the progress
+       is reported after each shard"""
+    
+    if not processes or processes < 1:
+        processes = multiprocessing.cpu_count()
+    
+    if geometry and geometry is not True and not isinstance(geometry, DiskNodeIndex):
+        raise ValueError('the worker processes cannot share a {0}, use a '
+                         'geometry.DiskNodeIndex or a single process'.format(
+                             type(geometry).__name__))
+    
+    if rules is None:
+        rules = correction_rules.CorrectionRules(mapping, expected_street_types)
+    
+    # Each worker validates with its own copy of the validator settings
+    worker_validate = validate
+    if isinstance(validate, validation.ElementValidator):
+        worker_validate = validate.spawn()
+    
+    run_stats = pipeline_stats.get_stats(stats)
+    worker_stats = run_stats.spawn() if run_stats is not None else None
+    
+    prolog_end, shards = find_shard_offsets(file_in, processes * shards_per_process)
+    if run_stats is not None:
+        # The progress is given by the size of the shards done
+        bytes_done = [prolog_end or 0]
+        run_stats.set_input(os.path.getsize(file_in), lambda: bytes_done[0])
+    out_paths = [nodes_path, node_tags_path, ways_path, way_nodes_path, 
+                 way_tags_path]
+    if relations_path:
+        out_paths += [relations_path, relation_members_path, relation_tags_path]
+    
+    # Keep the part files on the same filesystem as the final outputs
+    tmp_dir = tempfile.mkdtemp(prefix='osm2csv_', 
+                               dir=os.path.dirname(os.path.abspath(nodes_path)))
+    try:
+        node_index_path = None
+        if isinstance(geometry, DiskNodeIndex):
+            node_index_path = geometry.path
+            if geometry.writable:
+                with pipeline_stats.stage_timer(run_stats, 'node_index'):
+                    build_node_index(file_in, geometry, backend).flush()
+        elif geometry:
+            node_index_path = os.path.join(tmp_dir, 'nodes.idx')
+            with pipeline_stats.stage_timer(run_stats, 'node_index'):
+                build_node_index(file_in, DiskNodeIndex(node_index_path), backend).close()
+        
+        tasks = []
+        for i, (start, end) in enumerate(shards):
+            part_paths = [os.path.join(tmp_dir, '{0:05d}_{1}.csv'.format(i, j)) 
+                          for j in range(len(out_paths))]
+            tasks.append((i, file_in, prolog_end, start, end, rules, part_paths, 
+                          worker_validate, backend, node_index_path, worker_stats))
+        
+        results = [None] * len(tasks)
+        pool = multiprocessing.Pool(min(processes, max(len(tasks), 1)))
+        try:
+            for result in pool.imap_unordered(process_shard, tasks, chunksize=1):
+                shard, _, _, shard_stats = result
+                results[shard] = result
+                if run_stats is not None:
+                    run_stats.merge(shard_stats)
+                    start, end = shards[shard]
+                    bytes_done[0] += end - start
+                    if run_stats.progress_every:
+                        run_stats.progress()
+        finally:
+            pool.close()
+            pool.join()
+        shard_parts = [part_paths for _, part_paths, _, _ in results]
+        
+        fields_list = csv_fields(geometry)
+        with pipeline_stats.stage_timer(run_stats, 'merge'):
+            for j, (out_path, fields) in enumerate(zip(out_paths, fields_list)):
+                with codecs.open(out_path, "w", encoding="utf-8") as out_file:
+                    csv.writer(out_file).writerow(fields)
+                with open(out_path, 'ab') as out_file:
+                    for part_paths in shard_parts:
+                        with open(part_paths[j], 'rb') as part_file:
+                            shutil.copyfileobj(part_file, out_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    if run_stats is not None:
+        run_stats.finish()
+        if stats is True:
+            print(run_stats.summary())
+    
+    if isinstance(validate, validation.ElementValidator):
+        for _, _, report, _ in results:
+            validate.report.merge(report)
+        return validate.report
+    
+    return None
 
 
 if __name__ == '__main__':
     """Defines the required variables if the code is launched in stand-alone mode"""
     
-    OSM_FILE = sys.argv[1]
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    OSM_FILE = ARGS[0]
+    PROCESSES = int(ARGS[1]) if len(ARGS) > 1 else 1
+    # Checkpoints of the serial conversion of XML files, saved with 
+    # --checkpoint and used with --resume after a failure
+    RESUME = '--resume' in sys.argv
+    CHECKPOINT_PATH = None
+    if '--checkpoint' in sys.argv or RESUME:
+        CHECKPOINT_PATH = checkpoint_path(OSM_FILE)
     
     NODES_PATH = 'nodes.csv'
     NODE_TAGS_PATH = 'nodes_tags.csv'
     WAYS_PATH = 'ways.csv'
     WAY_NODES_PATH = 'ways_nodes.csv'
     WAY_TAGS_PATH = 'ways_tags.csv'
+    RELATIONS_PATH = 'relations.csv'
+    RELATION_MEMBERS_PATH = 'relations_members.csv'
+    RELATION_TAGS_PATH = 'relations_tags.csv'
+    
+    # Street types and corrections found in the audit of the A Coruña map
+    RULES = correction_rules.load_rules()
     
-    expected_street_types = ['Rúa', 'Praza', 'Avenida', 'Rolda', 'Glorieta', 
-                             'Travesía', 'Praciña', 'Estrada', 'Paseo', 'Lugar', 
-                             'Camiño', 'Cantón', 'Escaleira', 'Costa', 'Escalinata', 
-                             'Pasadizo', 'Estreita', 'Vía', 'Vereda', 'Calexón',
-                             'Ruela', 'Peirao', 'Rampla', 'Autoestrada',
-                             'Autovía']
-    
-    street_mapping = {'CARRETERA NACIONAL VI KM. 589': 'Estrada Nacional VI Km. 589',
-                      'Plaza do Santuario': 'Praza do Santuario',
-                      'Calle Cuba': 'Rúa Cuba',
-                      'Carretera de A Zapateira': 'Estrada da Zapateira',
-                      'Roi Xordo': 'Rúa Roi Xordo',
-                      'Rosalía de Castro': 'Rúa Rosalía de Castro',
-                      'Anxo senra Fernandez': 'Rúa Anxo Senra Fernández',
-                      'Capitán Juan Varela': 'Rúa Capitán Juan Varela',
-                      'María Corredoira': 'Rúa María Corredoira',
-                      'Av.Mallos': 'Avenida dos Mallos',
-                      'Avda Alfonso Molina': 'Avenida Alfonso Molina',
-                      'Avd. Ernesto Che Guevara': 'Avenida Ernesto Che Guevara'}
-    
-    process_map(OSM_FILE, street_mapping, expected_street_types, NODES_PATH, 
-                NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH, 
-                validate=False)
\ No newline at end of file
+    process_map(OSM_FILE, RULES.street_mapping, RULES.expected_street_types, 
+                NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, 
+                WAY_TAGS_PATH, validate=False, processes=PROCESSES, rules=RULES,
+                relations_path=RELATIONS_PATH, 
+                relation_members_path=RELATION_MEMBERS_PATH,
+                relation_tags_path=RELATION_TAGS_PATH, geometry=True,
+                checkpoint=CHECKPOINT_PATH, resume=RESUME)
\ No newline at end of file
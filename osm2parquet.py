@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+The objective of this program is to read an OSM datafile given in XML format,
+apply the same corrections as osm2csv and store the data in typed, compressed
+columnar Parquet files instead of CSV files.
+
+The same tables as osm2csv are written (nodes, nodes_tags, ways, ways_nodes,
+ways_tags, and relations, relations_members, relations_tags if their paths
+are given), with integer and float columns stored with their type
+and dictionary encoding for the repetitive columns (user, key and type). The
+records are buffered into row groups of a fixed number of rows, which are
+written as soon as they are full, so whole tables are never held in memory.
+
+The files can be read with pandas.read_parquet, and csv2sqldb.create_database
+imports them when the given paths have the .parquet extension.
+
+This program requires the pyarrow library.
+
+Python version: 3.6.0
+"""
+
+import sys
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+import osm2csv
+import correction_rules
+from geometry import get_node_index
+
+ROW_GROUP_SIZE = 100000
+COMPRESSION = 'snappy'
+DICTIONARY_COLUMNS = ['user', 'key', 'type', 'member_type', 'role']
+
+# Types of the columns of each table, in the same order as the CSV fields
+COLUMN_TYPES = {
+    'id': 'int64', 'lat': 'float64', 'lon': 'float64', 'user': 'string',
+    'uid': 'int64', 'version': 'int64', 'changeset': 'int64',
+    'timestamp': 'string', 'key': 'string', 'value': 'string',
+    'type': 'string', 'node_id': 'int64', 'position': 'int64',
+    'member_id': 'int64', 'member_type': 'string', 'role': 'string',
+    'min_lat': 'float64', 'min_lon': 'float64', 'max_lat': 'float64',
+    'max_lon': 'float64', 'centroid_lat': 'float64', 'centroid_lon': 'float64',
+    'length': 'float64'
+}
+
+
+def table_schema(fields):
+    """Produces the Arrow schema of a table from its list of fields"""
+    
+    return pa.schema([(field, pa.type_for_alias(COLUMN_TYPES[field]))
+                      for field in fields])
+
+
+class ParquetTableWriter(object):
+    """Writer with the same interface as csv.writer (writerow and writerows)
+       buffering the records (tuples in the order of the fields) column by
+       column and writing a row group to the Parquet file every 
+       row_group_size records"""
+    
+    def __init__(self, path, fields, row_group_size=ROW_GROUP_SIZE,
+                 compression=COMPRESSION):
+        self.fields = fields
+        self.schema = table_schema(fields)
+        self.row_group_size = row_group_size
+        self.columns = {field: [] for field in fields}
+        self.column_lists = [self.columns[field] for field in fields]
+        self.rows = 0
+        self.writer = pq.ParquetWriter(
+            path, self.schema, compression=compression,
+            use_dictionary=[f for f in fields if f in DICTIONARY_COLUMNS])
+    
+    def writerow(self, record):
+        for column, value in zip(self.column_lists, record):
+            column.append(value)
+        self.rows += 1
+        if self.rows >= self.row_group_size:
+            self.flush()
+    
+    def writerows(self, records):
+        for record in records:
+            self.writerow(record)
+    
+    def flush(self):
+        if not self.rows:
+            return
+        
+        arrays = []
+        for field in self.schema:
+            values = self.columns[field.name]
+            if field.type == pa.string() or not isinstance(values[0], str):
+                arrays.append(pa.array(values, type=field.type))
+            else:
+                # Missing attributes are given as empty strings by shape_element
+                values = [v if v != '' else None for v in values]
+                arrays.append(pa.array(values, type=pa.string()).cast(field.type))
+            del self.columns[field.name][:]
+        
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = 0
+    
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def process_map_parquet(file_in, mapping, expected_street_types, nodes_path,
+                        node_tags_path, ways_path, way_nodes_path,
+                        way_tags_path, validate=False, backend=None,
+                        rules=None, row_group_size=ROW_GROUP_SIZE,
+                        compression=COMPRESSION, relations_path=None,
+                        relation_members_path=None, relation_tags_path=None,
+                        geometry=False):
+    """Iteratively process each XML element and write to Parquet file(s).
+       The relations are converted too if relations_path is given, and the
+       geometry of the ways is added as in osm2csv.process_map.
+       Returns the validation report if validate is given"""
+    
+    if pa is None:
+        raise ImportError('pyarrow is required to write Parquet files')
+    
+    if rules is None:
+        rules = correction_rules.CorrectionRules(mapping, expected_street_types)
+    
+    paths = [nodes_path, node_tags_path, ways_path, way_nodes_path, way_tags_path]
+    if relations_path:
+        paths += [relations_path, relation_members_path, relation_tags_path]
+    node_index = get_node_index(geometry)
+    writers = []
+    try:
+        for path, fields in zip(paths, osm2csv.csv_fields(node_index is not None)):
+            writers.append(ParquetTableWriter(path, fields, row_group_size,
+                                              compression))
+        
+        elements = osm2csv.get_element(
+            file_in, osm2csv.element_types(len(writers)), backend)
+        validator = osm2csv.write_elements(elements, writers, rules, validate,
+                                           node_index)
+    finally:
+        for writer in writers:
+            writer.close()
+    
+    return validator.report if validator is not None else None
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    OSM_FILE = sys.argv[1]
+    
+    NODES_PATH = 'nodes.parquet'
+    NODE_TAGS_PATH = 'nodes_tags.parquet'
+    WAYS_PATH = 'ways.parquet'
+    WAY_NODES_PATH = 'ways_nodes.parquet'
+    WAY_TAGS_PATH = 'ways_tags.parquet'
+    RELATIONS_PATH = 'relations.parquet'
+    RELATION_MEMBERS_PATH = 'relations_members.parquet'
+    RELATION_TAGS_PATH = 'relations_tags.parquet'
+    
+    RULES = correction_rules.load_rules()
+    
+    process_map_parquet(OSM_FILE, RULES.street_mapping,
+                        RULES.expected_street_types, NODES_PATH, NODE_TAGS_PATH,
+                        WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH, rules=RULES,
+                        relations_path=RELATIONS_PATH,
+                        relation_members_path=RELATION_MEMBERS_PATH,
+                        relation_tags_path=RELATION_TAGS_PATH, geometry=True)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+The objective of this program is to read an OSM datafile given in XML format,
+apply the same corrections as osm2csv and stream the shaped elements directly
+into the SQL database, skipping the intermediate CSV files.
+
+The elements are parsed one by one with osm2csv.get_element and shaped with
+osm2csv.shape_element. The rows are buffered per table and inserted in batches
+with executemany (the INSERT statements are prepared once and reused by the
+sqlite3 statement cache) inside large transactions. During the load the
+database is configured with bulk-load PRAGMAs (no journal, no synchronous
+writes, bigger page cache), which are restored once the load has finished.
+The memory usage does not depend on the size of the input file. The summary
+tables and the secondary indexes defined in csv2sqldb are built after the load.
+
+The records of the shaped elements are tuples in the order of the table
+columns (see osm2csv.NodeRecord, etc.), so they are inserted as they are. The
+missing metadata (uid, version and changeset), given as empty strings, are 
+inserted as NULL values like in the CSV import of csv2sqldb.
+
+The tables are created with the schemas given by csv2sqldb.create_schemas,
+including the relation tables. The members of the relations are buffered and
+inserted in the same batches as the other rows, so the member lists of large
+relations are never built in memory.
+
+Python version: 3.6.0
+"""
+
+import sys
+
+import osm2csv
+import csv2sqldb
+import validation
+import correction_rules
+from geometry import get_node_index
+
+TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags', 
+          'relations', 'relations_members', 'relations_tags']
+TABLE_FIELDS = dict(zip(TABLES, osm2csv.CSV_FIELDS))
+# Table of each field of the shaped elements
+FIELD_TABLES = dict(zip(osm2csv.SHAPED_FIELDS, TABLES))
+
+# PRAGMAs applied during the load, restored to their previous values afterwards
+BULK_PRAGMAS = [('journal_mode', 'OFF'),
+                ('synchronous', 'OFF'),
+                ('cache_size', -200000),
+                ('temp_store', 'MEMORY')]
+
+
+# ================================================== #
+#               Helper Functions                     #
+# ================================================== #
+def insert_statement(table_name, table_fields=TABLE_FIELDS):
+    """Produces the parametrised INSERT statement for a given table"""
+    
+    fields = table_fields[table_name]
+    return 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+        table_name, ', '.join(fields), ', '.join('?' * len(fields)))
+
+
+def null_positions(table_name, table_fields=TABLE_FIELDS):
+    """Positions of the fields of a table whose empty strings are inserted
+       as NULL values (csv2sqldb.CSV_NA_VALUES)"""
+    
+    na_values = csv2sqldb.CSV_NA_VALUES.get(table_name, {})
+    return [i for i, field in enumerate(table_fields[table_name]) if field in na_values]
+
+
+def null_values(record, positions):
+    """Returns the record with None instead of the empty strings found at
+       the given positions"""
+    
+    if '' not in record:
+        return record
+    
+    values = list(record)
+    for i in positions:
+        if values[i] == '':
+            values[i] = None
+    return values
+
+
+def set_pragmas(conn, pragmas):
+    """Sets the given PRAGMAs and returns their previous values"""
+    
+    previous = []
+    for name, value in pragmas:
+        previous.append((name, conn.execute('PRAGMA {0}'.format(name)).fetchone()[0]))
+        conn.execute('PRAGMA {0} = {1}'.format(name, value))
+    
+    return previous
+
+
+def create_tables(conn):
+    """Drops the OSM tables if they exist and creates them again with the
+       schemas defined in csv2sqldb"""
+    
+    sql_table_schemas = csv2sqldb.create_schemas(*TABLES)
+    for table_name in TABLES:
+        conn.execute('DROP TABLE IF EXISTS {0}'.format(table_name))
+    for table_name in TABLES:
+        csv2sqldb.create_table(conn, sql_table_schemas[table_name])
+
+
+class BatchInserter(object):
+    """Buffers rows per table and inserts them with executemany once a batch
+       is full"""
+    
+    def __init__(self, conn, batch_size, table_fields=TABLE_FIELDS):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.table_fields = table_fields
+        self.statements = {table: insert_statement(table, table_fields) 
+                           for table in TABLES}
+        self.buffers = {table: [] for table in TABLES}
+        self.rows = {table: 0 for table in TABLES}
+        self.null_positions = {table: null_positions(table, table_fields)
+                               for table in TABLES}
+    
+    def add(self, table_name, record):
+        """Buffers a record of the shaped elements, a tuple in the order of
+           the table fields"""
+        
+        positions = self.null_positions[table_name]
+        if positions:
+            record = null_values(record, positions)
+        
+        buffer = self.buffers[table_name]
+        buffer.append(record)
+        if len(buffer) >= self.batch_size:
+            self.flush(table_name)
+    
+    def add_many(self, table_name, records):
+        buffer = self.buffers[table_name]
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= self.batch_size:
+                self.flush(table_name)
+    
+    def flush(self, table_name=None):
+        for table in ([table_name] if table_name else TABLES):
+            buffer = self.buffers[table]
+            if buffer:
+                self.conn.executemany(self.statements[table], buffer)
+                self.rows[table] += len(buffer)
+                del buffer[:]
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def process_map_to_db(file_in, mapping, expected_street_types, db_path,
+                      validate=False, batch_size=10000,
+                      transaction_size=500000, pragmas=BULK_PRAGMAS,
+                      indexes=csv2sqldb.INDEXES, analyze=True, backend=None,
+                      rules=None, relations=True, geometry=False, 
+                      spatial_index=False, summary_tables=True):
+    """Iteratively process each XML element, insert it into the SQL database
+       and build the secondary indexes. validate and geometry work as in 
+       osm2csv.process_map. The relations are loaded too unless relations is
+       False. The summary tables of csv2sqldb are built unless summary_tables
+       is False, and the R*Tree spatial index if spatial_index is True.
+       Returns the number of rows inserted in each table"""
+    
+    if rules is None:
+        rules = correction_rules.CorrectionRules(mapping, expected_street_types)
+    
+    conn = csv2sqldb.create_connection(db_path)
+    previous_pragmas = set_pragmas(conn, pragmas)
+    try:
+        create_tables(conn)
+        
+        node_index = get_node_index(geometry)
+        table_fields = dict(zip(TABLES, osm2csv.csv_fields(node_index is not None)))
+        inserter = BatchInserter(conn, batch_size, table_fields)
+        validator = validation.get_validator(validate)
+        
+        conn.execute('BEGIN')
+        element_types = ('node', 'way', 'relation') if relations else ('node', 'way')
+        elements = osm2csv.get_element(file_in, element_types, backend)
+        for i, element in enumerate(elements, 1):
+            el = osm2csv.shape_element(element, mapping, expected_street_types, 
+                                       rules=rules)
+            if el:
+                if node_index is not None:
+                    osm2csv.add_geometry(element, el, node_index)
+                
+                if validator is not None:
+                    validator.validate(el)
+                
+                for field, records in el.items():
+                    if isinstance(records, tuple):
+                        inserter.add(FIELD_TABLES[field], records)
+                    else:
+                        inserter.add_many(FIELD_TABLES[field], records)
+            
+            if i % transaction_size == 0:
+                inserter.flush()
+                conn.commit()
+                conn.execute('BEGIN')
+        
+        inserter.flush()
+        conn.commit()
+        
+        if summary_tables:
+            csv2sqldb.create_summary_tables(conn)
+        if indexes:
+            csv2sqldb.create_indexes(conn, indexes, analyze)
+        if spatial_index:
+            csv2sqldb.create_spatial_index(conn)
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        set_pragmas(conn, previous_pragmas)
+        conn.close()
+    
+    return inserter.rows
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    OSM_FILE = sys.argv[1]
+    SQL_DB_PATH = sys.argv[2] if len(sys.argv) > 2 else 'LCG_map.db'
+    
+    RULES = correction_rules.load_rules()
+    
+    process_map_to_db(OSM_FILE, RULES.street_mapping, RULES.expected_street_types,
+                      SQL_DB_PATH, rules=RULES, geometry=True, 
+                      spatial_index=True)
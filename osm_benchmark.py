@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+This program benchmarks the stages of the wrangling pipeline on an OSM file,
+by default a synthetic file written by osm_generator, and saves the results
+to a JSON file so that the runs can be compared to catch throughput
+regressions.
+
+The following stages are timed:
+    - parse: read the element records (osm_reader backend)
+    - shape: parse and shape the elements with the correction rules
+    - validate: parse, shape and validate the elements with the compiled schema
+    - write_csv: the whole osm2csv.process_map conversion (with relations)
+    - audit: all the audits of audit_engine in a single pass
+    - sql_import: import of the CSV files by csv2sqldb.create_database,
+      without the summary tables
+    - summary_tables: summary tables of the tags and users, and their indexes
+    - index_build: secondary indexes and R*Tree spatial index
+The shape, validate and write_csv stages include the previous steps of the
+pipeline, the time of the step itself (own_seconds) is obtained by subtracting
+the time of the base stage (see BASE_STAGES).
+
+Each stage runs in a new worker process, so the peak resident memory (peak
+RSS, from resource.getrusage) is the one of the stage alone. The best time of
+the given number of repeats is kept. The results give the number of elements
+(or rows) processed and the elements per second of each stage.
+
+Launched in stand-alone mode, the program generates a synthetic file of the
+given size (or uses the given OSM file), runs the benchmark, writes the JSON
+results and, if a previous results file is given with --compare, reports the
+stages whose throughput dropped by more than the tolerance (the exit status
+is then 1).
+
+Python version: 3.6.0
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from contextlib import redirect_stdout
+
+import osm2csv
+import csv2sqldb
+import validation
+import audit_engine
+import osm_generator
+import correction_rules
+from pipeline_stats import peak_rss_mb
+from osm_reader import TOP_LEVEL_ELEMENTS
+
+STAGES = ('parse', 'shape', 'validate', 'write_csv', 'audit', 'sql_import',
+          'summary_tables', 'index_build')
+# Stage whose time is included in the time of each stage
+BASE_STAGES = {'shape': 'parse', 'validate': 'shape', 'write_csv': 'shape'}
+TOLERANCE = 0.1
+
+CSV_FILES = ['nodes.csv', 'nodes_tags.csv', 'ways.csv', 'ways_nodes.csv',
+             'ways_tags.csv', 'relations.csv', 'relations_members.csv',
+             'relations_tags.csv']
+DB_FILE = 'benchmark.db'
+SUMMARY_TABLES = [re.search(r'CREATE TABLE (\w+)', sql_schema).group(1)
+                  for sql_schema in csv2sqldb.SUMMARY_SCHEMAS]
+
+
+def table_rows(db_path, summary=False):
+    """Total number of rows of the imported tables of the database, or of
+       its summary tables if summary is True"""
+    
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '%rtree%' "
+            "AND name != 'import_progress'")]
+        tables = [table for table in tables if (table in SUMMARY_TABLES) == summary]
+        return sum(conn.execute('SELECT COUNT(*) FROM {0}'.format(table)).fetchone()[0]
+                   for table in tables)
+    finally:
+        conn.close()
+
+
+# ================================================== #
+#               Stages                               #
+# ================================================== #
+def stage_parse(osm_file, work_dir, rules, backend, n_elements):
+    count = 0
+    for _ in osm2csv.get_element(osm_file, TOP_LEVEL_ELEMENTS, backend):
+        count += 1
+    
+    return count
+
+
+def stage_shape(osm_file, work_dir, rules, backend, n_elements, validator=None):
+    count = 0
+    for element in osm2csv.get_element(osm_file, TOP_LEVEL_ELEMENTS, backend):
+        el = osm2csv.shape_element(element, rules.street_mapping,
+                                   rules.expected_street_types, rules=rules)
+        if validator is not None:
+            validator.validate(el)
+        count += 1
+    
+    return count
+
+
+def stage_validate(osm_file, work_dir, rules, backend, n_elements):
+    return stage_shape(osm_file, work_dir, rules, backend, n_elements,
+                       validation.ElementValidator())
+
+
+def stage_write_csv(osm_file, work_dir, rules, backend, n_elements):
+    paths = [os.path.join(work_dir, name) for name in CSV_FILES]
+    osm2csv.process_map(osm_file, rules.street_mapping, rules.expected_street_types,
+                        *paths[:5], validate=False, backend=backend, rules=rules,
+                        relations_path=paths[5], relation_members_path=paths[6],
+                        relation_tags_path=paths[7])
+    
+    return n_elements
+
+
+def stage_audit(osm_file, work_dir, rules, backend, n_elements):
+    audits = [audit_engine.TagValuesAudit('node'), audit_engine.TagValuesAudit('way'),
+              audit_engine.StreetTypesAudit(re.compile(r'\S+\b', re.IGNORECASE)),
+              audit_engine.CityNamesAudit(), audit_engine.PostcodeAudit()]
+    audit_engine.run_audits(osm_file, audits, backend)
+    
+    return n_elements
+
+
+def stage_sql_import(osm_file, work_dir, rules, backend, n_elements):
+    paths = [os.path.join(work_dir, name) for name in CSV_FILES]
+    db_path = os.path.join(work_dir, DB_FILE)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    
+    csv2sqldb.create_database(db_path, *paths[:5], indexes=None,
+                              relations_path=paths[5], relation_members_path=paths[6],
+                              relation_tags_path=paths[7], summary_tables=False)
+    
+    return table_rows(db_path)
+
+
+def stage_summary_tables(osm_file, work_dir, rules, backend, n_elements):
+    db_path = os.path.join(work_dir, DB_FILE)
+    conn = csv2sqldb.create_connection(db_path)
+    try:
+        csv2sqldb.create_summary_tables(conn)
+    finally:
+        conn.close()
+    
+    return table_rows(db_path, summary=True)
+
+
+def drop_indexes(work_dir):
+    """Drops the indexes built by a previous run of the index_build stage"""
+    
+    conn = sqlite3.connect(os.path.join(work_dir, DB_FILE))
+    try:
+        conn.execute('DROP TABLE IF EXISTS nodes_rtree')
+        conn.execute('DROP TABLE IF EXISTS ways_rtree')
+        for (index_name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                          "AND name LIKE 'idx_%'").fetchall():
+            conn.execute('DROP INDEX {0}'.format(index_name))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def stage_index_build(osm_file, work_dir, rules, backend, n_elements):
+    db_path = os.path.join(work_dir, DB_FILE)
+    conn = csv2sqldb.create_connection(db_path)
+    try:
+        csv2sqldb.create_indexes(conn)
+        csv2sqldb.create_spatial_index(conn)
+    finally:
+        conn.close()
+    
+    return table_rows(db_path)
+
+
+STAGE_FUNCTIONS = {'parse': stage_parse,
+                   'shape': stage_shape,
+                   'validate': stage_validate,
+                   'write_csv': stage_write_csv,
+                   'audit': stage_audit,
+                   'sql_import': stage_sql_import,
+                   'summary_tables': stage_summary_tables,
+                   'index_build': stage_index_build}
+
+
+def run_stage(task):
+    """Runs a stage and returns its elapsed time, number of elements and peak
+       RSS. Runs in a new worker process for each stage"""
+    
+    stage, osm_file, work_dir, rules, backend, n_elements = task
+    if stage == 'index_build':
+        drop_indexes(work_dir)
+    
+    # Silence the progress messages of the conversion programs
+    with redirect_stdout(io.StringIO()):
+        start = time.time()
+        count = STAGE_FUNCTIONS[stage](osm_file, work_dir, rules, backend, n_elements)
+        elapsed = time.time() - start
+    
+    return elapsed, count, peak_rss_mb()
+
+
+# ================================================== #
+#               Main Functions                       #
+# ================================================== #
+def run_benchmark(osm_file, stages=STAGES, repeat=1, rules=None, backend=None,
+                  work_dir=None):
+    """Runs the stages of the pipeline on the OSM file (the CSV and database
+       files are written to a temporary directory unless work_dir is given)
+       and returns the results as a dictionary, ready to be saved as JSON"""
+    
+    if rules is None:
+        rules = correction_rules.load_rules()
+    
+    tmp_dir = None
+    if work_dir is None:
+        tmp_dir = work_dir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    
+    results = {}
+    n_elements = None
+    try:
+        # The number of elements is given by the parse stage, and the import
+        # and index stages need the outputs of the previous ones
+        needed = set(stages) | {'parse'}
+        if needed & {'sql_import', 'summary_tables', 'index_build'}:
+            needed.add('write_csv')
+            needed.add('sql_import')
+        
+        for stage in STAGES:
+            if stage not in needed:
+                continue
+            
+            best = None
+            for _ in range(repeat):
+                pool = multiprocessing.Pool(1)
+                try:
+                    result = pool.apply(run_stage, ((stage, osm_file, work_dir, rules,
+                                                     backend, n_elements),))
+                finally:
+                    pool.close()
+                    pool.join()
+                if best is None or result[0] < best[0]:
+                    best = result
+            
+            elapsed, count, peak_rss = best
+            if stage == 'parse':
+                n_elements = count
+            results[stage] = {'seconds': round(elapsed, 4),
+                              'elements': count,
+                              'elements_per_s': round(count / elapsed, 1) if elapsed > 0 else None,
+                              'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None}
+        
+        for stage, base in BASE_STAGES.items():
+            if stage in results and base in results:
+                own = results[stage]['seconds'] - results[base]['seconds']
+                results[stage]['own_seconds'] = round(max(own, 0.0), 4)
+        
+        return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'osm_file': osm_file,
+                'file_size': os.path.getsize(osm_file),
+                'repeat': repeat,
+                'stages': {stage: results[stage] for stage in STAGES
+                           if stage in results and stage in stages}}
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def compare_results(previous, current, tolerance=TOLERANCE):
+    """Returns the (stage, previous rate, current rate) of the stages whose
+       elements per second dropped by more than tolerance (a fraction)"""
+    
+    regressions = []
+    for stage, result in current['stages'].items():
+        previous_rate = previous.get('stages', {}).get(stage, {}).get('elements_per_s')
+        rate = result['elements_per_s']
+        if previous_rate and rate is not None and rate < previous_rate * (1 - tolerance):
+            regressions.append((stage, previous_rate, rate))
+    
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the wrangling pipeline')
+    parser.add_argument('osm_file', nargs='?',
+                        help='OSM file (default: synthetic file written by osm_generator)')
+    parser.add_argument('-n', '--nodes', type=int, default=100000,
+                        help='number of nodes of the synthetic file')
+    parser.add_argument('-d', '--tag-density', type=float, default=0.5,
+                        help='mean number of tags per node of the synthetic file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-s', '--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('-r', '--repeat', type=int, default=1)
+    parser.add_argument('-b', '--backend', help='XML backend of osm_reader')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON results file')
+    parser.add_argument('-c', '--compare', help='previous JSON results file')
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE,
+                        help='accepted throughput drop (fraction)')
+    
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    ARGS = parse_args(sys.argv[1:])
+    
+    GENERATED_DIR = None
+    OSM_FILE = ARGS.osm_file
+    if OSM_FILE is None:
+        GENERATED_DIR = tempfile.mkdtemp(prefix='osm_benchmark_')
+        OSM_FILE = os.path.join(GENERATED_DIR, 'synthetic.osm')
+        osm_generator.generate_osm(OSM_FILE, ARGS.nodes, ARGS.tag_density, seed=ARGS.seed)
+    
+    try:
+        RESULTS = run_benchmark(OSM_FILE, ARGS.stages, ARGS.repeat, backend=ARGS.backend)
+    finally:
+        if GENERATED_DIR is not None:
+            shutil.rmtree(GENERATED_DIR, ignore_errors=True)
+    
+    if GENERATED_DIR is not None:
+        RESULTS['generator'] = {'nodes': ARGS.nodes, 'tag_density': ARGS.tag_density,
+                                'seed': ARGS.seed}
+    
+    with open(ARGS.output, 'w') as f:
+        json.dump(RESULTS, f, indent=2, sort_keys=True)
+    
+    for STAGE, RESULT in RESULTS['stages'].items():
+        print('{0}: {1:.2f} s, {2} elements/s, peak RSS {3} MB'.format(
+            STAGE, RESULT['seconds'], RESULT['elements_per_s'], RESULT['peak_rss_mb']))
+    
+    if ARGS.compare:
+        with open(ARGS.compare) as f:
+            REGRESSIONS = compare_results(json.load(f), RESULTS, ARGS.tolerance)
+        for STAGE, PREVIOUS_RATE, RATE in REGRESSIONS:
+            print('Regression in {0}: {1} -> {2} elements/s'.format(STAGE, PREVIOUS_RATE, RATE))
+        if REGRESSIONS:
+            sys.exit(1)
@@ -1,40 +1,311 @@
 # -*- coding: utf-8 -*-
 """
+The objective of this program is to generate a smaller sample of an OSM file,
+to develop and test the wrangling code before running it on the full map.
+
+The following sampling modes are available:
+    - every: keep every k-th top level element (node, way or relation)
+    - reservoir: keep a uniform random sample of a fixed number of top level
+      elements (reservoir sampling, the size of the file is not needed)
+    - bbox: keep the nodes inside a bounding box, the ways with at least one
+      of these nodes and the relations with at least one of these nodes or
+      ways as members
+
+With the complete option the sample is referentially complete: every node
+referenced by a kept way is kept too, and the relations are kept only if all
+their node and way members are kept. The ids of the kept nodes and ways are
+stored in compact bitsets (one bit per id) during a first pass over the file,
+and the elements are written in a second pass.
+
+The elements are copied byte for byte from the original file (see
+osm_reader.iter_chunks), without parsing and serialising them again, and the
+output is written through a large write buffer. The prolog of the original
+file (XML declaration, osm element and bounds) is kept.
+
+The input file can be compressed (.osm.bz2 or .osm.gz, see osm_input) or a
+PBF file (.osm.pbf, see pbf_reader), the sample is always written as an
+uncompressed XML file (.osm).
+
+The program can be used from the command line (see --help), including a
+benchmark against the previous ElementTree based implementation (--benchmark).
+
 Python version: 3.6.0
 """
 
-import sys
 import os
-import codecs
+import re
+import sys
+import time
+import random
+import argparse
 import xml.etree.cElementTree as ET
 
-OSM_FILE = sys.argv[1]
+from osm_reader import iter_elements, iter_chunks
+
+MODES = ('every', 'reservoir', 'bbox')
+BUFFER_SIZE = 1 << 20
+
+# Attributes of the raw elements, searched with regular expressions
+ID_RE = re.compile(br'\sid=["\'](-?\d+)')
+LAT_RE = re.compile(br'\slat=["\']([^"\']+)')
+LON_RE = re.compile(br'\slon=["\']([^"\']+)')
+ND_RE = re.compile(br'<nd\s+ref=["\'](-?\d+)')
+MEMBER_RE = re.compile(br'<member\s[^>]*>')
+MEMBER_TYPE_RE = re.compile(br'\stype=["\'](\w+)')
+MEMBER_REF_RE = re.compile(br'\sref=["\'](-?\d+)')
+
+
+class Bitset(object):
+    """Compact set of non-negative integer ids, using one bit per id"""
+    
+    __slots__ = ('bits',)
+    
+    def __init__(self):
+        self.bits = bytearray()
+    
+    def add(self, i):
+        if i < 0:
+            raise ValueError('negative id {0} cannot be stored in a Bitset'.format(i))
+        byte = i >> 3
+        if byte >= len(self.bits):
+            # Grow at least by doubling to limit the number of copies
+            self.bits.extend(bytes(max(byte + 1 - len(self.bits), len(self.bits))))
+        self.bits[byte] |= 1 << (i & 7)
+    
+    def __contains__(self, i):
+        byte = i >> 3
+        return 0 <= byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+
+# ================================================== #
+#               Helper Functions                     #
+# ================================================== #
+def element_id(data):
+    """Id of a raw top level element"""
+    
+    return int(ID_RE.search(data, 0, data.find(b'>') + 1).group(1))
+
+
+def node_coords(data):
+    """(lat, lon) of a raw node element"""
+    
+    head_end = data.find(b'>') + 1
+    return (float(LAT_RE.search(data, 0, head_end).group(1)),
+            float(LON_RE.search(data, 0, head_end).group(1)))
+
+
+def way_refs(data):
+    """Node references of a raw way element"""
+    
+    return [int(ref) for ref in ND_RE.findall(data)]
+
+
+def relation_members(data):
+    """(type, ref) pairs of the members of a raw relation element"""
+    
+    members = []
+    for member in MEMBER_RE.findall(data):
+        members.append((MEMBER_TYPE_RE.search(member).group(1).decode('ascii'),
+                        int(MEMBER_REF_RE.search(member).group(1))))
+    return members
+
+
+def reservoir_indices(osm_file, size, rng):
+    """Returns the positions of a uniform random sample of size top level
+       elements, chosen with reservoir sampling in a single pass"""
+    
+    reservoir = []
+    i = -1
+    for tag, _ in iter_chunks(osm_file):
+        if tag is None:
+            continue
+        i += 1
+        if i < size:
+            reservoir.append(i)
+        else:
+            j = rng.randint(0, i)
+            if j < size:
+                reservoir[j] = i
+    
+    return set(reservoir)
+
+
+def default_sample_file(osm_file, mode, k):
+    """Name of the sample file: <name>_sample_k<k>.osm for the every mode, as
+       in the previous versions, or <name>_sample_<mode>.osm otherwise"""
+    
+    name, ext = os.path.splitext(osm_file)
+    # The sample is an uncompressed XML file
+    if ext in ('.bz2', '.gz', '.pbf'):
+        name, ext = os.path.splitext(name)
+    if ext != '.osm':
+        name += ext
+    if name.endswith('_full'):
+        name = name[:-len('_full')]
+    suffix = '_sample_k' + str(k) if mode == 'every' else '_sample_' + mode
+    
+    return name + suffix + '.osm'
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def sample_osm(osm_file, sample_file, mode='every', k=2, size=1000, bbox=None,
+               complete=False, seed=None, buffer_size=BUFFER_SIZE):
+    """Writes a sample of the OSM file with the given mode (see MODES): every
+       k-th element, a reservoir of size elements or the elements inside the
+       bounding box given as (min_lat, min_lon, max_lat, max_lon). If complete
+       is True, the nodes of the kept ways are kept too. Returns the number of
+       elements written of each type"""
+    
+    if mode not in MODES:
+        raise ValueError('unknown sampling mode {0!r}, expected one of {1}'.format(mode, MODES))
+    if mode == 'bbox' and bbox is None:
+        raise ValueError('the bbox mode requires a bounding box')
+    
+    selected = None
+    if mode == 'reservoir':
+        selected = reservoir_indices(osm_file, size, random.Random(seed))
+    
+    inside_nodes = Bitset()
+    inside_ways = Bitset()
+    
+    def is_selected(i, tag, data):
+        """Selection of the i-th element, by position or by location. In the
+           bbox mode, the selected nodes and ways are stored in the bitsets"""
+        
+        if mode == 'every':
+            return i % k == 0
+        if mode == 'reservoir':
+            return i in selected
+        
+        if tag == 'node':
+            lat, lon = node_coords(data)
+            if bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]:
+                inside_nodes.add(element_id(data))
+                return True
+        elif tag == 'way':
+            if any(ref in inside_nodes for ref in way_refs(data)):
+                inside_ways.add(element_id(data))
+                return True
+        else:
+            for member_type, ref in relation_members(data):
+                if ((member_type == 'node' and ref in inside_nodes) or
+                        (member_type == 'way' and ref in inside_ways)):
+                    return True
+        return False
+    
+    kept_nodes = Bitset()
+    kept_ways = Bitset()
+    if complete:
+        # First pass: the kept nodes and ways are known before writing
+        i = -1
+        for tag, data in iter_chunks(osm_file):
+            if tag is None:
+                continue
+            i += 1
+            if tag != 'relation' and is_selected(i, tag, data):
+                if tag == 'node':
+                    kept_nodes.add(element_id(data))
+                else:
+                    kept_ways.add(element_id(data))
+                    for ref in way_refs(data):
+                        kept_nodes.add(ref)
+    
+    counts = dict.fromkeys(('node', 'way', 'relation'), 0)
+    with open(sample_file, 'wb', buffering=buffer_size) as output:
+        i = -1
+        for tag, data in iter_chunks(osm_file):
+            if tag is None:
+                output.write(data)
+                continue
+            i += 1
+            
+            if not complete:
+                keep = is_selected(i, tag, data)
+            elif tag == 'node':
+                keep = element_id(data) in kept_nodes
+            elif tag == 'way':
+                keep = element_id(data) in kept_ways
+            else:
+                keep = is_selected(i, tag, data) and all(
+                    ref in kept_nodes if member_type == 'node' else
+                    ref in kept_ways if member_type == 'way' else True
+                    for member_type, ref in relation_members(data))
+            
+            if keep:
+                output.write(data)
+                counts[tag] += 1
+    
+    return counts
 
-k = 2 # Parameter: take every k-th top level element
-SAMPLE_FILE = (os.path.splitext(OSM_FILE)[0].strip('_full') + '_sample_k' + str(k) + os.path.splitext(OSM_FILE)[-1])
 
+# ================================================== #
+#               Benchmark                            #
+# ================================================== #
+def sample_every_etree(osm_file, sample_file, k=2):
+    """Previous implementation of the every mode, parsing the elements with
+       ElementTree and serialising them with ET.tostring. Kept as the
+       reference of the benchmark"""
+    
+    with open(sample_file, 'w', encoding='utf-8') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+        
+        # Write every kth top level element
+        for i, element in enumerate(iter_elements(osm_file)):
+            if i % k == 0:
+                output.write(ET.tostring(element).decode('utf-8'))
+        
+        output.write('</osm>')
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
 
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
-    """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+def benchmark(osm_file, sample_file, k=2):
+    """Times the previous ElementTree implementation and the every mode of
+       sample_osm on the same file and returns the elapsed seconds of each"""
+    
+    results = {}
+    
+    start = time.time()
+    sample_every_etree(osm_file, sample_file, k)
+    results['etree'] = time.time() - start
+    
+    start = time.time()
+    sample_osm(osm_file, sample_file, 'every', k)
+    results['every'] = time.time() - start
+    
+    return results
 
 
-with codecs.open(SAMPLE_FILE, 'wb', encoding='utf-8') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Generate a sample of an OSM file')
+    parser.add_argument('osm_file')
+    parser.add_argument('-o', '--output', help='sample file (default: <name>_sample_...)')
+    parser.add_argument('-m', '--mode', choices=MODES, default='every')
+    parser.add_argument('-k', type=int, default=2, help='every mode: keep every k-th element')
+    parser.add_argument('-n', '--size', type=int, default=1000,
+                        help='reservoir mode: number of elements to keep')
+    parser.add_argument('--bbox', type=float, nargs=4,
+                        metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                        help='bbox mode: bounding box of the sample')
+    parser.add_argument('-c', '--complete', action='store_true',
+                        help='keep all the nodes of the kept ways')
+    parser.add_argument('--seed', type=int, help='reservoir mode: random seed')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare the every mode with the previous implementation')
+    
+    return parser.parse_args(argv)
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element).decode('utf-8'))
 
-    output.write('</osm>')
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    ARGS = parse_args(sys.argv[1:])
+    SAMPLE_FILE = ARGS.output or default_sample_file(ARGS.osm_file, ARGS.mode, ARGS.k)
+    
+    if ARGS.benchmark:
+        for name, elapsed in sorted(benchmark(ARGS.osm_file, SAMPLE_FILE, ARGS.k).items()):
+            print('{0}: {1:.2f} s'.format(name, elapsed))
+    else:
+        print(sample_osm(ARGS.osm_file, SAMPLE_FILE, ARGS.mode, ARGS.k, ARGS.size,
+                         ARGS.bbox, ARGS.complete, ARGS.seed))
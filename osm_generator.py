@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+This program generates synthetic OSM XML files of any size, used as test and
+benchmark data for the wrangling pipeline (see osm_benchmark) instead of the
+single extract of A Coruña.
+
+The files have the structure of the real extracts: nodes sorted by id with
+coordinates inside a bounding box, followed by the ways (runs of nodes, some
+of them closed) and the relations (multipolygons and routes of ways and
+nodes). The number of tags per element is configurable (tag_density, mean
+number of tags per node) and the tags exercise the corrections of osm2csv:
+    - street names with the expected Galician street types, and variants to be
+      corrected: Spanish street types (Calle, Plaza, Carretera), abbreviations
+      (Av., Avda, Avd.), missing street types and the entries of the street
+      mapping of correction_rules.json
+    - city names with the variants of A Coruña and O Temple
+    - valid and invalid postal codes
+    - name tags of streets (renamed to name:street), keys with problematic
+      characters (skipped) and keys with several colons
+
+The same seed always generates the same file.
+
+Python version: 3.6.0
+"""
+
+import sys
+import random
+import argparse
+from xml.sax.saxutils import quoteattr
+
+import correction_rules
+
+# Bounding box of the A Coruña extract
+BBOX = (43.29, -8.47, 43.40, -8.33)
+
+STREET_TYPES = ['Rúa', 'Rúa', 'Rúa', 'Avenida', 'Praza', 'Rolda', 'Travesía',
+                'Estrada', 'Paseo', 'Camiño', 'Lugar', 'Glorieta']
+# Street types to be corrected: Spanish names and abbreviations
+STREET_TYPE_VARIANTS = ['Calle', 'Plaza', 'Carretera', 'Avda', 'Av.', 'Avd.',
+                        'Avda.', 'Ronda']
+STREET_NAMES = ['Real', 'Rosalía de Castro', 'Alfonso Molina', 'Juan Flórez',
+                'Ramón y Cajal', 'Fernández Latorre', 'dos Mallos', 'de Lugo',
+                'de Pontevedra', 'do Orzán', 'de Riazor', 'San Andrés',
+                'Finisterre', 'Curros Enríquez', 'Manuel Murguía', 'Castelao',
+                'Concepción Arenal', 'Emilia Pardo Bazán', 'Ernesto Che Guevara',
+                'da Mariña', 'de María Pita', 'Cuba', 'Roi Xordo',
+                'Anxo Senra Fernández', 'Capitán Juan Varela', 'da Zapateira',
+                'dos Cantóns', 'de Santa Lucía', 'Barcelona', 'Ferrol']
+CITY_NAMES = ['A Coruña', 'A Coruña', 'A Coruña', 'Coruña', 'La Coruña',
+              'Coruña, A', 'O Temple', 'Temple, O', 'Culleredo', 'Oleiros',
+              'Arteixo', 'Cambre']
+INVALID_POSTCODES = ['1500', '15 001', 'E-15001', '150011', 'A Coruña']
+SHOPS = ['clothes', 'supermarket', 'bakery', 'hairdresser', 'convenience',
+         'shoes', 'butcher', 'books']
+SHOP_NAMES = ['Zara', 'Gadis', 'Froiz', 'Panadería Rosalía', 'Bershka',
+              'Librería Arenas', 'Pull&Bear', 'Tenda "O Recanto"']
+AMENITIES = ['cafe', 'restaurant', 'bar', 'bank', 'pharmacy', 'school',
+             'parking', 'bench', 'recycling', 'place_of_worship']
+# Keys with problematic characters are skipped by osm2csv
+ODD_KEYS = ['fixme?', 'note 2', 'addr:housenumber:extra', 'name:gl', 'old_name',
+            'source:date']
+USERS = ['Xoán', 'Antía', 'Brais', 'Uxía', 'Iago', 'Noa', 'Martiño', 'Sabela',
+         'mapper', 'osm_coruna', 'Iván Fernández', 'María López']
+
+
+class TagGenerator(object):
+    """Random tag values of the synthetic elements"""
+    
+    def __init__(self, rng, error_rate, street_mapping):
+        self.rng = rng
+        self.error_rate = error_rate
+        self.street_mapping = sorted(street_mapping)
+    
+    def street_name(self):
+        """Street name, with a variant to be corrected in error_rate of the
+           cases"""
+        
+        rng = self.rng
+        name = rng.choice(STREET_NAMES)
+        if rng.random() >= self.error_rate:
+            return rng.choice(STREET_TYPES) + ' ' + name
+        
+        variant = rng.random()
+        if variant < 0.3 and self.street_mapping:
+            return rng.choice(self.street_mapping)
+        if variant < 0.8:
+            street_type = rng.choice(STREET_TYPE_VARIANTS)
+            # Abbreviations are sometimes written without a space
+            separator = '' if street_type.endswith('.') and rng.random() < 0.3 else ' '
+            return street_type + separator + name
+        if variant < 0.9:
+            return name[0].upper() + name[1:]
+        return (rng.choice(STREET_TYPES) + ' ' + name).upper()
+    
+    def city_name(self):
+        return self.rng.choice(CITY_NAMES)
+    
+    def postcode(self):
+        if self.rng.random() < self.error_rate:
+            return self.rng.choice(INVALID_POSTCODES)
+        return '150{0:02d}'.format(self.rng.randint(1, 15))
+    
+    def housenumber(self):
+        return str(self.rng.randint(1, 150))
+    
+    def node_tag(self):
+        """(key, value) of a random node tag"""
+        
+        rng = self.rng
+        kind = rng.random()
+        if kind < 0.25:
+            return 'addr:street', self.street_name()
+        if kind < 0.35:
+            return 'addr:housenumber', self.housenumber()
+        if kind < 0.45:
+            return 'addr:city', self.city_name()
+        if kind < 0.55:
+            return 'addr:postcode', self.postcode()
+        if kind < 0.65:
+            return 'amenity', rng.choice(AMENITIES)
+        if kind < 0.72:
+            return 'shop', rng.choice(SHOPS)
+        if kind < 0.82:
+            return 'name', rng.choice(SHOP_NAMES + [self.street_name()])
+        if kind < 0.87:
+            return 'highway', rng.choice(['bus_stop', 'crossing', 'traffic_signals'])
+        if kind < 0.92:
+            return rng.choice(ODD_KEYS), rng.choice(STREET_NAMES)
+        return rng.choice(['wheelchair', 'opening_hours', 'source']), 'yes'
+    
+    def node_tags(self, tag_density):
+        """Tags of a node: the number of tags follows a geometric distribution
+           with mean tag_density, most nodes have no tags"""
+        
+        tags = {}
+        p = tag_density / (1.0 + tag_density)
+        while self.rng.random() < p:
+            key, value = self.node_tag()
+            tags[key] = value
+        return tags
+    
+    def way_tags(self, tag_density):
+        """Tags of a way: a named street or a building, plus extra node tags"""
+        
+        rng = self.rng
+        if rng.random() < 0.5:
+            tags = {'highway': rng.choice(['residential', 'primary', 'footway',
+                                           'service', 'pedestrian']),
+                    'name': self.street_name()}
+        else:
+            tags = {'building': rng.choice(['yes', 'residential', 'apartments']),
+                    'addr:street': self.street_name(),
+                    'addr:housenumber': self.housenumber()}
+        tags.update(self.node_tags(tag_density))
+        return tags
+
+
+def write_element(output, tag, attrib, tags, nds=(), members=()):
+    """Writes an element in the format of the OSM files"""
+    
+    head = ' <{0} {1}'.format(tag, ' '.join(
+        '{0}={1}'.format(k, quoteattr(v)) for k, v in attrib))
+    if not tags and not nds and not members:
+        output.write(head + '/>\n')
+        return
+    
+    output.write(head + '>\n')
+    for ref in nds:
+        output.write('  <nd ref="{0}"/>\n'.format(ref))
+    for member_type, ref, role in members:
+        output.write('  <member type="{0}" ref="{1}" role={2}/>\n'.format(
+            member_type, ref, quoteattr(role)))
+    for k, v in sorted(tags.items()):
+        output.write('  <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v)))
+    output.write(' </{0}>\n'.format(tag))
+
+
+def element_attrib(rng, element_id, changeset):
+    """Metadata attributes of an element"""
+    
+    user = rng.randrange(len(USERS) * 10)
+    timestamp = '{0}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}Z'.format(
+        rng.randint(2008, 2017), rng.randint(1, 12), rng.randint(1, 28),
+        rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+    
+    return [('id', str(element_id)), ('visible', 'true'),
+            ('version', str(rng.randint(1, 12))), ('changeset', str(changeset)),
+            ('timestamp', timestamp),
+            ('user', '{0}{1}'.format(USERS[user % len(USERS)], user // len(USERS) or '')),
+            ('uid', str(1000 + user))]
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def generate_osm(osm_file, n_nodes=10000, tag_density=0.5, ways_per_node=0.15,
+                 relations_per_way=0.02, error_rate=0.2, bbox=BBOX, seed=0,
+                 street_mapping=None):
+    """Writes a synthetic OSM file with n_nodes nodes, about n_nodes *
+       ways_per_node ways and ways * relations_per_way relations. tag_density
+       is the mean number of tags per node and error_rate the fraction of
+       street names and postal codes to be corrected. The street mapping of
+       correction_rules.json is used if none is given. Returns the number of
+       elements written of each type"""
+    
+    rng = random.Random(seed)
+    if street_mapping is None:
+        street_mapping = correction_rules.load_rules().street_mapping
+    tag_generator = TagGenerator(rng, error_rate, street_mapping)
+    
+    min_lat, min_lon, max_lat, max_lon = bbox
+    n_ways = int(n_nodes * ways_per_node)
+    n_relations = int(n_ways * relations_per_way)
+    changeset = 1000
+    
+    with open(osm_file, 'w', encoding='utf-8', buffering=1 << 20) as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm version="0.6" generator="osm_generator">\n')
+        output.write(' <bounds minlat="{0}" minlon="{1}" maxlat="{2}" maxlon="{3}"/>\n'.format(
+            min_lat, min_lon, max_lat, max_lon))
+        
+        for node_id in range(1, n_nodes + 1):
+            changeset += rng.randint(0, 3)
+            attrib = element_attrib(rng, node_id, changeset)
+            attrib.append(('lat', '{0:.7f}'.format(rng.uniform(min_lat, max_lat))))
+            attrib.append(('lon', '{0:.7f}'.format(rng.uniform(min_lon, max_lon))))
+            write_element(output, 'node', attrib, tag_generator.node_tags(tag_density))
+        
+        for way_id in range(1, n_ways + 1):
+            changeset += rng.randint(0, 3)
+            # Runs of consecutive nodes, as the nodes created together
+            length = rng.randint(2, 12)
+            start = rng.randint(1, max(n_nodes - length, 1))
+            nds = list(range(start, min(start + length, n_nodes + 1)))
+            if len(nds) > 2 and rng.random() < 0.3:
+                nds.append(nds[0])
+            write_element(output, 'way', element_attrib(rng, way_id, changeset),
+                          tag_generator.way_tags(tag_density), nds=nds)
+        
+        for relation_id in range(1, n_relations + 1):
+            changeset += rng.randint(0, 3)
+            if rng.random() < 0.5:
+                tags = {'type': 'multipolygon', 'building': 'yes'}
+                members = [('way', rng.randint(1, n_ways), 'outer')]
+                members += [('way', rng.randint(1, n_ways), 'inner')
+                            for _ in range(rng.randint(0, 2))]
+            else:
+                tags = {'type': 'route', 'route': 'bus',
+                        'name': 'Bus ' + str(rng.randint(1, 24))}
+                members = [('node', rng.randint(1, n_nodes), 'stop')
+                           for _ in range(rng.randint(1, 5))]
+                members += [('way', rng.randint(1, n_ways), '')
+                            for _ in range(rng.randint(1, 8))]
+            write_element(output, 'relation', element_attrib(rng, relation_id, changeset),
+                          tags, members=members)
+        
+        output.write('</osm>\n')
+    
+    return {'node': n_nodes, 'way': n_ways, 'relation': n_relations}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Generate a synthetic OSM file')
+    parser.add_argument('osm_file')
+    parser.add_argument('-n', '--nodes', type=int, default=10000, help='number of nodes')
+    parser.add_argument('-d', '--tag-density', type=float, default=0.5,
+                        help='mean number of tags per node')
+    parser.add_argument('-w', '--ways-per-node', type=float, default=0.15)
+    parser.add_argument('-r', '--relations-per-way', type=float, default=0.02)
+    parser.add_argument('-e', '--error-rate', type=float, default=0.2,
+                        help='fraction of street names and postal codes to correct')
+    parser.add_argument('--seed', type=int, default=0)
+    
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    ARGS = parse_args(sys.argv[1:])
+    
+    print(generate_osm(ARGS.osm_file, ARGS.nodes, ARGS.tag_density, ARGS.ways_per_node,
+                       ARGS.relations_per_way, ARGS.error_rate, seed=ARGS.seed))
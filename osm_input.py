@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+This program provides the input layer shared by all the readers of OSM files,
+so that the compressed extracts (.osm.bz2 and .osm.gz, or .osc.gz diffs) are
+read directly, without decompressing them to disk first.
+
+open_input detects the compression from the first bytes of the file and
+returns a binary file object with the decompressed data. The decompression
+runs in a background thread, which feeds the parser through a bounded queue
+of blocks, so decompressing and parsing overlap and the memory usage is
+limited to a few blocks.
+
+The bz2 files made of several streams (as written by pbzip2, which 
+compresses each block of the input as a separate stream) are split at the 
+start of each stream and the chunks of streams are decompressed in parallel
+in a pool of worker processes, keeping the decompressed chunks in file order.
+The bz2 files made of a single stream (as written by bzip2 and lbzip2) and 
+the gzip files are decompressed sequentially in the background thread.
+
+Python version: 3.6.0
+"""
+
+import io
+import re
+import bz2
+import gzip
+import queue
+import threading
+import multiprocessing
+from collections import deque
+
+READ_SIZE = 1 << 20
+BZ2_CHUNK_SIZE = 1 << 20
+MAX_BLOCKS = 16
+
+BZ2_MAGIC = b'BZh'
+GZIP_MAGIC = b'\x1f\x8b'
+# Stream header followed by the magic number of the first block
+BZ2_STREAM_START = re.compile(br'BZh[1-9]1AY&SY')
+
+
+def compression(osm_file):
+    """Returns the compression of a file ('bz2' or 'gzip'), or None"""
+    
+    with open(osm_file, 'rb') as f:
+        magic = f.read(3)
+    
+    if magic.startswith(BZ2_MAGIC):
+        return 'bz2'
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    
+    return None
+
+
+def is_compressed(osm_file):
+    return isinstance(osm_file, str) and compression(osm_file) is not None
+
+
+# ================================================== #
+#               Background Reader                    #
+# ================================================== #
+class BackgroundReader(io.RawIOBase):
+    """Read-only binary file returning the blocks of bytes produced by a
+       generator running in a background thread. At most max_blocks blocks
+       are waiting in the queue between the thread and the reader"""
+    
+    def __init__(self, blocks, max_blocks=MAX_BLOCKS):
+        super(BackgroundReader, self).__init__()
+        self.queue = queue.Queue(max_blocks)
+        self.stopped = threading.Event()
+        self.pending = memoryview(b'')
+        self.eof = False
+        self.thread = threading.Thread(target=self.produce, args=(blocks,))
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce(self, blocks):
+        end = None
+        try:
+            for block in blocks:
+                if not self.put(block):
+                    break
+        except Exception as e:
+            end = e
+        finally:
+            blocks.close()
+        self.put(end)
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, b):
+        while not self.pending and not self.eof:
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, Exception):
+                self.eof = True
+                raise item
+            else:
+                self.pending = memoryview(item)
+        
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        
+        return n
+    
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+        super(BackgroundReader, self).close()
+
+
+# ================================================== #
+#               Decompression                        #
+# ================================================== #
+def gzip_blocks(osm_file, read_size=READ_SIZE):
+    """Yield the decompressed blocks of a gzip file"""
+    
+    with gzip.open(osm_file, 'rb') as f:
+        while True:
+            block = f.read(read_size)
+            if not block:
+                break
+            yield block
+
+
+def bz2_sequential_blocks(data, f, read_size=READ_SIZE):
+    """Yield the decompressed blocks of the bz2 data, starting with the given
+       bytes and followed by the rest of the file"""
+    
+    decompressor = bz2.BZ2Decompressor()
+    while True:
+        if not data:
+            data = f.read(read_size)
+            if not data:
+                break
+        if decompressor.eof:
+            decompressor = bz2.BZ2Decompressor()
+        
+        block = decompressor.decompress(data)
+        if block:
+            yield block
+        data = decompressor.unused_data if decompressor.eof else b''
+    
+    if not decompressor.eof:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def bz2_decompress(data):
+    """Decompresses bz2 data made of complete streams, raising EOFError if
+       the last stream is truncated, like the sequential decompression"""
+    
+    try:
+        return bz2.decompress(data)
+    except ValueError as e:
+        raise EOFError(str(e))
+
+
+def last_stream_start(data):
+    """Offset of the last bz2 stream start found in the data after its first
+       byte, or None"""
+    
+    start = None
+    for m in BZ2_STREAM_START.finditer(data, 1):
+        start = m.start()
+    
+    return start
+
+
+def bz2_blocks(osm_file, processes=None, chunk_size=BZ2_CHUNK_SIZE):
+    """Yield the decompressed blocks of a bz2 file. The file is split in
+       chunks of complete streams which are decompressed in parallel by a
+       pool of processes, with at most 2 chunks per process in flight. If no
+       second stream is found, the file is decompressed sequentially"""
+    
+    if not processes or processes < 1:
+        processes = multiprocessing.cpu_count()
+    
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    in_flight = deque()
+    try:
+        with open(osm_file, 'rb') as f:
+            buf = b''
+            while True:
+                data = f.read(chunk_size)
+                buf += data
+                if data:
+                    cut = last_stream_start(buf)
+                    if cut is None:
+                        if len(buf) < 4 * chunk_size:
+                            continue
+                        # Single stream: it cannot be split
+                        while in_flight:
+                            yield in_flight.popleft().get()
+                        for block in bz2_sequential_blocks(buf, f):
+                            yield block
+                        return
+                    chunk, buf = buf[:cut], buf[cut:]
+                else:
+                    chunk, buf = buf, b''
+                
+                if chunk:
+                    if pool is not None:
+                        in_flight.append(pool.apply_async(bz2_decompress, (chunk,)))
+                    else:
+                        yield bz2_decompress(chunk)
+                
+                while in_flight and (len(in_flight) >= 2 * processes or not data):
+                    yield in_flight.popleft().get()
+                
+                if not data:
+                    break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def open_input(osm_file, processes=None, max_blocks=MAX_BLOCKS):
+    """Opens an OSM file for reading in binary mode, decompressing it in the
+       background if it is compressed with bz2 (in parallel with the given
+       number of processes) or gzip. File objects are returned unchanged"""
+    
+    if not isinstance(osm_file, str):
+        return osm_file
+    
+    kind = compression(osm_file)
+    if kind == 'bz2':
+        return BackgroundReader(bz2_blocks(osm_file, processes), max_blocks)
+    if kind == 'gzip':
+        return BackgroundReader(gzip_blocks(osm_file), max_blocks)
+    
+    return open(osm_file, 'rb')
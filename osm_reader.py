@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+This program provides the streaming readers shared by the conversion and the
+audit modules.
+
+iter_elements yields ElementTree elements. The OSM file is parsed
+incrementally with end events, so the secondary tags of each element are
+complete when it is yielded, and the root element is cleared after every top
+level element. The memory usage is therefore limited to the size of a single
+element, whatever the size of the file.
+
+iter_records yields lightweight OSMElement records (element type, attributes,
+tags, node references and relation members) instead, which can be produced
+by one of the following backends, selectable at runtime:
+    - expat: SAX-like parsing with the stdlib expat parser (default)
+    - lxml: lxml.etree.iterparse with the "fast iteration" clearing pattern,
+      only available if lxml is installed
+    - etree: stdlib ElementTree iterparse, converted to records
+If the requested backend is not available the stdlib etree backend is used.
+The default backend can also be set with the OSM_XML_BACKEND environment
+variable or with set_default_backend.
+
+All the readers accept a path or a binary file object. The paths are opened
+with osm_input.open_input, so bz2 and gzip compressed files are read directly.
+
+iter_changes reads osmChange (.osc) files, yielding each record together with
+its action (create, modify or delete).
+
+PBF files (.osm.pbf) are detected from their first bytes and read with
+pbf_reader by iter_records and iter_chunks, whatever the selected backend.
+
+iter_chunks splits the file into the raw bytes of its top level elements
+without parsing them, for the programs which copy elements unchanged (e.g.
+osm_downsampler).
+
+Launched in stand-alone mode, the program benchmarks the available backends
+on the given file and prints the number of elements read per second.
+
+Python version: 3.6.0
+"""
+
+import os
+import re
+import sys
+import time
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
+from osm_input import open_input
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+TOP_LEVEL_ELEMENTS = ('node', 'way', 'relation')
+# Opening of a top level element; a raw '<' cannot appear inside attribute values
+ELEMENT_START = re.compile(br'<(node|way|relation)[\s/>]')
+ROOT_END = b'</osm>'
+CHANGE_ACTIONS = ('create', 'modify', 'delete')
+READ_SIZE = 1 << 20
+
+DEFAULT_BACKEND = os.environ.get('OSM_XML_BACKEND', 'expat')
+
+
+class OSMElement(object):
+    """Lightweight record of a top level OSM element: element type (tag),
+       attributes, (key, value) pairs of its tags, references of its nodes
+       and (type, ref, role) triplets of its members"""
+    
+    __slots__ = ('tag', 'attrib', 'tags', 'nds', 'members')
+    
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.tags = []
+        self.nds = []
+        self.members = []
+
+
+# ================================================== #
+#               ElementTree Reader                   #
+# ================================================== #
+def iter_elements(osm_file, tags=TOP_LEVEL_ELEMENTS):
+    """Yield each top level element of the given types once it is fully
+       parsed, clearing the parsed tree after every top level element"""
+    
+    osm = open_input(osm_file)
+    try:
+        context = ET.iterparse(osm, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in TOP_LEVEL_ELEMENTS:
+                if elem.tag in tags:
+                    yield elem
+                root.clear()
+    finally:
+        if osm is not osm_file:
+            osm.close()
+
+
+def element_to_record(elem):
+    """Converts an ElementTree (or lxml) element into an OSMElement record"""
+    
+    record = OSMElement(elem.tag, dict(elem.attrib))
+    for child in elem:
+        if child.tag == 'tag':
+            record.tags.append((child.get('k'), child.get('v')))
+        elif child.tag == 'nd':
+            record.nds.append(child.get('ref'))
+        elif child.tag == 'member':
+            record.members.append((child.get('type'), child.get('ref'),
+                                   child.get('role')))
+    
+    return record
+
+
+# ================================================== #
+#               Record Backends                      #
+# ================================================== #
+def etree_records(osm_file, tags):
+    """Yield records using the stdlib ElementTree parser"""
+    
+    for elem in iter_elements(osm_file, tags):
+        yield element_to_record(elem)
+
+
+def lxml_records(osm_file, tags):
+    """Yield records using lxml iterparse, deleting the parsed siblings of
+       each element so that the tree does not grow"""
+    
+    osm = open_input(osm_file)
+    try:
+        context = lxml_etree.iterparse(osm, events=('end',), tag=TOP_LEVEL_ELEMENTS)
+        for _, elem in context:
+            if elem.tag in tags:
+                yield element_to_record(elem)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        del context
+    finally:
+        if osm is not osm_file:
+            osm.close()
+
+
+def expat_records(osm_file, tags, with_actions=False):
+    """Yield records using the expat parser, building them directly from the
+       start and end events without creating any tree. If with_actions is True
+       (osmChange files), yield (action, record) pairs instead, where action 
+       is the enclosing create, modify or delete element"""
+    
+    records = []
+    current = None
+    action = None
+    
+    def start_element(name, attrs):
+        nonlocal current, action
+        if current is None:
+            if name in TOP_LEVEL_ELEMENTS:
+                current = OSMElement(name, attrs)
+            elif name in CHANGE_ACTIONS:
+                action = name
+        elif name == 'nd':
+            current.nds.append(attrs['ref'])
+        elif name == 'tag':
+            current.tags.append((attrs['k'], attrs['v']))
+        elif name == 'member':
+            current.members.append((attrs.get('type'), attrs.get('ref'),
+                                    attrs.get('role')))
+    
+    def end_element(name):
+        nonlocal current
+        if current is not None and name == current.tag:
+            if name in tags:
+                records.append((action, current) if with_actions else current)
+            current = None
+    
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    
+    osm = open_input(osm_file)
+    try:
+        while True:
+            data = osm.read(READ_SIZE)
+            parser.Parse(data, not data)
+            for record in records:
+                yield record
+            del records[:]
+            if not data:
+                break
+    finally:
+        if osm is not osm_file:
+            osm.close()
+
+
+BACKENDS = {'etree': etree_records,
+            'lxml': lxml_records,
+            'expat': expat_records}
+
+
+def available_backends():
+    """Returns the names of the backends that can be used"""
+    
+    return [name for name in sorted(BACKENDS)
+            if name != 'lxml' or lxml_etree is not None]
+
+
+def set_default_backend(name):
+    """Sets the backend used when none is given to iter_records"""
+    
+    global DEFAULT_BACKEND
+    DEFAULT_BACKEND = name
+
+
+def get_backend(name=None):
+    """Returns the record reader of the given backend, falling back to the
+       stdlib etree backend if it is not available"""
+    
+    name = name or DEFAULT_BACKEND
+    if name not in available_backends():
+        name = 'etree'
+    
+    return BACKENDS[name]
+
+
+def iter_records(osm_file, tags=TOP_LEVEL_ELEMENTS, backend=None):
+    """Yield an OSMElement record for each top level element of the given
+       types, using the selected backend. PBF files are read with
+       pbf_reader whatever the backend"""
+    
+    # Imported here, pbf_reader depends on this module
+    import pbf_reader
+    if pbf_reader.is_pbf(osm_file):
+        return pbf_reader.pbf_records(osm_file, tags)
+    
+    return get_backend(backend)(osm_file, tags)
+
+
+def iter_changes(osc_file, tags=TOP_LEVEL_ELEMENTS):
+    """Yield an (action, OSMElement) pair for each element of the given types
+       found in an osmChange file, in file order"""
+    
+    return expat_records(osc_file, tags, with_actions=True)
+
+
+# ================================================== #
+#               Raw Element Chunks                   #
+# ================================================== #
+def record_to_xml(record):
+    """Serialises a record as the XML of its element, as written in the OSM
+       files (one child element per line)"""
+    
+    attrib = ''.join(' {0}={1}'.format(k, quoteattr(v)) for k, v in record.attrib.items())
+    children = ['  <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v))
+                for k, v in record.tags]
+    children += ['  <nd ref="{0}"/>\n'.format(ref) for ref in record.nds]
+    children += ['  <member type="{0}" ref="{1}" role={2}/>\n'.format(
+        member_type, ref, quoteattr(role)) for member_type, ref, role in record.members]
+    
+    if not children:
+        return ' <{0}{1}/>\n'.format(record.tag, attrib).encode('utf-8')
+    
+    return ' <{0}{1}>\n{2} </{0}>\n'.format(
+        record.tag, attrib, ''.join(children)).encode('utf-8')
+
+
+def pbf_chunks(pbf_file):
+    """Yield the (tag, data) pairs of iter_chunks for a PBF file, with the
+       records serialised as XML"""
+    
+    import pbf_reader
+    yield None, b'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="pbf_reader">\n'
+    for record in pbf_reader.pbf_records(pbf_file):
+        yield record.tag, record_to_xml(record)
+    yield None, ROOT_END + b'\n'
+
+
+def iter_chunks(osm_file, read_size=READ_SIZE):
+    """Yield (tag, data) pairs with the raw bytes of the file: first the 
+       prolog (tag None), then each top level element followed by the 
+       whitespace up to the next one, and finally the closing of the root 
+       element (tag None). Joining all the data gives back the file. The
+       elements of PBF files are serialised as XML (see pbf_chunks)"""
+    
+    import pbf_reader
+    if pbf_reader.is_pbf(osm_file):
+        for chunk in pbf_chunks(osm_file):
+            yield chunk
+        return
+    
+    osm = open_input(osm_file)
+    try:
+        buf = b''
+        start = None
+        tag = None
+        search_from = 0
+        eof = False
+        while True:
+            m = ELEMENT_START.search(buf, search_from)
+            if m:
+                if start is None:
+                    yield None, buf[:m.start()]
+                else:
+                    yield tag, buf[start:m.start()]
+                tag = m.group(1).decode('ascii')
+                start = m.start()
+                search_from = start + 1
+                continue
+            
+            if eof:
+                break
+            
+            data = osm.read(read_size)
+            if not data:
+                eof = True
+                continue
+            
+            # Keep only the bytes of the current element
+            if start:
+                buf = buf[start:]
+                search_from -= start
+                start = 0
+            # An element opening may be split between two reads
+            search_from = max(search_from, len(buf) - 16)
+            buf += data
+        
+        if start is None:
+            yield None, buf
+            return
+        
+        end = buf.rfind(ROOT_END)
+        if end == -1:
+            end = len(buf)
+        yield tag, buf[start:end]
+        yield None, buf[end:]
+    finally:
+        if osm is not osm_file:
+            osm.close()
+
+
+# ================================================== #
+#               Benchmark                            #
+# ================================================== #
+def benchmark(osm_file, backends=None):
+    """Reads the whole file with each backend and returns the number of
+       elements per second obtained by each one"""
+    
+    results = {}
+    for name in backends or available_backends():
+        start = time.time()
+        n_elements = 0
+        for _ in BACKENDS[name](osm_file, TOP_LEVEL_ELEMENTS):
+            n_elements += 1
+        results[name] = n_elements / (time.time() - start)
+    
+    return results
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    OSM_FILE = sys.argv[1]
+    
+    for backend_name, rate in sorted(benchmark(OSM_FILE).items(),
+                                     key=lambda item: item[1], reverse=True):
+        print('{0}: {1:.0f} elements/s'.format(backend_name, rate))
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+This program provides a pure Python reader of the OSM PBF format (the binary
+format of the OSM extracts, around 10 times smaller than the XML files).
+
+The file is a sequence of blobs (BlobHeader and Blob messages), each one
+holding a zlib (or lzma) compressed PrimitiveBlock with a string table and
+groups of nodes, dense nodes, ways and relations. The protocol buffer
+messages are decoded with a minimal wire format parser, so no protobuf
+library is required. The data blobs are decompressed and decoded in a pool
+of worker processes, with a bounded number of blobs in flight, and the
+records are yielded in file order.
+
+The records are the same osm_reader.OSMElement records produced by the XML
+backends, with the attributes given as strings formatted as in the XML files
+of the OSM API (coordinates with 7 decimals and timestamps in ISO 8601
+format), so they can be used by shape_element and the audits unchanged.
+osm_reader.iter_records reads the PBF files with this reader whatever the
+selected XML backend.
+
+Python version: 3.6.0
+"""
+
+import sys
+import time
+import zlib
+import struct
+import multiprocessing
+from collections import deque
+from itertools import accumulate
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from osm_reader import OSMElement, TOP_LEVEL_ELEMENTS
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+MAX_BLOB_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+
+
+# ================================================== #
+#               Protocol Buffers                     #
+# ================================================== #
+def read_varint(buf, pos):
+    """Decodes the varint starting at pos and returns it with the next position"""
+    
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(buf):
+    """Yield the (field number, value) pairs of a protocol buffer message. The
+       value is an integer for the varint fields and bytes otherwise"""
+    
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('unsupported protocol buffer wire type {0}'.format(wire_type))
+        yield key >> 3, value
+
+
+def signed(value):
+    """Signed value of an int32/int64 field (two's complement on 64 bits)"""
+    
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def zigzag(value):
+    """Signed value of a sint32/sint64 field"""
+    
+    return (value >> 1) ^ -(value & 1)
+
+
+def unpack_varints(value):
+    """Values of a repeated varint field, packed (bytes) or not (integer)"""
+    
+    if isinstance(value, int):
+        return [value]
+    
+    values = []
+    pos = 0
+    end = len(value)
+    while pos < end:
+        v, pos = read_varint(value, pos)
+        values.append(v)
+    return values
+
+
+def unpack_sints(value):
+    return [zigzag(v) for v in unpack_varints(value)]
+
+
+def unpack_deltas(value):
+    """Values of a packed sint field encoded as deltas"""
+    
+    return list(accumulate(unpack_sints(value)))
+
+
+# ================================================== #
+#               Attribute Formatting                 #
+# ================================================== #
+def format_coord(nanodegrees):
+    """Coordinate in degrees given in nanodegrees, formatted with 7 decimals"""
+    
+    units = (abs(nanodegrees) + 50) // 100
+    sign = '-' if nanodegrees < 0 and units else ''
+    
+    return '{0}{1}.{2:07d}'.format(sign, *divmod(units, 10 ** 7))
+
+
+def format_timestamp(milliseconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(milliseconds // 1000))
+
+
+class Block(object):
+    """Context of a PrimitiveBlock: string table, granularities and offsets"""
+    
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for field, value in iter_fields(data):
+            if field == 1:
+                self.strings = [s.decode('utf-8') for f, s in iter_fields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+    
+    def lat(self, lat):
+        return format_coord(self.lat_offset + self.granularity * lat)
+    
+    def lon(self, lon):
+        return format_coord(self.lon_offset + self.granularity * lon)
+    
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+    
+    def info(self, data, attrib):
+        """Adds the attributes of an Info message"""
+        
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['version'] = str(value)
+            elif field == 2:
+                attrib['timestamp'] = format_timestamp(signed(value) * self.date_granularity)
+            elif field == 3:
+                attrib['changeset'] = str(signed(value))
+            elif field == 4:
+                attrib['uid'] = str(signed(value))
+            elif field == 5:
+                attrib['user'] = self.strings[value]
+            elif field == 6:
+                attrib['visible'] = 'true' if value else 'false'
+
+
+# ================================================== #
+#               Element Decoding                     #
+# ================================================== #
+def decode_node(block, data):
+    attrib = {}
+    keys, vals = [], []
+    lat = lon = 0
+    for field, value in iter_fields(data):
+        if field == 1:
+            attrib['id'] = str(zigzag(value))
+        elif field == 2:
+            keys.extend(unpack_varints(value))
+        elif field == 3:
+            vals.extend(unpack_varints(value))
+        elif field == 4:
+            block.info(value, attrib)
+        elif field == 8:
+            lat = zigzag(value)
+        elif field == 9:
+            lon = zigzag(value)
+    attrib['lat'] = block.lat(lat)
+    attrib['lon'] = block.lon(lon)
+    
+    record = OSMElement('node', attrib)
+    record.tags = block.tags(keys, vals)
+    return record
+
+
+def decode_dense_nodes(block, data):
+    ids, lats, lons, keys_vals = [], [], [], []
+    infos = {}
+    for field, value in iter_fields(data):
+        if field == 1:
+            ids = unpack_deltas(value)
+        elif field == 5:
+            for info_field, info_value in iter_fields(value):
+                infos[info_field] = info_value
+        elif field == 8:
+            lats = unpack_deltas(value)
+        elif field == 9:
+            lons = unpack_deltas(value)
+        elif field == 10:
+            keys_vals = unpack_varints(value)
+    
+    versions = unpack_varints(infos[1]) if 1 in infos else None
+    timestamps = unpack_deltas(infos[2]) if 2 in infos else None
+    changesets = unpack_deltas(infos[3]) if 3 in infos else None
+    uids = unpack_deltas(infos[4]) if 4 in infos else None
+    user_sids = unpack_deltas(infos[5]) if 5 in infos else None
+    visibles = unpack_varints(infos[6]) if 6 in infos else None
+    
+    strings = block.strings
+    records = []
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {'id': str(node_id)}
+        if visibles is not None:
+            attrib['visible'] = 'true' if visibles[i] else 'false'
+        if versions is not None:
+            attrib['version'] = str(versions[i])
+        if changesets is not None:
+            attrib['changeset'] = str(changesets[i])
+        if timestamps is not None:
+            attrib['timestamp'] = format_timestamp(timestamps[i] * block.date_granularity)
+        if user_sids is not None:
+            attrib['user'] = strings[user_sids[i]]
+        if uids is not None:
+            attrib['uid'] = str(uids[i])
+        attrib['lat'] = block.lat(lats[i])
+        attrib['lon'] = block.lon(lons[i])
+        
+        record = OSMElement('node', attrib)
+        # Tags of all the nodes given as key, value pairs ended by a 0
+        while kv < len(keys_vals) and keys_vals[kv]:
+            record.tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+            kv += 2
+        kv += 1
+        records.append(record)
+    
+    return records
+
+
+def decode_way(block, data):
+    attrib = {}
+    keys, vals, refs = [], [], []
+    for field, value in iter_fields(data):
+        if field == 1:
+            attrib['id'] = str(signed(value))
+        elif field == 2:
+            keys.extend(unpack_varints(value))
+        elif field == 3:
+            vals.extend(unpack_varints(value))
+        elif field == 4:
+            block.info(value, attrib)
+        elif field == 8:
+            refs = unpack_deltas(value)
+    
+    record = OSMElement('way', attrib)
+    record.tags = block.tags(keys, vals)
+    record.nds = [str(ref) for ref in refs]
+    return record
+
+
+def decode_relation(block, data):
+    attrib = {}
+    keys, vals, roles, memids, types = [], [], [], [], []
+    for field, value in iter_fields(data):
+        if field == 1:
+            attrib['id'] = str(signed(value))
+        elif field == 2:
+            keys.extend(unpack_varints(value))
+        elif field == 3:
+            vals.extend(unpack_varints(value))
+        elif field == 4:
+            block.info(value, attrib)
+        elif field == 8:
+            roles.extend(unpack_varints(value))
+        elif field == 9:
+            memids = unpack_deltas(value)
+        elif field == 10:
+            types.extend(unpack_varints(value))
+    
+    record = OSMElement('relation', attrib)
+    record.tags = block.tags(keys, vals)
+    strings = block.strings
+    record.members = [(MEMBER_TYPES[t], str(ref), strings[role])
+                      for t, ref, role in zip(types, memids, roles)]
+    return record
+
+
+def blob_data(blob):
+    """Uncompressed data of a Blob message"""
+    
+    for field, value in iter_fields(blob):
+        if field == 1:
+            return value
+        elif field == 3:
+            return zlib.decompress(value)
+        elif field == 4:
+            if lzma is None:
+                raise ValueError('lzma is required to read this PBF file')
+            return lzma.decompress(value)
+        elif field in (5, 6, 7):
+            raise ValueError('unsupported PBF blob compression (field {0})'.format(field))
+    
+    return b''
+
+
+def decode_blob(blob, tags=TOP_LEVEL_ELEMENTS):
+    """Decodes an OSMData blob into the list of its records of the given
+       types. Runs in the worker processes of pbf_records"""
+    
+    block = Block(blob_data(blob))
+    records = []
+    for group in block.groups:
+        for field, value in iter_fields(group):
+            if field == 2:
+                if 'node' in tags:
+                    records.extend(decode_dense_nodes(block, value))
+            elif field == 1:
+                if 'node' in tags:
+                    records.append(decode_node(block, value))
+            elif field == 3:
+                if 'way' in tags:
+                    records.append(decode_way(block, value))
+            elif field == 4:
+                if 'relation' in tags:
+                    records.append(decode_relation(block, value))
+    
+    return records
+
+
+# ================================================== #
+#               File Reading                         #
+# ================================================== #
+def iter_blobs(osm):
+    """Yield the (type, blob) pairs of a PBF file handle"""
+    
+    while True:
+        size = osm.read(4)
+        if not size:
+            return
+        header_size = struct.unpack('>I', size)[0]
+        if header_size > MAX_BLOB_HEADER_SIZE:
+            raise ValueError('invalid PBF blob header size {0}'.format(header_size))
+        
+        blob_type = None
+        blob_size = 0
+        for field, value in iter_fields(osm.read(header_size)):
+            if field == 1:
+                blob_type = value.decode('utf-8')
+            elif field == 3:
+                blob_size = value
+        if blob_size > MAX_BLOB_SIZE:
+            raise ValueError('invalid PBF blob size {0}'.format(blob_size))
+        
+        yield blob_type, osm.read(blob_size)
+
+
+def is_pbf(osm_file):
+    """Returns True if the file starts with the header blob of a PBF file"""
+    
+    if not isinstance(osm_file, str):
+        return False
+    
+    with open(osm_file, 'rb') as osm:
+        start = osm.read(4 + 16)
+    if len(start) < 20:
+        return False
+    
+    return start[6:6 + 9] == b'OSMHeader' or start[6:6 + 7] == b'OSMData'
+
+
+def pbf_records(osm_file, tags=TOP_LEVEL_ELEMENTS, processes=None):
+    """Yield an OSMElement record for each element of the given types of the
+       PBF file. The blobs are decoded by a pool of processes (in this
+       process if processes is 1), with at most 2 blobs per process in
+       flight"""
+    
+    if not processes or processes < 1:
+        processes = multiprocessing.cpu_count()
+    
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    in_flight = deque()
+    try:
+        with open(osm_file, 'rb') as osm:
+            for blob_type, blob in iter_blobs(osm):
+                if blob_type != 'OSMData':
+                    continue
+                
+                if pool is None:
+                    for record in decode_blob(blob, tags):
+                        yield record
+                    continue
+                
+                in_flight.append(pool.apply_async(decode_blob, (blob, tags)))
+                while len(in_flight) >= 2 * processes:
+                    for record in in_flight.popleft().get():
+                        yield record
+        
+        while in_flight:
+            for record in in_flight.popleft().get():
+                yield record
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+if __name__ == '__main__':
+    """Defines the required variables if the code is launched in stand-alone mode"""
+    
+    PBF_FILE = sys.argv[1]
+    
+    start = time.time()
+    n_elements = sum(1 for _ in pbf_records(PBF_FILE))
+    print('{0} elements in {1:.2f} s'.format(n_elements, time.time() - start))
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+This program provides the optional instrumentation of the conversion and
+import programs (stats argument of osm2csv.process_map and
+csv2sqldb.create_database), to find where the time goes on large extracts
+and how far along a long run is.
+
+PipelineStats keeps:
+    - the cumulative time of each stage: parse (reading the element records),
+      shape (shape_element, mostly get_tags), geometry, validate and write
+      (csv.writer) for process_map; import, summary_tables, indexes and 
+      spatial_index for create_database
+    - counters: elements of each type, tags, way nodes, relation members,
+      skipped postal codes and rewritten street names, and the rows imported
+      into each table
+    - the peak resident memory of the process (resource.getrusage), sampled
+      at each progress report and after each imported table, and at the end
+      of each shard in the worker processes of a parallel conversion
+Every progress_every elements a progress line is reported with the elements
+per second and, when the size of the input is known (uncompressed XML files),
+the fraction of the input consumed and the estimated time left. In a 
+parallel conversion the stats of each shard are merged once it is done and
+the progress is reported then.
+
+One stage can be profiled with cProfile (profile_stage), only while that
+stage runs, and the profile is written to profile_file by dump_profile. In a
+parallel conversion the stage is profiled in the worker processes, and their
+profiles are merged with the stats of the shards.
+
+The runs without stats skip the timers (see osm2csv.write_elements), the
+other programs use timers doing nothing instead (NULL_TIMER).
+
+Python version: 3.6.0
+"""
+
+import sys
+import time
+import pstats
+import cProfile
+from collections import Counter, defaultdict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROGRESS_EVERY = 100000
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process in MB, or None if the resource
+       module is not available"""
+    
+    if resource is None:
+        return None
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+class ProfileData(object):
+    """Statistics of a cProfile profiler (Profile.stats), as loaded by 
+       pstats.Stats"""
+    
+    def __init__(self, stats):
+        self.stats = stats
+    
+    def create_stats(self):
+        pass
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class StageTimer(object):
+    """Context manager adding the time spent inside it to a stage, and
+       profiling it if it is the profiled stage"""
+    
+    __slots__ = ('timers', 'stage', 'profiler', 'start')
+    
+    def __init__(self, timers, stage, profiler=None):
+        self.timers = timers
+        self.stage = stage
+        self.profiler = profiler
+        self.start = None
+    
+    def __enter__(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+        self.start = time.perf_counter()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timers[self.stage] += time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+
+
+class NullTimer(object):
+    """Context manager doing nothing, used when there are no stats"""
+    
+    def __enter__(self):
+        pass
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class PipelineStats(object):
+    """Per-stage cumulative timers, counters, progress reports and peak
+       memory of a conversion or import run"""
+    
+    def __init__(self, progress_every=PROGRESS_EVERY, report=print,
+                 profile_stage=None, profile_file=None):
+        self.progress_every = progress_every
+        self.report = report
+        self.profile_stage = profile_stage
+        self.profile_file = profile_file
+        self.profiler = cProfile.Profile() if profile_stage else None
+        # Profiles of the stage in the merged runs (worker processes)
+        self.profiles = []
+        self.timers = defaultdict(float)
+        self.counters = Counter()
+        self.peak_rss_mb = None
+        self.total_bytes = None
+        self.bytes_read = None
+        self.started = time.time()
+        self.elapsed = 0.0
+        self.stage_timers = {}
+    
+    def timer(self, stage):
+        """Returns the timer of a stage, to be used as a context manager"""
+        
+        try:
+            return self.stage_timers[stage]
+        except KeyError:
+            profiler = self.profiler if stage == self.profile_stage else None
+            stage_timer = self.stage_timers[stage] = StageTimer(self.timers, stage, profiler)
+            return stage_timer
+    
+    def set_input(self, total_bytes, bytes_read):
+        """Sets the size of the input and a function returning the number of
+           bytes consumed, used to report the progress and the time left"""
+        
+        self.total_bytes = total_bytes
+        self.bytes_read = bytes_read
+    
+    def count_element(self, element, el):
+        """Updates the counters with an element record and its shaped element"""
+        
+        counters = self.counters
+        counters['elements'] += 1
+        counters[element.tag + 's'] += 1
+        
+        tags = el.get(element.tag + '_tags', ())
+        counters['tags'] += len(tags)
+        if element.tag == 'way':
+            counters['way_nodes'] += len(el['way_nodes'])
+        elif element.tag == 'relation':
+            counters['relation_members'] += len(el['relation_members'])
+        
+        street_name = None
+        for tag_key, tag_value in element.tags:
+            if tag_key == 'addr:postcode' and len(tag_value) != 5:
+                counters['skipped_postcodes'] += 1
+            elif tag_key == 'addr:street':
+                street_name = tag_value
+        if street_name is not None:
+            for tag in tags:
+                if tag.key == 'street' and tag.type == 'addr' and tag.value != street_name:
+                    counters['rewritten_street_names'] += 1
+        
+        if self.progress_every and not counters['elements'] % self.progress_every:
+            self.progress()
+    
+    def sample_memory(self):
+        rss = peak_rss_mb()
+        if rss is not None:
+            self.peak_rss_mb = max(rss, self.peak_rss_mb or 0)
+    
+    def progress(self):
+        """Reports the number of elements, the elements per second and, if the
+           input size is known, the fraction consumed and the time left"""
+        
+        self.sample_memory()
+        if self.report is None:
+            return
+        
+        elapsed = time.time() - self.started
+        elements = self.counters['elements']
+        line = '{0} elements, {1:.0f} elements/s'.format(
+            elements, elements / elapsed if elapsed > 0 else 0)
+        
+        if self.total_bytes and self.bytes_read is not None:
+            fraction = min(self.bytes_read() / float(self.total_bytes), 1.0)
+            line += ', {0:.1%} of the input'.format(fraction)
+            if fraction > 0:
+                line += ', ETA {0}'.format(format_duration(elapsed * (1 - fraction) / fraction))
+        
+        if self.peak_rss_mb is not None:
+            line += ', peak RSS {0:.0f} MB'.format(self.peak_rss_mb)
+        
+        self.report(line)
+    
+    def finish(self):
+        """Stops the run: records the total time and the peak memory, and
+           writes the profile if required"""
+        
+        self.elapsed = time.time() - self.started
+        self.sample_memory()
+        if self.profiler is not None and self.profile_file:
+            self.dump_profile(self.profile_file)
+    
+    def profile_data(self):
+        """Statistics of the profiled stage in this run and in the merged
+           runs"""
+        
+        profiles = list(self.profiles)
+        if self.profiler is not None:
+            self.profiler.create_stats()
+            if self.profiler.stats:
+                profiles.append(self.profiler.stats)
+        
+        return profiles
+    
+    def dump_profile(self, profile_file):
+        """Writes the cProfile statistics of the profiled stage, to be read
+           with pstats"""
+        
+        profiles = self.profile_data()
+        if not profiles:
+            return
+        
+        pstats.Stats(*[ProfileData(stats) for stats in profiles]).dump_stats(profile_file)
+    
+    def merge(self, other):
+        """Adds the timers and counters of another run, e.g. of the shards
+           of osm2csv.process_map_parallel, and keeps the largest peak memory"""
+        
+        for stage, seconds in other.timers.items():
+            self.timers[stage] += seconds
+        self.counters.update(other.counters)
+        self.profiles.extend(other.profiles)
+        if other.peak_rss_mb is not None:
+            self.peak_rss_mb = max(other.peak_rss_mb, self.peak_rss_mb or 0)
+    
+    def spawn(self):
+        """Returns new stats without progress reports, profiling the same 
+           stage, used by the worker processes (their progress is reported by
+           the parent process once they are merged)"""
+        
+        return PipelineStats(progress_every=0, report=None, 
+                             profile_stage=self.profile_stage)
+    
+    def as_dict(self):
+        """Returns the stats as a dictionary, ready to be saved as JSON"""
+        
+        elements = self.counters['elements']
+        return {'elapsed': round(self.elapsed, 4),
+                'elements_per_s': (round(elements / self.elapsed, 1)
+                                   if elements and self.elapsed > 0 else None),
+                'stages': {stage: round(seconds, 4) for stage, seconds in self.timers.items()},
+                'counters': dict(self.counters),
+                'peak_rss_mb': round(self.peak_rss_mb, 1) if self.peak_rss_mb is not None else None}
+    
+    def summary(self):
+        if self.counters['elements']:
+            lines = ['{0} elements in {1:.2f} s'.format(self.counters['elements'], self.elapsed)]
+        else:
+            lines = ['Finished in {0:.2f} s'.format(self.elapsed)]
+        total = sum(self.timers.values())
+        for stage, seconds in sorted(self.timers.items(), key=lambda item: -item[1]):
+            lines.append('    {0}: {1:.2f} s ({2:.0%})'.format(
+                stage, seconds, seconds / total if total > 0 else 0))
+        for name, count in sorted(self.counters.items()):
+            lines.append('    {0}: {1}'.format(name, count))
+        if self.peak_rss_mb is not None:
+            lines.append('    peak RSS: {0:.0f} MB'.format(self.peak_rss_mb))
+        return '\n'.join(lines)
+    
+    def __getstate__(self):
+        # The profiler, the report function and the timers cannot be pickled,
+        # the statistics of the profiler are kept instead
+        state = self.__dict__.copy()
+        state.update(profiler=None, report=None, bytes_read=None, stage_timers={},
+                     profiles=self.profile_data())
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.profiler = cProfile.Profile() if self.profile_stage else None
+
+
+def get_stats(stats):
+    """Returns the stats to use for the stats argument of process_map and
+       create_database: None if False, new stats printing the progress if
+       True, or the given stats"""
+    
+    if stats is True:
+        return PipelineStats()
+    if not stats:
+        return None
+    
+    return stats
+
+
+def stage_timer(stats, stage):
+    """Returns the timer of a stage of the stats, or a timer doing nothing if
+       there are no stats"""
+    
+    if stats is None:
+        return NULL_TIMER
+    
+    return stats.timer(stage)
@@ -33,7 +33,14 @@ schema = {
             'uid': {'required': True, 'type': 'integer', 'coerce': int},
             'version': {'required': True, 'type': 'string'},
             'changeset': {'required': True, 'type': 'integer', 'coerce': int},
-            'timestamp': {'required': True, 'type': 'string'}
+            'timestamp': {'required': True, 'type': 'string'},
+            'min_lat': {'type': 'float', 'coerce': float, 'nullable': True},
+            'min_lon': {'type': 'float', 'coerce': float, 'nullable': True},
+            'max_lat': {'type': 'float', 'coerce': float, 'nullable': True},
+            'max_lon': {'type': 'float', 'coerce': float, 'nullable': True},
+            'centroid_lat': {'type': 'float', 'coerce': float, 'nullable': True},
+            'centroid_lon': {'type': 'float', 'coerce': float, 'nullable': True},
+            'length': {'type': 'float', 'coerce': float, 'nullable': True}
         }
     },
     'way_nodes': {
@@ -58,5 +65,41 @@ schema = {
                 'type': {'required': True, 'type': 'string'}
             }
         }
+    },
+    'relation': {
+        'type': 'dict',
+        'schema': {
+            'id': {'required': True, 'type': 'integer', 'coerce': int},
+            'user': {'required': True, 'type': 'string'},
+            'uid': {'required': True, 'type': 'integer', 'coerce': int},
+            'version': {'required': True, 'type': 'string'},
+            'changeset': {'required': True, 'type': 'integer', 'coerce': int},
+            'timestamp': {'required': True, 'type': 'string'}
+        }
+    },
+    'relation_members': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'member_id': {'required': True, 'type': 'integer', 'coerce': int},
+                'member_type': {'required': True, 'type': 'string'},
+                'role': {'required': True, 'type': 'string'},
+                'position': {'required': True, 'type': 'integer', 'coerce': int}
+            }
+        }
+    },
+    'relation_tags': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'key': {'required': True, 'type': 'string'},
+                'value': {'required': True, 'type': 'string'},
+                'type': {'required': True, 'type': 'string'}
+            }
+        }
     }
 }
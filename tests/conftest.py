@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Configuration of the tests: the modules of the project are imported from
+the parent directory, and the sample OSM files are given in tests/data
+(written by pbf_writer).
+
+Python version: 3.6.0
+"""
+
+import os
+import sys
+import sqlite3
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import osm2csv
+import correction_rules
+
+DATA_DIR = os.path.join(TESTS_DIR, 'data')
+CSV_NAMES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags',
+             'relations', 'relations_members', 'relations_tags']
+
+
+def data_path(name):
+    return os.path.join(DATA_DIR, name)
+
+
+@pytest.fixture(scope='session')
+def rules():
+    return correction_rules.load_rules()
+
+
+@pytest.fixture
+def convert(rules, tmp_path):
+    """Returns a function converting an OSM file with osm2csv.process_map
+       into the csv files of a directory, and returning their paths"""
+    
+    def convert_file(osm_file, name='out', **kwargs):
+        out_dir = tmp_path / name
+        out_dir.mkdir(exist_ok=True)
+        paths = [str(out_dir / '{0}.csv'.format(csv_name)) for csv_name in CSV_NAMES]
+        osm2csv.process_map(osm_file, rules.street_mapping, rules.expected_street_types,
+                            *paths[:5], validate=kwargs.pop('validate', False),
+                            rules=rules, relations_path=paths[5],
+                            relation_members_path=paths[6], 
+                            relation_tags_path=paths[7], **kwargs)
+        return paths
+    
+    return convert_file
+
+
+def read_bytes(paths):
+    """Contents of a list of files"""
+    
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return contents
+
+
+def read_tables(db_path):
+    """Sorted rows of each table of a database, including the R*Tree tables
+       but not their internal tables nor import_progress"""
+    
+    conn = sqlite3.connect(db_path)
+    try:
+        names = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' AND name != 'import_progress'")]
+        rtree_tables = [name for name in names if name.endswith('_rtree')]
+        names = [name for name in names 
+                 if not any(name.startswith(rtree + '_') for rtree in rtree_tables)]
+        return {name: sorted(conn.execute('SELECT * FROM {0}'.format(name)), key=repr)
+                for name in names}
+    finally:
+        conn.close()
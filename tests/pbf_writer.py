@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+This program writes the OSM PBF files used by the tests of pbf_reader, from
+OSM XML files, with a minimal protocol buffers encoder written independently
+of the reader: a header blob and data blobs of block_size elements, with the
+nodes as dense nodes, and with or without the metadata of the elements.
+
+Run as a script, it writes the fixtures of tests/data from a small synthetic
+OSM file (osm_generator): sample.osm and sample.osm.pbf, and their versions
+without metadata, sample_nometa.osm and sample_nometa.osm.pbf.
+
+Python version: 3.6.0
+"""
+
+import os
+import re
+import sys
+import time
+import zlib
+import struct
+import calendar
+import xml.etree.ElementTree as ET
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+MEMBER_TYPES = {'node': 0, 'way': 1, 'relation': 2}
+METADATA_ATTRIBUTES = ('visible', 'version', 'changeset', 'timestamp', 'user', 'uid')
+
+
+# ================================================== #
+#               Protocol Buffers                     #
+# ================================================== #
+def varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def key(field, wire_type):
+    return varint(field << 3 | wire_type)
+
+
+def int_field(field, value):
+    return key(field, 0) + varint(value)
+
+
+def bytes_field(field, value):
+    return key(field, 2) + varint(len(value)) + value
+
+
+def packed_field(field, values):
+    return bytes_field(field, b''.join(varint(v) for v in values))
+
+
+def deltas(values):
+    previous = 0
+    result = []
+    for value in values:
+        result.append(zigzag(value - previous))
+        previous = value
+    return result
+
+
+# ================================================== #
+#               OSM Elements                         #
+# ================================================== #
+class StringTable(object):
+    
+    def __init__(self):
+        self.strings = ['']
+        self.ids = {'': 0}
+    
+    def id(self, string):
+        try:
+            return self.ids[string]
+        except KeyError:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            return self.ids[string]
+    
+    def encode(self):
+        return b''.join(bytes_field(1, s.encode('utf-8')) for s in self.strings)
+
+
+def timestamp_seconds(timestamp):
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def nanodegrees(coord):
+    """Coordinate in units of 100 nanodegrees (granularity 100)"""
+    
+    return int(round(float(coord) * 10 ** 7))
+
+
+def info(element, strings):
+    attrib = element.attrib
+    if 'version' not in attrib:
+        return b''
+    return (int_field(1, int(attrib['version'])) +
+            int_field(2, timestamp_seconds(attrib['timestamp'])) +
+            int_field(3, int(attrib['changeset'])) +
+            int_field(4, int(attrib['uid'])) +
+            int_field(5, strings.id(attrib['user'])))
+
+
+def tag_ids(element, strings):
+    tags = [(strings.id(t.get('k')), strings.id(t.get('v'))) for t in element.findall('tag')]
+    return [k for k, _ in tags], [v for _, v in tags]
+
+
+def dense_nodes(nodes, strings):
+    data = packed_field(1, deltas([int(n.get('id')) for n in nodes]))
+    if 'version' in nodes[0].attrib:
+        dense_info = (packed_field(1, [int(n.get('version')) for n in nodes]) +
+                      packed_field(2, deltas([timestamp_seconds(n.get('timestamp')) for n in nodes])) +
+                      packed_field(3, deltas([int(n.get('changeset')) for n in nodes])) +
+                      packed_field(4, deltas([int(n.get('uid')) for n in nodes])) +
+                      packed_field(5, deltas([strings.id(n.get('user')) for n in nodes])))
+        data += bytes_field(5, dense_info)
+    data += packed_field(8, deltas([nanodegrees(n.get('lat')) for n in nodes]))
+    data += packed_field(9, deltas([nanodegrees(n.get('lon')) for n in nodes]))
+    keys_vals = []
+    for node in nodes:
+        keys, vals = tag_ids(node, strings)
+        for k, v in zip(keys, vals):
+            keys_vals += [k, v]
+        keys_vals.append(0)
+    data += packed_field(10, keys_vals)
+    return bytes_field(2, data)
+
+
+def way(element, strings):
+    keys, vals = tag_ids(element, strings)
+    data = int_field(1, int(element.get('id')))
+    data += packed_field(2, keys) + packed_field(3, vals)
+    element_info = info(element, strings)
+    if element_info:
+        data += bytes_field(4, element_info)
+    data += packed_field(8, deltas([int(nd.get('ref')) for nd in element.findall('nd')]))
+    return bytes_field(3, data)
+
+
+def relation(element, strings):
+    keys, vals = tag_ids(element, strings)
+    members = element.findall('member')
+    data = int_field(1, int(element.get('id')))
+    data += packed_field(2, keys) + packed_field(3, vals)
+    element_info = info(element, strings)
+    if element_info:
+        data += bytes_field(4, element_info)
+    data += packed_field(8, [strings.id(m.get('role')) for m in members])
+    data += packed_field(9, deltas([int(m.get('ref')) for m in members]))
+    data += packed_field(10, [MEMBER_TYPES[m.get('type')] for m in members])
+    return bytes_field(4, data)
+
+
+# ================================================== #
+#               File Writing                         #
+# ================================================== #
+def write_blob(output, blob_type, data):
+    blob = int_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    header = bytes_field(1, blob_type.encode('utf-8')) + int_field(3, len(blob))
+    output.write(struct.pack('>I', len(header)))
+    output.write(header)
+    output.write(blob)
+
+
+def primitive_block(elements):
+    strings = StringTable()
+    groups = []
+    nodes = [e for e in elements if e.tag == 'node']
+    if nodes:
+        groups.append(dense_nodes(nodes, strings))
+    ways = b''.join(way(e, strings) for e in elements if e.tag == 'way')
+    if ways:
+        groups.append(ways)
+    relations = b''.join(relation(e, strings) for e in elements if e.tag == 'relation')
+    if relations:
+        groups.append(relations)
+    
+    return bytes_field(1, strings.encode()) + b''.join(bytes_field(2, g) for g in groups)
+
+
+def write_pbf(osm_file, pbf_file, block_size=200):
+    """Writes the elements of an OSM XML file to a PBF file, in blocks of
+       block_size elements of the same type"""
+    
+    root = ET.parse(osm_file).getroot()
+    elements = [e for e in root if e.tag in MEMBER_TYPES]
+    
+    with open(pbf_file, 'wb') as output:
+        header = (bytes_field(4, b'OsmSchema-V0.6') + bytes_field(4, b'DenseNodes') +
+                  bytes_field(16, b'pbf_writer'))
+        write_blob(output, 'OSMHeader', header)
+        
+        block = []
+        for element in elements:
+            if block and (len(block) >= block_size or block[-1].tag != element.tag):
+                write_blob(output, 'OSMData', primitive_block(block))
+                block = []
+            block.append(element)
+        if block:
+            write_blob(output, 'OSMData', primitive_block(block))
+
+
+def strip_metadata(osm_file, stripped_file):
+    """Writes a copy of an OSM XML file without the metadata attributes of
+       the elements"""
+    
+    with open(osm_file, encoding='utf-8') as f:
+        text = f.read()
+    pattern = re.compile(r'(<(?:node|way|relation) [^>]*)')
+    metadata = re.compile(r' (?:{0})="[^"]*"'.format('|'.join(METADATA_ATTRIBUTES)))
+    text = pattern.sub(lambda match: metadata.sub('', match.group(1)), text)
+    with open(stripped_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+if __name__ == '__main__':
+    """Writes the fixtures of tests/data"""
+    
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import osm_generator
+    
+    SAMPLE = os.path.join(DATA_DIR, 'sample.osm')
+    SAMPLE_NOMETA = os.path.join(DATA_DIR, 'sample_nometa.osm')
+    
+    osm_generator.generate_osm(SAMPLE, n_nodes=600, seed=7)
+    strip_metadata(SAMPLE, SAMPLE_NOMETA)
+    write_pbf(SAMPLE, SAMPLE + '.pbf')
+    write_pbf(SAMPLE_NOMETA, SAMPLE_NOMETA + '.pbf')
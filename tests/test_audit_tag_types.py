@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the capped value sets of audit_tag_types: the number of values kept
+per key and among all the keys is bounded, the most frequent values are kept,
+and the number of different values of the capped keys is estimated.
+
+Python version: 3.6.0
+"""
+
+import audit_tag_types
+from conftest import data_path
+
+
+def test_uncapped_results_are_unchanged():
+    tag_types, tag_numbers = audit_tag_types.get_tags(data_path('sample.osm'), 'node')
+    capped_types, capped_numbers = audit_tag_types.get_tags(
+        data_path('sample.osm'), 'node', max_values=1000, max_total_values=10000)
+    
+    assert {key: set(values) for key, values in capped_types.items()} == tag_types
+    assert capped_numbers == tag_numbers
+
+
+def test_total_values_are_capped():
+    value_sets = audit_tag_types.new_value_sets(max_values=50, max_total_values=200)
+    for i in range(20000):
+        # Two frequent keys and many rare keys, with many rare values
+        value_sets['frequent_a'].add('common')
+        value_sets['frequent_b'].add('value_{0}'.format(i % 3))
+        value_sets['rare_{0}'.format(i)].add('value_{0}'.format(i))
+    
+    assert sum(len(values) for values in value_sets.values()) <= 200
+    assert len(value_sets) <= 200
+    assert 'common' in value_sets['frequent_a']
+    assert set(value_sets['frequent_b']) == {'value_0', 'value_1', 'value_2'}
+
+
+def test_distinct_values_are_estimated():
+    value_sets = audit_tag_types.new_value_sets(max_values=10)
+    for i in range(50000):
+        value_sets['name'].add('name_{0}'.format(i % 5000))
+    value_sets['highway'].add('residential')
+    
+    counts = audit_tag_types.count_elems(value_sets)
+    assert len(value_sets['name']) == 10
+    assert abs(counts['name'] - 5000) < 5000 * 0.3
+    assert counts['highway'] == 1
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the checkpoints of osm2csv.process_map: a conversion interrupted in
+the middle of a segment and resumed from its last checkpoint gives the same
+csv files as an uninterrupted conversion.
+
+Python version: 3.6.0
+"""
+
+import os
+import shutil
+
+import pytest
+
+import osm2csv
+from conftest import data_path, read_bytes
+
+CHECKPOINT_SIZE = 8 * 1024
+
+
+def interrupt_after(monkeypatch, segments):
+    """Makes the conversion fail in the middle of the segment following the
+       given number of segments"""
+    
+    get_element = osm2csv.get_element
+    calls = []
+    
+    def failing_get_element(osm_file, tags, backend=None):
+        calls.append(osm_file)
+        records = get_element(osm_file, tags, backend)
+        if len(calls) <= segments:
+            return records
+        
+        def interrupted():
+            for i, record in enumerate(records):
+                if i == 10:
+                    raise RuntimeError('conversion interrupted')
+                yield record
+        return interrupted()
+    
+    monkeypatch.setattr(osm2csv, 'get_element', failing_get_element)
+
+
+@pytest.mark.parametrize('geometry', [False, True])
+def test_resumed_conversion_is_identical(convert, tmp_path, monkeypatch, geometry):
+    expected = read_bytes(convert(data_path('sample.osm'), 'full', geometry=geometry))
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    
+    interrupt_after(monkeypatch, 3)
+    with pytest.raises(RuntimeError):
+        convert(data_path('sample.osm'), 'resumed', geometry=geometry,
+                checkpoint=checkpoint, checkpoint_size=CHECKPOINT_SIZE)
+    monkeypatch.undo()
+    assert os.path.exists(checkpoint)
+    
+    paths = convert(data_path('sample.osm'), 'resumed', geometry=geometry,
+                    checkpoint=checkpoint, resume=True, 
+                    checkpoint_size=CHECKPOINT_SIZE)
+    
+    assert read_bytes(paths) == expected
+    assert not os.path.exists(checkpoint)
+
+
+def test_resume_rejects_modified_input(convert, tmp_path, monkeypatch):
+    osm_file = str(tmp_path / 'sample.osm')
+    shutil.copy(data_path('sample.osm'), osm_file)
+    checkpoint = osm2csv.checkpoint_path(osm_file, str(tmp_path))
+    
+    interrupt_after(monkeypatch, 2)
+    with pytest.raises(RuntimeError):
+        convert(osm_file, checkpoint=checkpoint, checkpoint_size=CHECKPOINT_SIZE)
+    monkeypatch.undo()
+    
+    stat = os.stat(osm_file)
+    os.utime(osm_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    with pytest.raises(ValueError):
+        convert(osm_file, checkpoint=checkpoint, resume=True, 
+                checkpoint_size=CHECKPOINT_SIZE)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the summary tables of csv2sqldb: the tables updated with the
+differences of SummaryChanges are the same as the tables built again by
+create_summary_tables.
+
+Python version: 3.6.0
+"""
+
+import csv2sqldb
+import osm2sqldb
+from conftest import data_path, read_tables
+
+SUMMARY_TABLES = ['tags', 'tag_counts', 'key_counts', 'user_edits']
+
+
+def summary_tables(db_path):
+    tables = read_tables(db_path)
+    return {name: tables[name] for name in SUMMARY_TABLES}
+
+
+def test_summary_changes_match_rebuild(rules, tmp_path):
+    db_path = str(tmp_path / 'sample.db')
+    osm2sqldb.process_map_to_db(data_path('sample.osm'), rules.street_mapping,
+                                rules.expected_street_types, db_path, rules=rules)
+    
+    conn = csv2sqldb.create_connection(db_path)
+    try:
+        summary = csv2sqldb.SummaryChanges()
+        # Node 3: the amenity=bank tag is removed and a new tag is added
+        summary.remove_element(conn, 'node', 3)
+        conn.execute("DELETE FROM nodes_tags WHERE id = 3 AND key = 'amenity'")
+        conn.execute("INSERT INTO nodes_tags VALUES (3, 'cuisine', 'galician', 'regular')")
+        tags = conn.execute('SELECT key, value, type FROM nodes_tags WHERE id = 3').fetchall()
+        summary.add_element('node', 3, 1073, 'Antía6', tags)
+        # Node 28 is deleted
+        summary.remove_element(conn, 'node', 28)
+        conn.execute('DELETE FROM nodes_tags WHERE id = 28')
+        conn.execute('DELETE FROM nodes WHERE id = 28')
+        summary.apply(conn)
+        conn.commit()
+        updated = summary_tables(db_path)
+        
+        csv2sqldb.create_summary_tables(conn)
+    finally:
+        conn.close()
+    
+    assert ('node', 3, 'cuisine', 'galician', 'regular') in updated['tags']
+    assert updated == summary_tables(db_path)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of osm_downsampler: names of the sample files, and samples of a PBF
+file written as XML files with the same elements as the samples of the XML
+file.
+
+Python version: 3.6.0
+"""
+
+import pytest
+
+import osm_reader
+import pbf_reader
+import osm_downsampler
+from conftest import data_path
+
+
+@pytest.mark.parametrize('osm_file, mode, sample_file', [
+    ('LCG_map_full.osm', 'every', 'LCG_map_sample_k2.osm'),
+    ('maps/LCG_map.osm.bz2', 'every', 'maps/LCG_map_sample_k2.osm'),
+    ('LCG_map.osm.gz', 'reservoir', 'LCG_map_sample_reservoir.osm'),
+    ('LCG_map.osm.pbf', 'every', 'LCG_map_sample_k2.osm'),
+    ('LCG_map.pbf', 'bbox', 'LCG_map_sample_bbox.osm')])
+def test_default_sample_file(osm_file, mode, sample_file):
+    assert osm_downsampler.default_sample_file(osm_file, mode, 2) == sample_file
+
+
+def read_elements(osm_file):
+    return [(record.tag, record.attrib['id'], record.tags, record.nds, record.members)
+            for record in osm_reader.expat_records(osm_file, osm_reader.TOP_LEVEL_ELEMENTS)]
+
+
+def test_pbf_sample_is_xml(tmp_path):
+    xml_sample = str(tmp_path / 'xml_sample.osm')
+    pbf_sample = str(tmp_path / osm_downsampler.default_sample_file('sample.osm.pbf',
+                                                                     'every', 3))
+    counts = osm_downsampler.sample_osm(data_path('sample.osm'), xml_sample, k=3)
+    pbf_counts = osm_downsampler.sample_osm(data_path('sample.osm.pbf'), pbf_sample, k=3)
+    
+    assert pbf_counts == counts
+    assert not pbf_reader.is_pbf(pbf_sample)
+    assert read_elements(pbf_sample) == read_elements(xml_sample)
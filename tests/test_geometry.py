@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the node coordinate indexes of geometry.
+
+Python version: 3.6.0
+"""
+
+from geometry import DiskNodeIndex
+
+
+def test_disk_node_index_starts_empty(tmp_path):
+    path = str(tmp_path / 'nodes.idx')
+    node_index = DiskNodeIndex(path)
+    node_index.add(5, '43.3711500', '-8.3959800')
+    node_index.close()
+    
+    # The coordinates of a previous run are not kept by a new index
+    node_index = DiskNodeIndex(path)
+    assert node_index.get(5) is None
+    node_index.add(7, '43.3000000', '-8.4000000')
+    node_index.close()
+    
+    node_index = DiskNodeIndex(path, readonly=True)
+    try:
+        assert node_index.get(5) is None
+        assert node_index.get(7) == (43.3, -8.4)
+    finally:
+        node_index.close()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the incremental update of osc2sqldb: a database updated with the
+changes of an osmChange file has the same tables (including the way
+geometry, the R*Tree spatial index and the summary tables) as the database
+built from the OSM file with the changes applied to it.
+
+The changes of tests/data/sample_changes.osc create, modify and delete
+nodes, ways and a relation, move a node of an existing way, rename a user,
+and include a stale modification which must be skipped.
+
+Python version: 3.6.0
+"""
+
+from collections import OrderedDict
+
+import pytest
+
+import csv2sqldb
+import osm2sqldb
+import osc2sqldb
+import osm_reader
+from conftest import data_path, read_tables
+
+METADATA = ('version', 'changeset', 'timestamp', 'user', 'uid')
+ELEMENT_ORDER = {'node': 0, 'way': 1, 'relation': 2}
+
+
+def strip_metadata(record):
+    for name in METADATA:
+        record.attrib.pop(name, None)
+    return record
+
+
+def patch_records(records, changes):
+    """Elements of the OSM file once the changes are applied, skipping the
+       stale changes"""
+    
+    elements = OrderedDict(((record.tag, record.attrib['id']), record)
+                           for record in records)
+    for action, record in changes:
+        key = (record.tag, record.attrib['id'])
+        current = elements.get(key)
+        if (current is not None and 'version' in record.attrib and
+                int(current.attrib['version']) >= int(record.attrib['version'])):
+            continue
+        if action == 'delete':
+            del elements[key]
+        else:
+            elements[key] = record
+    
+    return sorted(elements.values(), key=lambda record: ELEMENT_ORDER[record.tag])
+
+
+def write_osm(path, records):
+    with open(path, 'wb') as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for record in records:
+            f.write(osm_reader.record_to_xml(record))
+        f.write(b'</osm>\n')
+
+
+def write_osc(path, changes):
+    with open(path, 'wb') as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n')
+        for action, record in changes:
+            f.write('<{0}>\n'.format(action).encode('utf-8'))
+            f.write(osm_reader.record_to_xml(record))
+            f.write('</{0}>\n'.format(action).encode('utf-8'))
+        f.write(b'</osmChange>\n')
+
+
+def build_database(rules, osm_file, db_path):
+    osm2sqldb.process_map_to_db(osm_file, rules.street_mapping,
+                                rules.expected_street_types, db_path, rules=rules,
+                                geometry=True, spatial_index=True)
+
+
+@pytest.mark.parametrize('metadata', [True, False])
+def test_changes_match_rebuild(rules, tmp_path, metadata):
+    records = list(osm_reader.expat_records(data_path('sample.osm'),
+                                            osm_reader.TOP_LEVEL_ELEMENTS))
+    changes = list(osm_reader.iter_changes(data_path('sample_changes.osc')))
+    if not metadata:
+        records = [strip_metadata(record) for record in records]
+        changes = [(action, strip_metadata(record)) for action, record in changes]
+    
+    osm_file = str(tmp_path / 'sample.osm')
+    osc_file = str(tmp_path / 'sample.osc')
+    patched_file = str(tmp_path / 'patched.osm')
+    write_osm(osm_file, records)
+    write_osc(osc_file, changes)
+    write_osm(patched_file, patch_records(records, changes))
+    
+    updated_db = str(tmp_path / 'updated.db')
+    rebuilt_db = str(tmp_path / 'rebuilt.db')
+    build_database(rules, osm_file, updated_db)
+    stats = osc2sqldb.apply_changes(osc_file, updated_db, rules.street_mapping,
+                                    rules.expected_street_types, rules=rules)
+    build_database(rules, patched_file, rebuilt_db)
+    
+    stale = 1 if metadata else 0
+    assert ([stats[action] for action in ('create', 'modify', 'delete', 'stale')] ==
+            [3, 5 - stale, 2, stale])
+    rebuilt_tables = read_tables(rebuilt_db)
+    assert read_tables(updated_db) == rebuilt_tables
+    
+    # The summary tables can still be built again from the updated tables
+    conn = csv2sqldb.create_connection(updated_db)
+    try:
+        csv2sqldb.create_summary_tables(conn)
+    finally:
+        conn.close()
+    assert read_tables(updated_db) == rebuilt_tables
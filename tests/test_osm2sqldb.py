@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the streaming loader of osm2sqldb: the database built directly from
+the OSM file has the same tables as the one imported from the csv files by
+csv2sqldb, including the files without metadata (NULL uid, version and
+changeset).
+
+Python version: 3.6.0
+"""
+
+import pytest
+
+import csv2sqldb
+import osm2sqldb
+from conftest import data_path, read_tables
+
+
+def import_csv(paths, db_path):
+    csv2sqldb.create_database(db_path, *paths[:5], relations_path=paths[5],
+                              relation_members_path=paths[6],
+                              relation_tags_path=paths[7], spatial_index=True)
+
+
+@pytest.mark.parametrize('osm_name', ['sample.osm', 'sample_nometa.osm'])
+def test_streamed_database_matches_csv_import(convert, rules, tmp_path, osm_name):
+    csv_db = str(tmp_path / 'csv.db')
+    import_csv(convert(data_path(osm_name), geometry=True), csv_db)
+    
+    streamed_db = str(tmp_path / 'streamed.db')
+    osm2sqldb.process_map_to_db(data_path(osm_name), rules.street_mapping,
+                                rules.expected_street_types, streamed_db,
+                                rules=rules, geometry=True, spatial_index=True)
+    
+    assert read_tables(streamed_db) == read_tables(csv_db)
+
+
+def test_missing_metadata_is_null(rules, tmp_path):
+    db_path = str(tmp_path / 'nometa.db')
+    osm2sqldb.process_map_to_db(data_path('sample_nometa.osm'), rules.street_mapping,
+                                rules.expected_street_types, db_path, rules=rules)
+    tables = read_tables(db_path)
+    
+    assert tables['nodes'] and tables['ways']
+    assert all(row[4:7] == (None, None, None) for row in tables['nodes'])
+    assert all(row[2:5] == (None, None, None) for row in tables['ways'])
+    assert tables['user_edits'] == []
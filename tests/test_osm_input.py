@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of osm_input: the bz2 files made of several streams (decompressed in
+parallel) or of a single stream (decompressed sequentially) and the gzip
+files give the same bytes as the uncompressed file, and the truncated files
+raise EOFError through the background reader.
+
+Python version: 3.6.0
+"""
+
+import bz2
+import gzip
+
+import pytest
+
+import osm_input
+from conftest import data_path
+
+STREAM_SIZE = 8192
+# Compression and extension of each kind of compressed file
+KINDS = {'bz2_multi': ('bz2', 'bz2'), 'bz2_single': ('bz2', 'bz2'), 'gzip': ('gzip', 'gz')}
+
+
+@pytest.fixture(scope='module')
+def sample_data():
+    with open(data_path('sample.osm'), 'rb') as f:
+        return f.read()
+
+
+def compress(data, kind):
+    if kind == 'bz2_multi':
+        # One stream per block of the input, as written by pbzip2
+        return b''.join(bz2.compress(data[i:i + STREAM_SIZE])
+                        for i in range(0, len(data), STREAM_SIZE))
+    if kind == 'bz2_single':
+        return bz2.compress(data)
+    
+    return gzip.compress(data)
+
+
+@pytest.fixture
+def compressed_file(sample_data, tmp_path):
+    def write(kind, truncated=False):
+        data = compress(sample_data, kind)
+        if truncated:
+            data = data[:len(data) * 3 // 4]
+        path = str(tmp_path / 'sample_{0}.osm.{1}'.format(kind, KINDS[kind][1]))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+    
+    return write
+
+
+def read_all(path, processes):
+    osm = osm_input.open_input(path, processes)
+    try:
+        return osm.read()
+    finally:
+        osm.close()
+
+
+@pytest.mark.parametrize('kind, processes', [
+    ('bz2_multi', 1), ('bz2_multi', 2), ('bz2_single', 2), ('gzip', 1)])
+def test_open_input_decompresses(compressed_file, sample_data, kind, processes):
+    path = compressed_file(kind)
+    
+    assert osm_input.compression(path) == KINDS[kind][0]
+    assert read_all(path, processes) == sample_data
+
+
+@pytest.mark.parametrize('kind', ['bz2_multi', 'bz2_single'])
+def test_bz2_chunks(compressed_file, sample_data, kind):
+    # Small chunks: many chunks of streams in flight for the multi-stream
+    # file, and the sequential decompression for the single stream
+    blocks = osm_input.bz2_blocks(compressed_file(kind), processes=2, chunk_size=1024)
+    
+    assert b''.join(blocks) == sample_data
+
+
+@pytest.mark.parametrize('kind', ['bz2_multi', 'bz2_single', 'gzip'])
+def test_truncated_file_raises(compressed_file, kind):
+    path = compressed_file(kind, truncated=True)
+    
+    with pytest.raises(EOFError):
+        read_all(path, 2)
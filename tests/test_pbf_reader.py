@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of pbf_reader: the conversion of the PBF samples gives the same csv
+files as the conversion of the XML files they were written from, with and
+without the metadata of the elements.
+
+Python version: 3.6.0
+"""
+
+import sqlite3
+
+import pytest
+
+import csv2sqldb
+import pbf_reader
+from conftest import data_path, read_bytes
+
+
+@pytest.mark.parametrize('sample', ['sample.osm', 'sample_nometa.osm'])
+def test_pbf_conversion_matches_xml(convert, sample):
+    xml_paths = convert(data_path(sample), 'xml', geometry=True)
+    pbf_paths = convert(data_path(sample + '.pbf'), 'pbf', geometry=True)
+    
+    assert pbf_reader.is_pbf(data_path(sample + '.pbf'))
+    assert read_bytes(pbf_paths) == read_bytes(xml_paths)
+
+
+def test_pbf_records_in_file_order():
+    serial = [(r.tag, r.attrib['id']) for r in 
+              pbf_reader.pbf_records(data_path('sample.osm.pbf'), processes=1)]
+    pooled = [(r.tag, r.attrib['id']) for r in 
+              pbf_reader.pbf_records(data_path('sample.osm.pbf'), processes=2)]
+    
+    assert serial == pooled
+    assert [tag for tag, _ in serial] == sorted((tag for tag, _ in serial), 
+                                                key=['node', 'way', 'relation'].index)
+
+
+def test_import_without_metadata(convert, tmp_path):
+    paths = convert(data_path('sample_nometa.osm.pbf'), geometry=True)
+    db_path = str(tmp_path / 'nometa.db')
+    csv2sqldb.create_database(db_path, *paths[:5], relations_path=paths[5],
+                              relation_members_path=paths[6], 
+                              relation_tags_path=paths[7])
+    
+    conn = sqlite3.connect(db_path)
+    try:
+        for table_name in ('nodes', 'ways', 'relations'):
+            rows, missing = conn.execute(
+                'SELECT COUNT(*), SUM(uid IS NULL AND changeset IS NULL) FROM {0}'.format(
+                    table_name)).fetchone()
+            assert rows > 0 and missing == rows
+        assert conn.execute('SELECT COUNT(*) FROM user_edits').fetchone()[0] == 0
+    finally:
+        conn.close()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the multi-process conversion of osm2csv.process_map: the csv files
+of the sharded conversion (with the node index built by the conversion or
+given as a DiskNodeIndex) are byte-identical to the ones of the serial
+conversion, the shards cover the elements of the file exactly once, and
+the profiles of the worker processes are merged.
+
+Python version: 3.6.0
+"""
+
+import pstats
+
+import pytest
+
+import osm2csv
+import validation
+import pipeline_stats
+from geometry import NodeIndex, DiskNodeIndex
+from conftest import data_path, read_bytes
+
+
+@pytest.mark.parametrize('geometry', [False, True])
+def test_sharded_conversion_is_identical(convert, geometry):
+    serial = convert(data_path('sample.osm'), 'serial', geometry=geometry, 
+                     processes=1)
+    sharded = convert(data_path('sample.osm'), 'sharded', geometry=geometry, 
+                      processes=4)
+    
+    assert read_bytes(sharded) == read_bytes(serial)
+
+
+@pytest.mark.parametrize('readonly', [False, True])
+def test_sharded_conversion_with_disk_node_index(convert, tmp_path, readonly):
+    serial = convert(data_path('sample.osm'), 'serial', geometry=True, processes=1)
+    
+    index_path = str(tmp_path / 'nodes.idx')
+    node_index = DiskNodeIndex(index_path)
+    if readonly:
+        osm2csv.build_node_index(data_path('sample.osm'), node_index).close()
+        node_index = DiskNodeIndex(index_path, readonly=True)
+    try:
+        sharded = convert(data_path('sample.osm'), 'sharded', geometry=node_index,
+                          processes=4)
+        assert node_index.get(3) is not None
+    finally:
+        node_index.close()
+    
+    assert read_bytes(sharded) == read_bytes(serial)
+
+
+def test_sharded_conversion_rejects_memory_node_index(convert):
+    with pytest.raises(ValueError):
+        convert(data_path('sample.osm'), geometry=NodeIndex(), processes=4)
+
+
+def test_sharded_validation_report(convert):
+    serial = validation.ElementValidator()
+    sharded = validation.ElementValidator()
+    convert(data_path('sample.osm'), 'serial', validate=serial, processes=1)
+    convert(data_path('sample.osm'), 'sharded', validate=sharded, processes=4)
+    
+    assert sharded.report.validated == serial.report.validated > 0
+    assert sharded.report.error_counts == serial.report.error_counts
+
+
+def test_sharded_profile(convert, tmp_path):
+    profile_file = str(tmp_path / 'shape.prof')
+    stats = pipeline_stats.PipelineStats(report=None, profile_stage='shape',
+                                         profile_file=profile_file)
+    convert(data_path('sample.osm'), processes=4, stats=stats)
+    
+    profiled = [function for _, _, function in pstats.Stats(profile_file).stats]
+    assert 'shape_element' in profiled
+    assert stats.counters['elements'] > 0
+
+
+def test_shards_cover_all_elements():
+    osm_file = data_path('sample.osm')
+    prolog_end, shards = osm2csv.find_shard_offsets(osm_file, 16)
+    
+    assert len(shards) > 1
+    assert all(end == next_start for (_, end), (next_start, _) in zip(shards, shards[1:]))
+    with open(osm_file, 'rb') as osm:
+        for start, _ in shards:
+            osm.seek(start)
+            assert osm.read(10).split()[0] in (b'<node', b'<way', b'<relation')
+    
+    shard_ids = []
+    for start, end in shards:
+        reader = osm2csv.ShardReader(osm_file, prolog_end, start, end)
+        try:
+            shard_ids += [(r.tag, r.attrib['id']) for r in osm2csv.get_element(reader)]
+        finally:
+            reader.close()
+    
+    assert shard_ids == [(r.tag, r.attrib['id']) for r in osm2csv.get_element(osm_file)]
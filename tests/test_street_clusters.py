@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of audit_street_clusters: the prefix filtering join finds the same
+pairs of similar keys as comparing all the pairs, the variant spellings of
+a street are grouped under the expected name (but not the streets with
+other street types or numbers), and the proposed mapping is saved in a
+rules file readable by correction_rules.load_rules.
+
+Python version: 3.6.0
+"""
+
+import json
+import codecs
+from itertools import combinations
+
+import pytest
+
+import correction_rules
+import audit_street_clusters
+
+NAMES = {'Rúa Fernández Latorre': 5,
+         'Calle Fernández Latorre': 2,
+         'Rua Fernandez Latorre': 1,
+         'RÚA FERNÁNDEZ LATORRE': 1,
+         'Rúa Concepción Arenal': 3,
+         'Rúa Concepcion Areal': 1,
+         'Avenida de Finisterre': 4,
+         'Avda. Finisterre': 2,
+         'Praza de Pontevedra': 3,
+         'Pontevedra': 1,
+         'Rúa 1 de Maio': 1,
+         'Rúa 2 de Maio': 1,
+         'Rolda de Outeiro': 2,
+         'Rúa Outeiro': 1}
+
+
+@pytest.fixture
+def street_rules():
+    return correction_rules.CorrectionRules(
+        {'Rúa Real': 'Rúa Real'}, ['Rúa', 'Avenida', 'Praza', 'Rolda'],
+        {'Avda.': 'Avenida'})
+
+
+@pytest.mark.parametrize('threshold', [0.5, 0.7, 0.9])
+def test_similar_keys_match_all_pairs(threshold):
+    keys = ['concepcion arenal', 'concepcion areal', 'fernandez latorre',
+            'fernandez la torre', 'finisterre', 'finisterra', 'pontevedra',
+            'ponte vedra', 'outeiro', 'outeiros', 'real', 'riazor', 'ramon cabanillas',
+            'ramon cabanilla', 'juana de vega', 'xoana de vega']
+    sets = [audit_street_clusters.trigrams(key) for key in keys]
+    expected = set()
+    for i, j in combinations(range(len(keys)), 2):
+        if len(sets[i] & sets[j]) / float(len(sets[i] | sets[j])) >= threshold:
+            expected.add(frozenset((i, j)))
+    
+    pairs = audit_street_clusters.similar_keys(keys, threshold)
+    
+    assert set(frozenset((i, j)) for _, i, j in pairs) == expected
+    assert expected
+
+
+def test_clusters(street_rules):
+    clusters = audit_street_clusters.cluster_street_names(NAMES, street_rules)
+    groups = {cluster['name']: set(name for name, _ in cluster['names'])
+              for cluster in clusters}
+    
+    assert groups == {
+        'Rúa Fernández Latorre': {'Rúa Fernández Latorre', 'Calle Fernández Latorre',
+                                  'Rua Fernandez Latorre', 'RÚA FERNÁNDEZ LATORRE'},
+        'Avenida de Finisterre': {'Avenida de Finisterre', 'Avda. Finisterre'},
+        'Praza de Pontevedra': {'Praza de Pontevedra', 'Pontevedra'},
+        'Rúa Concepción Arenal': {'Rúa Concepción Arenal', 'Rúa Concepcion Areal'}}
+    assert [cluster['count'] for cluster in clusters] == [9, 6, 4, 4]
+    
+    # Without the approximate clustering the typo is not grouped
+    exact = audit_street_clusters.cluster_street_names(NAMES, street_rules, threshold=None)
+    assert 'Rúa Concepción Arenal' not in [cluster['name'] for cluster in exact]
+
+
+def test_saved_rules(street_rules, tmp_path):
+    clusters = audit_street_clusters.cluster_street_names(NAMES, street_rules)
+    mapping = audit_street_clusters.proposed_mapping(clusters, street_rules)
+    assert mapping == {'Calle Fernández Latorre': 'Rúa Fernández Latorre',
+                       'Rua Fernandez Latorre': 'Rúa Fernández Latorre',
+                       'RÚA FERNÁNDEZ LATORRE': 'Rúa Fernández Latorre',
+                       'Avda. Finisterre': 'Avenida de Finisterre',
+                       'Pontevedra': 'Praza de Pontevedra',
+                       'Rúa Concepcion Areal': 'Rúa Concepción Arenal'}
+    
+    rules_file = str(tmp_path / 'proposed_rules.json')
+    audit_street_clusters.save_proposed_rules(street_rules, mapping, clusters, rules_file)
+    proposed = correction_rules.load_rules(rules_file)
+    
+    assert proposed.street_mapping == dict(mapping, **street_rules.street_mapping)
+    assert proposed.expected_street_types == street_rules.expected_street_types
+    for name, corrected in mapping.items():
+        assert proposed.street_name(name) == corrected
+    with codecs.open(rules_file, 'r', encoding='utf-8') as f:
+        assert len(json.load(f)['street_clusters']) == len(clusters)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of validation: the compiled validator finds the same invalid fields as
+the Cerberus validator of the schema, on the shaped elements of the sample
+and on invalid records (missing, unknown, null and wrongly typed fields).
+
+Python version: 3.6.0
+"""
+
+import pytest
+
+import osm2csv
+import schema
+import validation
+from conftest import data_path
+
+cerberus = pytest.importorskip('cerberus')
+
+CHECKS = validation.compile_schema()
+
+
+def as_dicts(el):
+    """Shaped element with dictionaries instead of records, as validated by
+       Cerberus"""
+    
+    return {field: records._asdict() if isinstance(records, tuple) 
+            else [record._asdict() for record in records]
+            for field, records in el.items()}
+
+
+def cerberus_errors(el):
+    """Set of (element field, field) errors found by Cerberus"""
+    
+    def leaves(errors):
+        fields = set()
+        for field, details in errors.items():
+            nested = [detail for detail in details if isinstance(detail, dict)]
+            if isinstance(field, str) and not nested:
+                fields.add(field)
+            for detail in nested:
+                fields |= leaves(detail)
+        return fields
+    
+    validator = cerberus.Validator(schema.schema)
+    validator.validate(el)
+    errors = set()
+    for element_field, details in validator.errors.items():
+        nested = [detail for detail in details if isinstance(detail, dict)]
+        if not nested:
+            errors.add((element_field, element_field))
+        for detail in nested:
+            errors |= {(element_field, field) for field in leaves(detail)}
+    return errors
+
+
+def compiled_errors(el):
+    """Set of (element field, field) errors found by the compiled validator"""
+    
+    errors = set()
+    for element_field, records in el.items():
+        for field, _ in CHECKS[element_field](records):
+            errors.add((element_field, field.split('.')[-1]))
+    return errors
+
+
+@pytest.fixture(scope='module')
+def shaped_elements(rules):
+    elements = []
+    for element in osm2csv.get_element(data_path('sample.osm')):
+        elements.append(osm2csv.shape_element(element, rules.street_mapping, 
+                                              rules.expected_street_types, 
+                                              rules=rules))
+    return elements
+
+
+def test_sample_elements_are_valid(shaped_elements):
+    for el in shaped_elements:
+        assert compiled_errors(el) == set()
+        assert compiled_errors(as_dicts(el)) == set() == cerberus_errors(as_dicts(el))
+
+
+# Value of the fields removed from a record
+MISSING = object()
+
+
+def changed_record(record, **changes):
+    """Copy of a record dictionary with the given values, without the
+       MISSING fields"""
+    
+    record = dict(record, **changes)
+    return {key: value for key, value in record.items() if value is not MISSING}
+
+
+NODE_CHANGES = [
+    {'timestamp': 20170101},
+    {'timestamp': None},
+    {'uid': MISSING},
+    {'uid': ''},
+    {'uid': 'anonymous'},
+    {'lat': 'north'},
+    {'user': 12},
+    {'version': 3},
+    {'changeset': None},
+    {'color': 'red'},
+    {'id': MISSING, 'lon': [8.4]},
+]
+
+
+@pytest.mark.parametrize('changes', NODE_CHANGES)
+def test_invalid_nodes(shaped_elements, changes):
+    el = as_dicts(next(el for el in shaped_elements if 'node' in el and el['node_tags']))
+    el['node'] = changed_record(el['node'], **changes)
+    
+    errors = compiled_errors(el)
+    assert errors
+    assert errors == cerberus_errors(el)
+    assert not validation.ElementValidator().validate(el)
+
+
+@pytest.mark.parametrize('changes', [{'key': None}, {'id': 'x'}, {'type': MISSING}])
+def test_invalid_tags(shaped_elements, changes):
+    el = as_dicts(next(el for el in shaped_elements if 'way' in el and len(el['way_tags']) > 1))
+    el['way_tags'][1] = changed_record(el['way_tags'][1], **changes)
+    
+    assert compiled_errors(el) == cerberus_errors(el) != set()
+
+
+def test_invalid_way_geometry(shaped_elements):
+    el = next(el for el in shaped_elements if 'way' in el)
+    way = el['way']._asdict()
+    way.update(min_lat=None, length='long')
+    el = dict(as_dicts(el), way=way)
+    
+    assert compiled_errors(el) == cerberus_errors(el) == {('way', 'length')}
+
+
+def test_invalid_records(shaped_elements):
+    el = next(el for el in shaped_elements if 'node' in el)
+    node = el['node']._replace(uid='', timestamp=None)
+    invalid = dict(el, node=node)
+    
+    assert compiled_errors(invalid) == cerberus_errors(as_dicts(invalid))
+    assert compiled_errors(invalid) == {('node', 'uid'), ('node', 'timestamp')}
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+This program provides a fast validator of the shaped elements produced by
+osm2csv.shape_element, replacing the per-element Cerberus validation.
+
+The Cerberus schema given in schema.py is compiled once into one check
+function per element field (node, node_tags, way, way_nodes, way_tags), which
+applies the same rules as Cerberus: required fields, unknown fields, null
+values, coercion and type of each value. The validator can check only one 
+element out of every sample_every elements, and it collects the errors in a
+report instead of raising an exception on the first one (unless 
+raise_on_error is set).
+
+The shaped elements are made of records (named tuples, see osm2csv), checked
+by position: the positions of the schema fields and the errors of the missing
+and unknown fields are computed once per record type. Dictionaries are
+accepted as well.
+
+Python version: 3.6.0
+"""
+
+import pprint
+from collections import Counter
+
+import schema
+
+SCHEMA = schema.schema
+
+TYPES = {'integer': int,
+         'float': float,
+         'string': str}
+
+
+# ================================================== #
+#               Schema Compilation                   #
+# ================================================== #
+def compile_dict_check(dict_schema):
+    """Compiles the schema of a dictionary into a function returning the list
+       of (field, message) errors of a record (named tuple or dictionary)"""
+    
+    fields = []
+    for field, rules in dict_schema.items():
+        fields.append((field, rules.get('required', False), rules.get('coerce'),
+                       TYPES[rules['type']], rules['type'], 
+                       rules.get('nullable', False)))
+    known_fields = frozenset(dict_schema)
+    record_checks = {}
+    
+    def compile_record(rec_type):
+        """Positions of the schema fields in a record type, and errors of
+           its missing and unknown fields"""
+        
+        positions = {field: i for i, field in enumerate(rec_type._fields)}
+        checked = []
+        type_errors = []
+        for field, required, coerce, field_type, type_name, nullable in fields:
+            if field in positions:
+                checked.append((positions[field], field, coerce, field_type, 
+                                type_name, nullable))
+            elif required:
+                type_errors.append((field, 'required field'))
+        type_errors += [(field, 'unknown field') for field in rec_type._fields
+                        if field not in known_fields]
+        
+        record_checks[rec_type] = checked, type_errors
+        return checked, type_errors
+    
+    def check_dict(record):
+        errors = []
+        n_fields = 0
+        for field, required, coerce, field_type, type_name, nullable in fields:
+            try:
+                value = record[field]
+            except KeyError:
+                if required:
+                    errors.append((field, 'required field'))
+                continue
+            
+            n_fields += 1
+            if type(value) is field_type:
+                continue
+            if value is None:
+                if not nullable:
+                    errors.append((field, 'null value not allowed'))
+                continue
+            
+            if coerce is not None:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError):
+                    errors.append((field, "field '{0}' cannot be coerced: {1!r}".format(field, value)))
+                    continue
+            
+            if type(value) is not field_type:
+                errors.append((field, 'must be of {0} type'.format(type_name)))
+        
+        if len(record) != n_fields:
+            for field in record:
+                if field not in known_fields:
+                    errors.append((field, 'unknown field'))
+        
+        return errors
+    
+    def check(record):
+        rec_type = type(record)
+        if rec_type is dict:
+            return check_dict(record)
+        try:
+            checked, type_errors = record_checks[rec_type]
+        except KeyError:
+            checked, type_errors = compile_record(rec_type)
+        
+        errors = list(type_errors)
+        for i, field, coerce, field_type, type_name, nullable in checked:
+            value = record[i]
+            # Values of the right type pass the coercion (int, float, str) 
+            # unchanged, they need no further check
+            if type(value) is field_type:
+                continue
+            if value is None:
+                if not nullable:
+                    errors.append((field, 'null value not allowed'))
+                continue
+            
+            if coerce is not None:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError):
+                    errors.append((field, "field '{0}' cannot be coerced: {1!r}".format(field, value)))
+                    continue
+            
+            if type(value) is not field_type:
+                errors.append((field, 'must be of {0} type'.format(type_name)))
+        
+        return errors
+    
+    return check
+
+
+def compile_field_check(field_schema):
+    """Compiles the schema of an element field (a dictionary or a list of
+       dictionaries) into a check function"""
+    
+    if field_schema['type'] == 'dict':
+        return compile_dict_check(field_schema['schema'])
+    
+    item_check = compile_dict_check(field_schema['schema']['schema'])
+    
+    def check(records):
+        errors = []
+        for i, record in enumerate(records):
+            for field, message in item_check(record):
+                errors.append(('{0}.{1}'.format(i, field), message))
+        return errors
+    
+    return check
+
+
+def compile_schema(element_schema=SCHEMA):
+    """Compiles the element schema into a dictionary of check functions"""
+    
+    return {field: compile_field_check(field_schema)
+            for field, field_schema in element_schema.items()}
+
+
+# ================================================== #
+#               Validator                            #
+# ================================================== #
+class ValidationReport(object):
+    """Number of validated elements and errors found, keeping the details of
+       the first max_errors errors"""
+    
+    def __init__(self, max_errors=1000):
+        self.max_errors = max_errors
+        self.validated = 0
+        self.invalid = 0
+        self.error_counts = Counter()
+        self.errors = []
+    
+    def add(self, element_field, element_id, errors):
+        for field, message in errors:
+            self.error_counts[(element_field, field.split('.')[-1])] += 1
+            if len(self.errors) < self.max_errors:
+                self.errors.append((element_field, element_id, field, message))
+    
+    def merge(self, other):
+        self.validated += other.validated
+        self.invalid += other.invalid
+        self.error_counts.update(other.error_counts)
+        self.errors.extend(other.errors[:max(self.max_errors - len(self.errors), 0)])
+    
+    def summary(self):
+        lines = ['{0} elements validated, {1} invalid'.format(self.validated, self.invalid)]
+        for (element_field, field), count in self.error_counts.most_common():
+            lines.append('    {0}.{1}: {2} errors'.format(element_field, field, count))
+        return '\n'.join(lines)
+
+
+class ElementValidator(object):
+    """Validates the shaped elements with the compiled schema, checking one
+       out of every sample_every elements"""
+    
+    def __init__(self, element_schema=SCHEMA, sample_every=1, max_errors=1000,
+                 raise_on_error=False):
+        self.element_schema = element_schema
+        self.checks = compile_schema(element_schema)
+        self.sample_every = sample_every
+        self.raise_on_error = raise_on_error
+        self.report = ValidationReport(max_errors)
+        self.seen = 0
+    
+    def validate(self, element):
+        """Validates the element if it is sampled. Returns False if errors
+           were found, True otherwise"""
+        
+        self.seen += 1
+        if self.sample_every > 1 and (self.seen - 1) % self.sample_every:
+            return True
+        
+        self.report.validated += 1
+        main = element.get('node') or element.get('way') or element.get('relation')
+        if isinstance(main, dict):
+            element_id = main.get('id')
+        else:
+            element_id = getattr(main, 'id', None)
+        valid = True
+        for element_field, records in element.items():
+            try:
+                check = self.checks[element_field]
+            except KeyError:
+                errors = [(element_field, 'unknown field')]
+            else:
+                errors = check(records)
+            
+            if errors:
+                valid = False
+                self.report.add(element_field, element_id, errors)
+                if self.raise_on_error:
+                    message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+                    raise Exception(message_string.format(element_field, pprint.pformat(errors)))
+        
+        if not valid:
+            self.report.invalid += 1
+        
+        return valid
+    
+    def spawn(self):
+        """Returns a new validator with the same settings and an empty report,
+           used by the worker processes"""
+        
+        return ElementValidator(self.element_schema, self.sample_every, 
+                                self.report.max_errors, self.raise_on_error)
+    
+    def __getstate__(self):
+        # The compiled checks cannot be pickled, they are rebuilt instead
+        state = self.__dict__.copy()
+        del state['checks']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.checks = compile_schema(self.element_schema)
+
+
+def get_validator(validate):
+    """Returns the validator to use for the validate argument of process_map:
+       None if False, a validator raising on the first error if True, or the
+       given validator"""
+    
+    if validate is True:
+        return ElementValidator(raise_on_error=True)
+    if not validate:
+        return None
+    
+    return validate